@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# --- BENCHMARK DE ARRANQUE ---
+# Mide el arranque en frío de la app en un proceso nuevo con `python -X importtime`:
+# cuánto tarda en importarse el módulo y en dibujarse la primera pantalla (la
+# ejecución del script sin token de Dropbox: barra lateral, encabezado y aviso)
+# y qué paquetes se importan en el camino. Termina con código 1 si la primera
+# pantalla importa un SDK pesado o rebasa el presupuesto, para detectar
+# regresiones. El tiempo de importar Streamlit se reporta aparte: no depende
+# de la app.
+#
+#   python benchmark_arranque.py
+#   python benchmark_arranque.py --repeticiones 5 --presupuesto-ms 500
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_SCRIPT = os.path.join(APP_DIR, "calculadora_cambio_USD.py")
+# Paquetes que la primera pantalla no debe importar (se cargan al conectarse o al usarse)
+HEAVY_PACKAGES = ["gspread", "google", "dropbox", "pandas", "numpy", "pyarrow", "PIL", "tenacity"]
+_PHASE_MARK = "--- fase "
+
+# Proceso hijo: marca en stderr el inicio de cada fase para repartir las líneas de importtime
+_CHILD = f"""
+import json, sys, time
+def phase(name):
+    print("{_PHASE_MARK}" + name, file=sys.stderr, flush=True)
+    return time.perf_counter()
+start = phase("streamlit")
+from streamlit.testing.v1 import AppTest
+module_start = phase("modulo")
+import calculadora_cambio_USD
+render_start = phase("primera_pantalla")
+app = AppTest.from_file({APP_SCRIPT!r}, default_timeout=60).run()
+end = phase("fin")
+print(json.dumps({{
+    "streamlit": module_start - start, "modulo": render_start - module_start, "primera_pantalla": end - render_start,
+    "aviso_token": any("token de Dropbox" in warning.value for warning in app.warning),
+    "excepciones": [str(exception.value) for exception in app.exception],
+}}))
+"""
+
+def parse_importtime(stderr):
+    """{fase: (µs acumulados por paquete de primer nivel, paquetes raíz importados a cualquier profundidad)}.
+
+    Lee la salida de `-X importtime` repartida por las marcas de fase del proceso hijo.
+    """
+    phases, current = {}, None
+    for line in stderr.splitlines():
+        if line.startswith(_PHASE_MARK):
+            current = phases.setdefault(line[len(_PHASE_MARK):], ({}, set()))
+        elif line.startswith("import time:") and current is not None:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if not cumulative.strip().isdigit(): continue
+            root = name.strip().split(".")[0]
+            current[1].add(root)
+            # Las importaciones anidadas ya están en el acumulado de su primer nivel
+            if not name.startswith("  "):
+                current[0][root] = current[0].get(root, 0) + int(cumulative)
+    return phases
+
+def run_once():
+    # Directorio vacío: sin .streamlit/secrets.toml la app se detiene en el aviso de token
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [APP_DIR, os.environ.get("PYTHONPATH")])))
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", _CHILD], cwd=directory, env=env, capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        raise RuntimeError(f"El proceso de arranque falló:\n{result.stderr[-2000:]}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings, parse_importtime(result.stderr)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de arranque en frío de la app (python -X importtime).")
+    parser.add_argument("--repeticiones", type=int, default=3, help="Procesos nuevos a medir; se reporta la mediana")
+    parser.add_argument("--presupuesto-ms", type=float, default=500, help="Máximo para importar la app y dibujar la primera pantalla")
+    parser.add_argument("--top", type=int, default=10, help="Paquetes más lentos a mostrar")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    runs = [run_once() for _ in range(args.repeticiones)]
+    median = {phase: statistics.median(timings[phase] for timings, _ in runs) * 1000 for phase in ("streamlit", "modulo", "primera_pantalla")}
+    first_render = median["modulo"] + median["primera_pantalla"]
+    print(f"importar streamlit: {median['streamlit']:8.1f} ms (no depende de la app)")
+    print(f"importar la app:    {median['modulo']:8.1f} ms")
+    print(f"primera pantalla:   {median['primera_pantalla']:8.1f} ms")
+    print(f"hasta dibujar:      {first_render:8.1f} ms (presupuesto {args.presupuesto_ms:.0f} ms)")
+    timings, phases = runs[-1]
+    app_imports, imported = {}, set()
+    for phase in ("modulo", "primera_pantalla"):
+        top_level, roots = phases.get(phase, ({}, set()))
+        imported |= roots
+        for package, micros in top_level.items():
+            app_imports[package] = app_imports.get(package, 0) + micros
+    print(f"\nPaquetes importados por la app antes de dibujar (último proceso, top {args.top}):")
+    for package, micros in sorted(app_imports.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {package:<28} {micros / 1000:8.1f} ms")
+
+    problems = [f"la primera pantalla importa {package}" for package in HEAVY_PACKAGES if package in imported]
+    if first_render > args.presupuesto_ms:
+        problems.append(f"la primera pantalla tardó {first_render:.0f} ms")
+    if not timings["aviso_token"]:
+        problems.append("la ejecución no terminó en el aviso de token de Dropbox")
+    problems += [f"excepción en el script: {exception}" for exception in timings["excepciones"]]
+    for problem in problems:
+        print(f"REGRESIÓN: {problem}", file=sys.stderr)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
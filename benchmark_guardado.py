@@ -0,0 +1,322 @@
+import argparse
+import io
+import logging
+import os
+import re
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import calculadora_cambio_USD as app
+from diario_guardado import SaveJournal
+
+# --- BENCHMARK DEL GUARDADO ---
+# Simula Google Sheets y Dropbox en memoria con latencia configurable por
+# llamada y ejecuta las mismas funciones que usa la app al guardar un cierre:
+# get_next_folio_number, el diario local y flush_journal_batch (subidas, links,
+# saldo desde el libro y escritura como etapas en paralelo, más el relleno de
+# links). Reporta p50/p95 del tiempo de guardado contra número de operaciones y
+# tamaño del libro.
+#
+#   python benchmark_guardado.py --ops 1,5,15 --ledger 100,10000,100000
+
+LEDGER_TAB = "Operaciones"
+CLIENT_ALIAS = "Cliente Benchmark"
+
+class Latency:
+    """Latencia simulada: `per_call` segundos por petición más `per_row` por fila transferida."""
+
+    def __init__(self, per_call=0.0, per_row=0.0):
+        self.per_call, self.per_row = per_call, per_row
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def wait(self, rows=0):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.per_call + self.per_row * rows)
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, sheet_id, values):
+        self.spreadsheet, self.title, self.id = spreadsheet, title, sheet_id
+        self.values = values
+
+    def _latency(self, rows=0):
+        self.spreadsheet.latency.wait(rows)
+
+    def get_all_values(self):
+        self._latency(len(self.values))
+        return [list(row) for row in self.values]
+
+    def get_all_records(self):
+        values = self.get_all_values()
+        return [dict(zip(values[0], row)) for row in values[1:]]
+
+    def col_values(self, col):
+        self._latency(len(self.values))
+        return [row[col - 1] if len(row) >= col else "" for row in self.values]
+
+    def row_values(self, row):
+        self._latency(1)
+        return list(self.values[row - 1])
+
+    def get(self, range_name, value_render_option=None):
+        # "A5:B9" o abierto hacia abajo como "A5:F"
+        bounds = [int(value) for value in re.findall(r"\d+", range_name)[:2]]
+        first, last = bounds[0], bounds[1] if len(bounds) > 1 else len(self.values)
+        self._latency(max(0, last - first + 1))
+        return [list(row) for row in self.values[first - 1:last]]
+
+    def update(self, values, range_name, **kwargs):
+        self._latency(len(values))
+        self.values = [[str(value) for value in row] for row in values]
+
+    def batch_get(self, ranges):
+        # Soporta "1:1" y rangos de una columna como "C2:C"
+        self._latency(len(self.values))
+        result = []
+        for range_name in ranges:
+            if range_name == "1:1":
+                result.append([list(self.values[0])] if self.values else [])
+                continue
+            col = app.gspread.utils.a1_to_rowcol(range_name.split(":")[0])[1]
+            result.append([[row[col - 1]] if len(row) >= col else [] for row in self.values[1:]])
+        return result
+
+    def find(self, query, in_column=None):
+        self._latency(len(self.values))
+        for row_number, row in enumerate(self.values, start=1):
+            if len(row) >= in_column and str(row[in_column - 1]) == str(query):
+                return app.gspread.cell.Cell(row_number, in_column, row[in_column - 1])
+        return None
+
+    def _set(self, row, col, value):
+        while len(self.values) < row: self.values.append([])
+        target = self.values[row - 1]
+        while len(target) < col: target.append("")
+        target[col - 1] = str(value)
+
+    def update_cell(self, row, col, value):
+        self._latency(1)
+        self._set(row, col, value)
+
+    def update_acell(self, label, value):
+        self.update_cell(*app.gspread.utils.a1_to_rowcol(label), value)
+
+    def append_rows(self, rows, **kwargs):
+        self._latency(len(rows))
+        # Sheets serializa los append; con guardados concurrentes cada uno debe recibir su rango
+        with self.spreadsheet.lock:
+            first = len(self.values) + 1
+            self.values.extend([str(value) for value in row] for row in rows)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{first}:B{len(self.values)}"}}
+
+    def append_row(self, row, **kwargs):
+        return self.append_rows([row], **kwargs)
+
+class FakeSpreadsheet:
+    def __init__(self, latency, ledger_rows, clients):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.sheets = {}
+        self._next_id = 0
+        self._add(LEDGER_TAB, ledger_rows)
+        self._add("Clientes", clients)
+
+    def _add(self, title, values):
+        self.sheets[title] = FakeWorksheet(self, title, self._next_id, values)
+        self._next_id += 1
+        return self.sheets[title]
+
+    def worksheets(self):
+        self.latency.wait()
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows, cols):
+        self.latency.wait()
+        with self.lock:
+            if title in self.sheets:
+                # Igual que Sheets: otra petición ya creó la pestaña
+                raise app.gspread.exceptions.APIError(FakeErrorResponse(400, f'A sheet with the name "{title}" already exists.'))
+            return self._add(title, [])
+
+    def batch_update(self, body):
+        # Como en Sheets, el batchUpdate se aplica completo o no se aplica
+        rows = 0
+        with self.lock:
+            for request in body["requests"]:
+                if "addSheet" in request and request["addSheet"]["properties"]["title"] in self.sheets:
+                    raise app.gspread.exceptions.APIError(FakeErrorResponse(400, f'A sheet with the name "{request["addSheet"]["properties"]["title"]}" already exists.'))
+            for request in body["requests"]:
+                by_id = {ws.id: ws for ws in self.sheets.values()}
+                if "addSheet" in request:
+                    properties = request["addSheet"]["properties"]
+                    self.sheets[properties["title"]] = FakeWorksheet(self, properties["title"], properties["sheetId"], [])
+                elif "appendCells" in request:
+                    cells = request["appendCells"]
+                    new_rows = [[_cell_value(cell) for cell in row["values"]] for row in cells["rows"]]
+                    by_id[cells["sheetId"]].values.extend(new_rows)
+                    rows += len(new_rows)
+                elif "findReplace" in request:
+                    replace = request["findReplace"]
+                    column = replace["range"]["startColumnIndex"]
+                    for row in by_id[replace["range"]["sheetId"]].values:
+                        if len(row) > column and row[column] == replace["find"]:
+                            row[column] = replace["replacement"]
+                    rows += 1
+                elif "updateCells" in request:
+                    start = request["updateCells"]["start"]
+                    value = _cell_value(request["updateCells"]["rows"][0]["values"][0])
+                    by_id[start["sheetId"]]._set(start["rowIndex"] + 1, start["columnIndex"] + 1, value)
+                    rows += 1
+        self.latency.wait(rows)
+        return {}
+
+class FakeErrorResponse:
+    def __init__(self, status_code, message):
+        self.status_code, self.message = status_code, message
+        self.text = message
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": self.message, "status": "INVALID_ARGUMENT"}}
+
+def _cell_value(cell):
+    value = cell.get("userEnteredValue", {})
+    return str(next(iter(value.values()))) if value else ""
+
+class FakeGspreadClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_key(self, key):
+        self.spreadsheet.latency.wait()
+        return self.spreadsheet
+
+class FakeLinkMetadata:
+    def __init__(self, url):
+        self.url = url
+
+class FakeSessionStart:
+    def __init__(self, session_id):
+        self.session_id = session_id
+
+class FakeFinishBatch:
+    def __init__(self, entries):
+        self.entries = entries
+
+class FakeDropbox:
+    def __init__(self, latency, per_byte=0.0):
+        self.latency, self.per_byte = latency, per_byte
+
+    def users_get_current_account(self):
+        self.latency.wait()
+
+    def files_upload(self, data, path, mode=None):
+        self.latency.wait()
+        time.sleep(self.per_byte * len(data))
+
+    def files_upload_session_start(self, data, close=False):
+        self.latency.wait()
+        time.sleep(self.per_byte * len(data))
+        return FakeSessionStart(f"sesion-{id(data)}")
+
+    def files_upload_session_append_v2(self, data, cursor, close=False):
+        self.latency.wait()
+        time.sleep(self.per_byte * len(data))
+
+    def files_upload_session_finish(self, data, cursor, commit):
+        self.latency.wait()
+
+    def files_upload_session_finish_batch_v2(self, entries):
+        self.latency.wait()
+        return FakeFinishBatch([app.dropbox.files.UploadSessionFinishBatchResultEntry.success(app.dropbox.files.FileMetadata(name=entry.commit.path.rsplit("/", 1)[-1])) for entry in entries])
+
+    def sharing_create_shared_link_with_settings(self, path):
+        self.latency.wait()
+        return FakeLinkMetadata(f"https://www.dropbox.com/s/benchmark{path}?dl=0")
+
+class FakeUpload(io.BytesIO):
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+def build_ledger(rows):
+    # Libro con folios de días anteriores para que el folio de hoy empiece en 1
+    values = [["Folio", "Fecha", "Cliente", "Tipo", "USD", "USDT", "Comisión", "Comprobante"]]
+    values += [[f"24-01-01-{i:04d}", "2024-01-01 10:00:00", CLIENT_ALIAS, "Compra (Das USD)", "100", "96.5", "3.5", ""] for i in range(1, rows + 1)]
+    return values
+
+def build_clients(count=1000):
+    values = [["Id", "Alias Cliente", "Saldo USDT"]]
+    values += [[str(i), f"Cliente {i}", "0"] for i in range(1, count)]
+    values.append([str(count), CLIENT_ALIAS, "0"])
+    return values
+
+def run_save(gsheet_client, dbx_client, spreadsheet_id, journal, operations, receipt_bytes):
+    """Un guardado completo con las funciones de la app (folios, diario y su sincronización); regresa los segundos transcurridos."""
+    now = datetime.now()
+    today_prefix, timestamp = now.strftime("%y-%m-%d"), now.strftime("%Y-%m-%d %H:%M:%S")
+    start = time.perf_counter()
+    first_folio = app.get_next_folio_number(gsheet_client, spreadsheet_id, LEDGER_TAB, count=operations, today_prefix=today_prefix)
+    rows = [[f"{today_prefix}-{first_folio + i:04d}", timestamp, CLIENT_ALIAS, "Compra (Das USD)", 100.0, 96.5, 3.5, ""] for i in range(operations)]
+    # Contenido distinto por comprobante: el diario reutilizaría el link de uno repetido
+    receipts = {row[0]: (f"recibo_{i}.jpg", row[0].encode() + b"\0" * receipt_bytes) for i, row in enumerate(rows)} if receipt_bytes else {}
+    journal.enqueue(CLIENT_ALIAS, 123.45, rows, receipts)
+    batch = journal.next_pending()
+    app.flush_journal_batch(gsheet_client, dbx_client, spreadsheet_id, LEDGER_TAB, journal, batch)
+    journal.mark_synced(batch["id"])
+    return time.perf_counter() - start
+
+def percentile(samples, pct):
+    return statistics.quantiles(samples, n=100, method="inclusive")[pct - 1] if len(samples) > 1 else samples[0]
+
+def run_scenario(operations, ledger_rows, args):
+    sheets_latency = Latency(args.sheets_latency, args.sheets_per_row)
+    dropbox_latency = Latency(args.dropbox_latency)
+    spreadsheet = FakeSpreadsheet(sheets_latency, build_ledger(ledger_rows), build_clients(args.clients))
+    gsheet_client, dbx_client = FakeGspreadClient(spreadsheet), FakeDropbox(dropbox_latency, args.dropbox_per_byte)
+    # Un id por escenario: las cachés de la app (metadatos, clientes) no se comparten entre escenarios
+    spreadsheet_id = f"benchmark-{operations}-{ledger_rows}"
+    receipt_bytes = args.receipt_kb * 1024
+    with tempfile.TemporaryDirectory() as directory:
+        journal = SaveJournal(os.path.join(directory, "diario.sqlite3"))
+        run_save(gsheet_client, dbx_client, spreadsheet_id, journal, operations, receipt_bytes)
+        sheets_latency.calls = dropbox_latency.calls = 0
+        samples = [run_save(gsheet_client, dbx_client, spreadsheet_id, journal, operations, receipt_bytes) for _ in range(args.repeats)]
+    return {
+        "operations": operations, "ledger_rows": ledger_rows,
+        "p50": percentile(samples, 50), "p95": percentile(samples, 95),
+        "sheets_calls": sheets_latency.calls / args.repeats, "dropbox_calls": dropbox_latency.calls / args.repeats,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del guardado con Google Sheets y Dropbox simulados.")
+    parser.add_argument("--ops", default="1,5,15", help="Operaciones por guardado (lista separada por comas)")
+    parser.add_argument("--ledger", default="100,10000,100000", help="Filas en el libro de operaciones (lista separada por comas)")
+    parser.add_argument("--repeats", type=int, default=10, help="Guardados medidos por escenario, después de uno de calentamiento")
+    parser.add_argument("--clients", type=int, default=1000, help="Filas en la hoja de clientes")
+    parser.add_argument("--receipt-kb", type=int, default=200, help="Tamaño de cada comprobante; 0 = sin comprobantes")
+    parser.add_argument("--sheets-latency", type=float, default=0.05, help="Segundos por llamada a Sheets")
+    parser.add_argument("--sheets-per-row", type=float, default=0.00001, help="Segundos por fila transferida desde/hacia Sheets")
+    parser.add_argument("--sheets-quota", type=int, default=0, help="Peticiones por minuto permitidas por tipo (lectura/escritura); 0 = sin límite")
+    parser.add_argument("--dropbox-latency", type=float, default=0.1, help="Segundos por llamada a Dropbox")
+    parser.add_argument("--dropbox-per-byte", type=float, default=0.0, help="Segundos por byte subido a Dropbox")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Fuera de `streamlit run` las cachés de Streamlit avisan en cada llamada
+    logging.disable(logging.WARNING)
+    # Sin límite por omisión: el benchmark hace más guardados por minuto que la cuota real de Sheets
+    quota = args.sheets_quota or float("inf")
+    app.cuota_sheets.scheduler = app.cuota_sheets.SheetsScheduler(read_quota=quota, write_quota=quota)
+    print(f"{'ops':>5} {'libro':>8} {'p50 ms':>9} {'p95 ms':>9} {'Sheets/guardado':>16} {'Dropbox/guardado':>17}")
+    for ledger_rows in [int(value) for value in args.ledger.split(",")]:
+        for operations in [int(value) for value in args.ops.split(",")]:
+            result = run_scenario(operations, ledger_rows, args)
+            print(f"{result['operations']:>5} {result['ledger_rows']:>8} {result['p50'] * 1000:>9.1f} {result['p95'] * 1000:>9.1f} {result['sheets_calls']:>16.1f} {result['dropbox_calls']:>17.1f}")
+
+if __name__ == "__main__":
+    main()
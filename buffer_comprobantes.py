@@ -0,0 +1,100 @@
+import mmap
+import tempfile
+
+# --- BUFFER DE COMPROBANTES POR SESIÓN ---
+# Los comprobantes que se adjuntan en la página se guardan aquí en cuanto se
+# suben, con un tope de memoria por sesión: un archivo grande, o cualquiera que
+# rebase el tope, se escribe en un archivo temporal y se lee con memory-map.
+# El contenido se entrega como bytes o memoryview sin copiarlo; quien lo guarda
+# (el diario en SQLite) lo lee directo del buffer.
+
+# Bytes de comprobantes en memoria por sesión; lo que exceda va a disco
+RECEIPT_MEMORY_LIMIT = 32 * 1024 * 1024
+# Un archivo de este tamaño o mayor va a disco aunque haya espacio en memoria
+RECEIPT_SPILL_BYTES = 4 * 1024 * 1024
+
+class BufferedReceipt:
+    """Comprobante del buffer: `name`, `size`, `spilled` y su contenido con getvalue() o view()."""
+
+    def __init__(self, name, data, spill=False):
+        self.name, self.size = name, len(data)
+        self._data, self._file, self._map = None, None, None
+        if not spill or not self.size:
+            self._data = bytes(data)
+            return
+        # El archivo temporal no tiene nombre en disco y se borra al cerrarse
+        self._file = tempfile.TemporaryFile(prefix="comprobante_")
+        self._file.write(data)
+        self._file.flush()
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def spilled(self):
+        return self._map is not None
+
+    def view(self):
+        """Contenido sin copiar: memoryview sobre los bytes o sobre el memory-map del archivo temporal."""
+        return memoryview(self._map if self.spilled else self._data)
+
+    def getvalue(self):
+        # Misma interfaz que UploadedFile; en disco esto sí lee el archivo completo a memoria
+        return self._map[:] if self.spilled else self._data
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Todavía hay un memoryview vivo; el mapa se libera con él
+                return
+            self._file.close()
+        self._data, self._file, self._map = None, None, None
+
+class ReceiptBuffer:
+    """Comprobantes de una sesión por llave (la del uploader), con a lo más `memory_limit` bytes en memoria."""
+
+    def __init__(self, memory_limit=RECEIPT_MEMORY_LIMIT, spill_bytes=RECEIPT_SPILL_BYTES):
+        self.memory_limit, self.spill_bytes = memory_limit, spill_bytes
+        self._receipts = {}
+
+    def __contains__(self, key):
+        return key in self._receipts
+
+    def __len__(self):
+        return len(self._receipts)
+
+    def keys(self):
+        return list(self._receipts)
+
+    @property
+    def memory_bytes(self):
+        return sum(receipt.size for receipt in self._receipts.values() if not receipt.spilled)
+
+    @property
+    def disk_bytes(self):
+        return sum(receipt.size for receipt in self._receipts.values() if receipt.spilled)
+
+    def put(self, key, name, data):
+        """Guarda `data` (bytes o memoryview) como comprobante `key`, reemplazando el anterior; regresa el BufferedReceipt."""
+        self.discard(key)
+        spill = len(data) >= self.spill_bytes or self.memory_bytes + len(data) > self.memory_limit
+        receipt = self._receipts[key] = BufferedReceipt(name, data, spill)
+        return receipt
+
+    def get(self, key):
+        return self._receipts.get(key)
+
+    def discard(self, key):
+        receipt = self._receipts.pop(key, None)
+        if receipt is not None: receipt.close()
+
+    def clear(self):
+        for key in self.keys():
+            self.discard(key)
+
+def receipt_data(file_object):
+    """Contenido de un comprobante sin copiarlo (UploadedFile, StoredReceipt o BufferedReceipt)."""
+    if isinstance(file_object, BufferedReceipt):
+        return file_object.view()
+    # En un BytesIO creado desde bytes, getvalue() regresa esos mismos bytes; getbuffer() los copiaría
+    return file_object.getvalue()
@@ -0,0 +1,87 @@
+import difflib
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+# --- BÚSQUEDA DE CLIENTES ---
+# Índice en memoria de los alias para el selector de clientes: se construye una
+# vez por lista de clientes y cada búsqueda cuesta una búsqueda binaria (prefijo
+# del alias o de cualquiera de sus palabras) más, si hacen falta resultados, una
+# consulta por trigramas para coincidencias aproximadas. Mayúsculas, acentos y
+# signos no cuentan: "jose p" encuentra "José Pérez".
+
+CLIENT_SEARCH_LIMIT = 20
+# Similitud mínima (0-1) de una coincidencia aproximada
+FUZZY_MIN_RATIO = 0.6
+# Candidatos por trigramas que se comparan con difflib por cada resultado pedido
+FUZZY_CANDIDATES_PER_RESULT = 5
+
+# Orden de los resultados: alias idéntico, prefijo del alias, prefijo de una palabra, aproximado
+_EXACT, _PREFIX, _WORD_PREFIX, _FUZZY = range(4)
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+def fold(text):
+    # "  José  PÉREZ-Gómez " -> "jose perez gomez"
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(_NON_ALNUM.sub(" ", text).split())
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class ClientSearchIndex:
+    """Alias de clientes indexados para búsqueda por prefijo y aproximada; inmutable una vez construido."""
+
+    def __init__(self, aliases):
+        # Sin repetidos ni vacíos, en el orden de la hoja
+        self.aliases = list(dict.fromkeys(str(alias) for alias in aliases if str(alias).strip()))
+        self._folded = [fold(alias) for alias in self.aliases]
+        # Llaves ordenadas: el alias completo y cada sufijo que empieza en una palabra ("jose perez", "perez")
+        keys = []
+        for alias_id, folded in enumerate(self._folded):
+            words = folded.split()
+            keys.extend((" ".join(words[start:]), alias_id) for start in range(len(words)))
+        keys.sort()
+        self._keys, self._key_ids = [key for key, _ in keys], [alias_id for _, alias_id in keys]
+        self._postings = defaultdict(list)
+        for alias_id, folded in enumerate(self._folded):
+            for gram in _trigrams(folded):
+                self._postings[gram].append(alias_id)
+
+    def __len__(self):
+        return len(self.aliases)
+
+    def _prefix_matches(self, query, ranked):
+        position = bisect_left(self._keys, query)
+        while position < len(self._keys) and self._keys[position].startswith(query):
+            alias_id = self._key_ids[position]
+            folded = self._folded[alias_id]
+            rank = _EXACT if folded == query else _PREFIX if self._keys[position] == folded else _WORD_PREFIX
+            if rank < ranked.get(alias_id, (_FUZZY,))[0]:
+                ranked[alias_id] = (rank, 0.0)
+            position += 1
+
+    def _fuzzy_matches(self, query, ranked, limit):
+        shared = Counter()
+        for gram in _trigrams(query):
+            shared.update(self._postings.get(gram, ()))
+        for alias_id, _ in shared.most_common(limit * FUZZY_CANDIDATES_PER_RESULT):
+            if alias_id in ranked: continue
+            folded = self._folded[alias_id]
+            # Contra el alias completo y contra cada palabra: "peres" se parece más a "perez" que a "jose perez"
+            ratio = max(difflib.SequenceMatcher(None, query, candidate).ratio() for candidate in [folded] + folded.split())
+            if ratio >= FUZZY_MIN_RATIO:
+                ranked[alias_id] = (_FUZZY, -ratio)
+
+    def search(self, query, limit=CLIENT_SEARCH_LIMIT):
+        """Hasta `limit` alias que coinciden con `query`, los mejores primero; sin texto, los primeros de la hoja."""
+        query = fold(query)
+        if not query:
+            return self.aliases[:limit]
+        ranked = {}
+        self._prefix_matches(query, ranked)
+        if len(ranked) < limit:
+            self._fuzzy_matches(query, ranked, limit)
+        best = sorted(ranked, key=lambda alias_id: (*ranked[alias_id], len(self._folded[alias_id]), self._folded[alias_id]))
+        return [self.aliases[alias_id] for alias_id in best[:limit]]
@@ -1,11 +1,35 @@
 import streamlit as st
-import gspread
-from google.oauth2.service_account import Credentials
-from datetime import datetime
-import pandas as pd
-import dropbox
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import os
+import re
+import threading
+import time
 import pytz
+from functools import partial
+import carga_diferida
+import metricas
+import salud_conexiones
+import saldos
+import busqueda_clientes
+import buffer_comprobantes
+from diario_guardado import SaveJournal, JournalWorker, StoredReceipt, PermanentSyncError, STATUS_SYNCED, STATUS_FAILED
+# SDK y módulos pesados: se importan en su primer uso (ver carga_diferida)
+gspread = carga_diferida.lazy_module("gspread")
+service_account = carga_diferida.lazy_module("google.oauth2.service_account")
+google_auth_exceptions = carga_diferida.lazy_module("google.auth.exceptions")
+pd = carga_diferida.lazy_module("pandas")
+dropbox = carga_diferida.lazy_module("dropbox")
+requests = carga_diferida.lazy_module("requests")
+motor_conversion = carga_diferida.lazy_module("motor_conversion")
+importacion = carga_diferida.lazy_module("importacion")
+comprobantes = carga_diferida.lazy_module("comprobantes")
+cuota_sheets = carga_diferida.lazy_module("cuota_sheets")
+espejo_libro = carga_diferida.lazy_module("espejo_libro")
+cierre_diario = carga_diferida.lazy_module("cierre_diario")
+pipeline_guardado = carga_diferida.lazy_module("pipeline_guardado")
 
 # --- Importar credenciales (solo para entorno local) ---
 try:
@@ -13,46 +37,233 @@ try:
 except ImportError:
     pass
 
+# Se construyen una vez por proceso, no en cada llamada ni en cada ejecución del script
+MEXICO_TZ = pytz.timezone("America/Mexico_City")
+_A1_ROW = re.compile(r"![A-Z]+(\d+)")
+
 # --- FUNCIONES DE CONEXIÓN Y DATOS ---
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive.file"]
+# Conexiones HTTP reutilizables por cliente (cubre las subidas y lecturas en paralelo)
+HTTP_POOL_SIZE = 8
 
-@st.cache_resource
-def connect_to_google_sheets():
+def load_sheets_settings():
+    """(credenciales, spreadsheet_id, pestaña del libro) de st.secrets o, en local, de config.py; None si no hay."""
     try:
-        creds_dict = st.secrets["google_creds"]
-        spreadsheet_id = st.secrets["SPREADSHEET_ID"]
-        sheet_tab_name = st.secrets["SHEET_TAB_NAME"]
+        return st.secrets["google_creds"], st.secrets["SPREADSHEET_ID"], st.secrets["SHEET_TAB_NAME"]
     except (FileNotFoundError, KeyError):
         try:
-            creds_dict = GOOGLE_CREDS
-            spreadsheet_id = SPREADSHEET_ID
-            sheet_tab_name = SHEET_TAB_NAME
+            return GOOGLE_CREDS, SPREADSHEET_ID, SHEET_TAB_NAME
         except NameError:
-            st.error("No se encontraron credenciales de Google Sheets.")
-            st.stop()
-            
-    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+            return None
+
+def authorize_google_sheets(creds_dict):
+    creds = service_account.Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
     client = gspread.authorize(creds)
-    return client, spreadsheet_id, sheet_tab_name
+    client.http_client.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+    return client
+
+@st.cache_resource
+def connect_to_google_sheets():
+    settings = load_sheets_settings()
+    if settings is None:
+        st.error("No se encontraron credenciales de Google Sheets.")
+        st.stop()
+    creds_dict, spreadsheet_id, sheet_tab_name = settings
+    return authorize_google_sheets(creds_dict), spreadsheet_id, sheet_tab_name
 
 # --- MODIFICADO: Ahora recibe el token como parámetro ---
 @st.cache_resource
 def connect_to_dropbox(api_token):
-    return dropbox.Dropbox(api_token)
+    return dropbox.Dropbox(api_token, session=dropbox.create_session(max_connections=HTTP_POOL_SIZE))
+
+@st.cache_resource
+def get_dropbox_accounts():
+    # Llave de credencial -> cliente de Dropbox validado; cada lote se sincroniza con la cuenta de quien lo guardó
+    return {}
+
+@st.cache_resource
+def get_connection_health():
+    # Validaciones de tokens compartidas por todas las sesiones del proceso
+    return salud_conexiones.ConnectionHealth()
+
+def _auth_failed_service(exc):
+    # Recorre la cadena de causas: las fallas de subida llegan envueltas en RuntimeError
+    while exc is not None:
+        if isinstance(exc, dropbox.exceptions.AuthError):
+            return "dropbox"
+        if isinstance(exc, google_auth_exceptions.RefreshError) or (isinstance(exc, gspread.exceptions.APIError) and exc.response.status_code == 401):
+            return "sheets"
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+def revalidate_on_auth_error(health, keys, exc):
+    """Si `exc` es un error de autenticación, descarta la validación de ese servicio (`keys` es servicio -> llave)."""
+    service = _auth_failed_service(exc)
+    if service in keys:
+        health.invalidate(keys[service])
+        if service == "sheets": open_spreadsheet.clear()
+        # Sus lotes esperan a que alguien vuelva a conectar esa cuenta con un token válido
+        if service == "dropbox": get_dropbox_accounts().pop(keys[service], None)
+    return service
+
+# Respuestas de Sheets que no se corrigen reintentando (solicitud inválida, sin permiso, hoja inexistente)
+PERMANENT_SHEETS_STATUS = {400, 403, 404}
+
+def flush_with_revalidation(health, keys, flush_fn, batch):
+    try:
+        return flush_fn(batch)
+    except Exception as e:
+        revalidate_on_auth_error(health, keys, e)
+        if isinstance(e, gspread.exceptions.APIError) and e.response.status_code in PERMANENT_SHEETS_STATUS:
+            raise PermanentSyncError(f"Google Sheets rechazó el lote: {e}") from e
+        raise
+
+@st.cache_resource
+def open_spreadsheet(_gsheet_client, spreadsheet_id):
+    # Una sola lectura de metadatos por proceso: las hojas se reutilizan en cada guardado
+    spreadsheet = cuota_sheets.read(_gsheet_client.open_by_key, spreadsheet_id)
+    worksheets = {ws.title: ws for ws in cuota_sheets.read(spreadsheet.worksheets)}
+    return spreadsheet, worksheets
+
+def check_sheets_access(gsheet_client, spreadsheet_id):
+    # Llamada real y mínima (solo el id): open_spreadsheet está en caché y no saldría a la red al vencer el TTL
+    cuota_sheets.read(gsheet_client.http_client.fetch_sheet_metadata, spreadsheet_id, params={"fields": "spreadsheetId"})
+
+def sheets_credential_key(gsheet_client, spreadsheet_id):
+    # Por cuenta de servicio y llave privada (y la hoja a la que se valida el acceso), no solo por SPREADSHEET_ID
+    creds = gsheet_client.http_client.auth
+    return salud_conexiones.credential_key("sheets", (creds.service_account_email, creds.signer.key_id, spreadsheet_id))
+
+def get_worksheet(gsheet_client, spreadsheet_id, title):
+    spreadsheet, worksheets = open_spreadsheet(gsheet_client, spreadsheet_id)
+    if title not in worksheets:
+        # La estructura pudo cambiar (pestaña nueva o renombrada): se recargan los metadatos una vez
+        open_spreadsheet.clear()
+        spreadsheet, worksheets = open_spreadsheet(gsheet_client, spreadsheet_id)
+        if title not in worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+    return worksheets[title]
+
+class ClientIndex:
+    """Alias -> fila y encabezado -> columna de la hoja "Clientes", ambos base 1, más la búsqueda de alias."""
+
+    def __init__(self, client_df):
+        self.columns = {header: position for position, header in enumerate(client_df.columns, start=1)}
+        self.rows = {}
+        if 'Alias Cliente' in client_df.columns:
+            # Si un alias se repite gana la primera fila, igual que worksheet.find
+            for alias, row_number in zip(client_df['Alias Cliente'], client_df.index):
+                self.rows.setdefault(str(alias), int(row_number))
+        # Se construye junto con el índice, es decir, solo cuando cambia la lista de clientes
+        self.search = busqueda_clientes.ClientSearchIndex(self.rows)
+
+    def cell(self, client_alias, header):
+        row_number, col_number = self.rows.get(str(client_alias)), self.columns.get(header)
+        if row_number is None or col_number is None:
+            return None
+        return row_number, col_number
+
+# Opciones que muestra el selector de clientes (las mejores coincidencias de la búsqueda)
+CLIENT_SELECTOR_RESULTS = 50
+# Segundos entre verificaciones de cambios en la hoja "Clientes"
+CLIENT_REFRESH_SECONDS = 60
+
+def _clean_balances(values):
+    return pd.to_numeric(pd.Series(values, dtype=object).astype(str).str.replace(r'[$,]', '', regex=True), errors='coerce').fillna(0).astype(float)
+
+def _column_range(col_number):
+    # 3 -> "C2:C" (la columna completa sin el encabezado)
+    letter = gspread.utils.rowcol_to_a1(1, col_number)[:-1]
+    return f"{letter}2:{letter}"
+
+class ClientCache:
+    """Copia en memoria de la hoja "Clientes", compartida por todas las sesiones.
+
+    La primera lectura descarga la hoja completa. Después, cada
+    CLIENT_REFRESH_SECONDS se leen solo los encabezados y las columnas de alias y
+    saldo en una petición: si encabezados o alias cambiaron (clientes nuevos,
+    borrados o reordenados) se recarga todo; si no, solo se actualizan los saldos
+    que difieren. Un guardado parcha su saldo de inmediato con `patch_balance`.
+    Los cambios crean un DataFrame nuevo: el que regresa `snapshot` no se modifica
+    después, aunque otra sesión lo siga leyendo.
+    """
+
+    def __init__(self, gsheet_client, spreadsheet_id):
+        self._gsheet_client, self._spreadsheet_id = gsheet_client, spreadsheet_id
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._raw_aliases = []
+        self.df, self.index = None, None
+
+    def _worksheet(self):
+        return get_worksheet(self._gsheet_client, self._spreadsheet_id, "Clientes")
+
+    def _full_reload(self):
+        values = cuota_sheets.read(self._worksheet().get_all_values)
+        headers, rows = (values[0], values[1:]) if values else ([], [])
+        if not rows:
+            df = pd.DataFrame(columns=['Alias Cliente', 'Saldo USDT'])
+        else:
+            df = pd.DataFrame(gspread.utils.to_records(headers, [gspread.utils.numericise_all(row) for row in rows]), columns=headers)
+            # El índice del DataFrame es el número de fila en la hoja (la fila 1 son los encabezados)
+            df.index = range(2, len(df) + 2)
+            # Limpieza de datos
+            if 'Saldo USDT' in df.columns:
+                df['Saldo USDT'] = _clean_balances(df['Saldo USDT'].tolist()).to_numpy()
+        alias_pos = headers.index('Alias Cliente') if 'Alias Cliente' in headers else None
+        self._raw_aliases = [row[alias_pos] if alias_pos is not None and alias_pos < len(row) else "" for row in rows]
+        self.df, self.index = df, ClientIndex(df)
+
+    def _refresh(self):
+        alias_col, usdt_col = self.index.columns.get('Alias Cliente'), self.index.columns.get('Saldo USDT')
+        if alias_col is None or usdt_col is None or self.df.empty:
+            return self._full_reload()
+        headers, aliases, balances = cuota_sheets.read(self._worksheet().batch_get, ["1:1", _column_range(alias_col), _column_range(usdt_col)])
+        headers = headers[0] if headers else []
+        aliases = [row[0] if row else "" for row in aliases]
+        known_aliases = list(self._raw_aliases)
+        while known_aliases and known_aliases[-1] == "": known_aliases.pop()
+        if headers != list(self.df.columns) or aliases != known_aliases:
+            return self._full_reload()
+        balances = [row[0] if row else "" for row in balances]
+        balances += [""] * (len(self.df) - len(balances))
+        fresh = _clean_balances(balances[:len(self.df)]).to_numpy()
+        changed = fresh != self.df['Saldo USDT'].to_numpy()
+        if changed.any():
+            df = self.df.copy()
+            df.loc[df.index[changed], 'Saldo USDT'] = fresh[changed]
+            self.df = df
+
+    def snapshot(self, force=False):
+        with self._lock:
+            if self.df is None:
+                self._full_reload()
+            elif force or time.monotonic() - self._checked_at >= CLIENT_REFRESH_SECONDS:
+                self._refresh()
+            else:
+                return self.df, self.index
+            self._checked_at = time.monotonic()
+            return self.df, self.index
+
+    def patch_balance(self, client_alias, new_usdt):
+        with self._lock:
+            cell = self.index.cell(client_alias, 'Saldo USDT') if self.index else None
+            if cell is not None:
+                df = self.df.copy()
+                df.at[cell[0], 'Saldo USDT'] = float(new_usdt)
+                self.df = df
+
+    def invalidate(self):
+        with self._lock:
+            self.df, self.index = None, None
+
+@st.cache_resource
+def get_client_cache(_gsheet_client, spreadsheet_id):
+    return ClientCache(_gsheet_client, spreadsheet_id)
 
-@st.cache_data(ttl=60)
 def get_client_data(_gsheet_client, spreadsheet_id):
     try:
-        spreadsheet = _gsheet_client.open_by_key(spreadsheet_id)
-        worksheet = spreadsheet.worksheet("Clientes")
-        data = worksheet.get_all_records()
-        if not data: return pd.DataFrame(columns=['Alias Cliente', 'Saldo USDT'])
-        df = pd.DataFrame(data)
-        # Limpieza de datos
-        if 'Saldo USDT' in df.columns:
-            df['Saldo USDT'] = df['Saldo USDT'].astype(str).str.replace(r'[$,]', '', regex=True)
-            df['Saldo USDT'] = pd.to_numeric(df['Saldo USDT'], errors='coerce').fillna(0)
-        return df
+        return get_client_cache(_gsheet_client, spreadsheet_id).snapshot()[0]
     except gspread.exceptions.WorksheetNotFound:
         st.error("Error: No se encontró la hoja 'Clientes' en tu Google Sheet.")
         return pd.DataFrame()
@@ -60,66 +271,943 @@ def get_client_data(_gsheet_client, spreadsheet_id):
         st.error(f"No se pudo cargar la lista de clientes: {e}")
         return pd.DataFrame()
 
-def upload_to_dropbox(dbx_client, file_object, client_name):
+def get_client_index(_gsheet_client, spreadsheet_id):
+    return get_client_cache(_gsheet_client, spreadsheet_id).snapshot()[1]
+
+def find_client(gsheet_client, spreadsheet_id, client_alias):
+    """Fila de "Clientes" del alias como Series, o None; búsqueda directa por el índice, sin recorrer la tabla."""
+    client_df, index = get_client_cache(gsheet_client, spreadsheet_id).snapshot()
+    row_number = index.rows.get(str(client_alias))
+    return None if row_number is None else client_df.loc[row_number]
+
+def invalidate_client_cache(gsheet_client, spreadsheet_id):
+    # Fuerza una recarga completa en la siguiente lectura
+    get_client_cache(gsheet_client, spreadsheet_id).invalidate()
+
+def patch_client_balance(gsheet_client, spreadsheet_id, client_alias, new_usdt):
+    # Refleja en la caché el saldo que se acaba de escribir, sin volver a leer la hoja
+    get_client_cache(gsheet_client, spreadsheet_id).patch_balance(client_alias, new_usdt)
+
+def find_client_balance_cell(gsheet_client, spreadsheet_id, client_alias):
+    cell = get_client_index(gsheet_client, spreadsheet_id).cell(client_alias, "Saldo USDT")
+    if cell is None:
+        # Cliente nuevo o filas reordenadas desde la última carga: se reconstruye el índice una vez
+        invalidate_client_cache(gsheet_client, spreadsheet_id)
+        cell = get_client_index(gsheet_client, spreadsheet_id).cell(client_alias, "Saldo USDT")
+    return cell
+
+# Archivos más grandes que esto se suben por partes en una sesión de Dropbox
+UPLOAD_SESSION_THRESHOLD = 8 * 1024 * 1024
+# Tamaño de cada parte; Dropbox pide múltiplos de 4 MB (salvo la última)
+UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+# Reintentos por parte ante errores de red antes de abandonar la sesión
+UPLOAD_CHUNK_RETRIES = 3
+
+def _receipt_path(file_object, client_name, folio=None):
+    timestamp = datetime.now(MEXICO_TZ).strftime("%Y%m%d_%H%M%S")
+    file_name = f"{folio}_{file_object.name}" if folio else file_object.name
+    return f"/{client_name.replace(' ', '_')}/{timestamp}_{file_name}"
+
+def _shared_link(dbx_client, dropbox_path):
+    with metricas.span("dropbox.shared_link"):
+        try:
+            link = dbx_client.sharing_create_shared_link_with_settings(dropbox_path).url
+        except dropbox.exceptions.ApiError as e:
+            if not (isinstance(e.error, dropbox.sharing.CreateSharedLinkWithSettingsError) and e.error.is_shared_link_already_exists()): raise
+            # El archivo ya tenía link (p. ej. un reintento): se usa el existente
+            existing = e.error.get_shared_link_already_exists()
+            if existing is not None and existing.is_metadata():
+                link = existing.get_metadata().url
+            else:
+                link = dbx_client.sharing_list_shared_links(path=dropbox_path, direct_only=True).links[0].url
+    return link.replace("?dl=0", "?raw=1")
+
+def _commit_info(dropbox_path):
+    return dropbox.files.CommitInfo(path=dropbox_path, mode=dropbox.files.WriteMode('overwrite'))
+
+def _upload_session(dbx_client, file_object, chunk_size=UPLOAD_CHUNK_BYTES):
+    """Sube el archivo por partes y regresa el cursor de la sesión, ya cerrada y lista para confirmarse.
+
+    Las partes se leen del buffer del archivo sin copiarlo completo. Ante un error de red
+    la parte se reenvía; si Dropbox indica otro offset (la parte sí había llegado o se
+    perdió una anterior) se continúa desde el último offset que confirmó.
+    """
+    # Sin copiar el archivo: getbuffer() de un BytesIO duplicaría su contenido; cada parte sí se copia al enviarse
+    view = memoryview(buffer_comprobantes.receipt_data(file_object))
+    size = len(view)
     try:
-        mexico_tz = pytz.timezone("America/Mexico_City")
-        timestamp = datetime.now(mexico_tz).strftime("%Y%m%d_%H%M%S")
-        dropbox_path = f"/{client_name.replace(' ', '_')}/{timestamp}_{file_object.name}"
-        dbx_client.files_upload(file_object.getvalue(), dropbox_path, mode=dropbox.files.WriteMode('overwrite'))
-        link_metadata = dbx_client.sharing_create_shared_link_with_settings(dropbox_path)
-        link = link_metadata.url
-        return link.replace("?dl=0", "?raw=1")
-    except Exception as e:
-        st.warning(f"No se pudo subir el archivo a Dropbox: {e}")
-        return ""
+        cursor, failures = None, 0
+        while cursor is None or cursor.offset < size:
+            offset = cursor.offset if cursor else 0
+            end = min(offset + chunk_size, size)
+            try:
+                if cursor is None:
+                    with metricas.span("dropbox.upload_session_start"):
+                        result = dbx_client.files_upload_session_start(bytes(view[:end]), close=end == size)
+                    cursor = dropbox.files.UploadSessionCursor(session_id=result.session_id, offset=end)
+                else:
+                    with metricas.span("dropbox.upload_session_append"):
+                        dbx_client.files_upload_session_append_v2(bytes(view[offset:end]), cursor, close=end == size)
+                    cursor.offset = end
+                failures = 0
+            except dropbox.exceptions.ApiError as e:
+                if not isinstance(e.error, dropbox.files.UploadSessionLookupError) or failures >= UPLOAD_CHUNK_RETRIES: raise
+                if e.error.is_incorrect_offset():
+                    cursor.offset = e.error.get_incorrect_offset().correct_offset
+                elif e.error.is_closed() and end == size:
+                    # El reenvío de la última parte llegó a una sesión que ya se había cerrado con ella
+                    cursor.offset = end
+                else:
+                    raise
+                failures += 1
+                metricas.count("dropbox.upload_session_reanudaciones")
+            except (requests.exceptions.RequestException, dropbox.exceptions.InternalServerError):
+                if failures >= UPLOAD_CHUNK_RETRIES: raise
+                failures += 1
+                metricas.count("dropbox.upload_session_reanudaciones")
+                time.sleep(failures)
+        return cursor
+    finally:
+        view.release()
+
+def _is_large(file_object):
+    return len(buffer_comprobantes.receipt_data(file_object)) > UPLOAD_SESSION_THRESHOLD
+
+def _upload_file(dbx_client, file_object, client_name, folio=None):
+    # Versión sin UI: regresa la ruta en Dropbox (sin link) y lanza la excepción para que quien llama decida cómo reportarla
+    dropbox_path = _receipt_path(file_object, client_name, folio)
+    if _is_large(file_object):
+        cursor = _upload_session(dbx_client, file_object)
+        with metricas.span("dropbox.upload_session_finish"):
+            dbx_client.files_upload_session_finish(b"", cursor, _commit_info(dropbox_path))
+    else:
+        with metricas.span("dropbox.files_upload"):
+            dbx_client.files_upload(file_object.getvalue(), dropbox_path, mode=dropbox.files.WriteMode('overwrite'))
+    return dropbox_path
+
+def _stage_upload(dbx_client, file_object, client_name, folio=None):
+    # Sube el contenido de un archivo grande sin confirmarlo; regresa (ruta, cursor) para finish_batch
+    return _receipt_path(file_object, client_name, folio), _upload_session(dbx_client, file_object)
+
+def _finish_sessions(dbx_client, staged):
+    """Confirma en una sola llamada las sesiones `staged` (folio -> (ruta, cursor)); regresa (rutas, errores) por folio."""
+    folios = list(staged)
+    entries = [dropbox.files.UploadSessionFinishArg(cursor=staged[folio][1], commit=_commit_info(staged[folio][0])) for folio in folios]
+    with metricas.span("dropbox.upload_session_finish_batch"):
+        result = dbx_client.files_upload_session_finish_batch_v2(entries)
+    paths, errors = {}, {}
+    for folio, entry in zip(folios, result.entries):
+        if entry.is_success():
+            paths[folio] = staged[folio][0]
+        else:
+            errors[folio] = RuntimeError(f"Dropbox no confirmó la subida: {entry.get_failure()}")
+    return paths, errors
+
+# Número máximo de subidas simultáneas a Dropbox por guardado
+MAX_UPLOAD_WORKERS = 4
+
+def _run_concurrently(fn, dbx_client, items):
+    # Ejecuta fn(dbx_client, *args) por clave en paralelo; regresa (resultados, errores) por clave
+    results, errors = {}, {}
+    if not items:
+        return results, errors
+    with ThreadPoolExecutor(max_workers=min(MAX_UPLOAD_WORKERS, len(items))) as executor:
+        futures = {metricas.submit(executor, fn, dbx_client, *args): key for key, args in items.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                results[key] = ""
+                errors[key] = e
+    return results, errors
+
+def upload_files_concurrently(dbx_client, uploads, client_name):
+    """Sube en paralelo los comprobantes de un lote, sin crear links.
+
+    `uploads` es un dict folio -> archivo. Regresa (paths, errors), ambos dicts
+    por folio; un archivo que falla deja ruta "" y su excepción en `errors`
+    sin detener el resto del lote. Si el lote trae dos o más archivos grandes,
+    sus sesiones se confirman juntas con finish_batch.
+    """
+    sessions = {folio for folio, file_object in uploads.items() if _is_large(file_object)}
+    if len(sessions) < 2: sessions = set()
+
+    def upload_fn(dbx, file_object, folio):
+        return (_stage_upload if folio in sessions else _upload_file)(dbx, file_object, client_name, folio)
+
+    paths, errors = _run_concurrently(upload_fn, dbx_client, {folio: (file_object, folio) for folio, file_object in uploads.items()})
+    staged = {folio: paths.pop(folio) for folio in sessions if folio not in errors}
+    if staged:
+        try:
+            committed, commit_errors = _finish_sessions(dbx_client, staged)
+        except Exception as e:
+            committed, commit_errors = {}, {folio: e for folio in staged}
+        errors.update(commit_errors)
+        paths.update({folio: committed.get(folio, "") for folio in staged})
+    return paths, errors
+
+# Pestaña de control con las reservas de folios: cada fila es [prefijo del día, folios reservados]
+FOLIO_TAB_NAME = "Folios"
+# Filas de reservas que se leen hacia atrás por cada petición
+FOLIO_LOOKBACK_ROWS = 200
+
+def _get_folio_worksheet(gsheet_client, spreadsheet_id, sheet_tab_name, today_prefix):
+    try:
+        return get_worksheet(gsheet_client, spreadsheet_id, FOLIO_TAB_NAME)
+    except gspread.exceptions.WorksheetNotFound:
+        pass
+    # Primera vez: se crea la pestaña sembrada con el último folio de hoy del libro de operaciones
+    seed = [["Prefijo", "Folios"]]
+    with metricas.span("sheets.folio_siembra"):
+        folios = cuota_sheets.read(get_worksheet(gsheet_client, spreadsheet_id, sheet_tab_name).col_values, 1)
+    if len(folios) >= 2 and folios[-1].startswith(f"{today_prefix}-"):
+        seed.append([today_prefix, int(folios[-1].split('-')[3])])
+    spreadsheet, worksheets = open_spreadsheet(gsheet_client, spreadsheet_id)
+    sheet_id = max((worksheet.id for worksheet in worksheets.values()), default=0) + 1
+    try:
+        # Pestaña y siembra en un solo batchUpdate: una reserva concurrente no puede quedar antes de la siembra
+        cuota_sheets.write(spreadsheet.batch_update, {"requests": [
+            {"addSheet": {"properties": {"sheetId": sheet_id, "title": FOLIO_TAB_NAME, "gridProperties": {"rowCount": 1000, "columnCount": 2}}}},
+            {"appendCells": {"sheetId": sheet_id, "rows": [{"values": [_to_cell_data(value) for value in row]} for row in seed], "fields": "userEnteredValue"}},
+        ]})
+    except gspread.exceptions.APIError as e:
+        # Otra caja la creó al mismo tiempo
+        if e.response.status_code == 429: raise
+    open_spreadsheet.clear()
+    return get_worksheet(gsheet_client, spreadsheet_id, FOLIO_TAB_NAME)
+
+def _row_from_range(a1_range):
+    # "'Folios'!A15:B15" -> 15
+    return int(_A1_ROW.search(a1_range).group(1))
+
+def get_next_folio_number(_gsheet_client, spreadsheet_id, sheet_tab_name, count=1, today_prefix=None):
+    """Reserva `count` folios consecutivos del día y regresa el primero.
+
+    La reserva es un append a la pestaña de folios, que la API serializa: la fila
+    asignada a esta petición define su lugar en la cola del día, y el número inicial es
+    la suma de las reservas de hoy anteriores a ella. Solo se leen las reservas
+    recientes, no el libro de operaciones completo. Los folios reinician en 1 cada día.
+    Los errores se propagan: un folio supuesto duplicaría folios ya asignados.
+    """
+    if today_prefix is None:
+        today_prefix = datetime.now(MEXICO_TZ).strftime("%y-%m-%d")
+    counter = _get_folio_worksheet(_gsheet_client, spreadsheet_id, sheet_tab_name, today_prefix)
+    with metricas.span("sheets.folio_reserva"):
+        response = cuota_sheets.write(counter.append_row, [today_prefix, count], value_input_option='RAW', table_range='A1')
+    last_row = _row_from_range(response['updates']['updatedRange']) - 1
+    reserved_before = 0
+    while last_row >= 1:
+        first_row = max(1, last_row - FOLIO_LOOKBACK_ROWS + 1)
+        with metricas.span("sheets.folio_lectura"):
+            rows = cuota_sheets.read(counter.get, f"A{first_row}:B{last_row}")
+        rows = list(rows) + [[]] * (last_row - first_row + 1 - len(rows))
+        for row in reversed(rows):
+            if len(row) < 2 or row[0] != today_prefix:
+                return reserved_before + 1
+            reserved_before += int(row[1])
+        last_row = first_row - 1
+    return reserved_before + 1
+
+# Folios que cada proceso reserva por adelantado; con menos de FOLIO_REFILL_AT se reserva otro bloque en segundo plano
+FOLIO_BLOCK_SIZE = 20
+FOLIO_REFILL_AT = 5
+# Espera máxima por un bloque que se está reservando antes de reservar en línea
+FOLIO_REFILL_WAIT_SECONDS = 10
+
+class FolioBlock:
+    """Folios del día ya reservados en la pestaña de folios, listos para asignarse sin llamar a Sheets.
+
+    Un guardado toma sus folios del bloque y, cuando quedan pocos, el siguiente bloque
+    se reserva en segundo plano: un error transitorio de Google no hace perder el lote.
+    Solo si el bloque no alcanza se reserva en línea, y ese error sí se propaga. Los
+    folios que no se usan (cambio de día, reinicio del proceso) quedan como huecos, y
+    con varias cajas los folios del libro no siguen el orden de la hora.
+    """
+
+    def __init__(self, reserve, size=FOLIO_BLOCK_SIZE, refill_at=FOLIO_REFILL_AT):
+        # reserve(count, today_prefix) reserva `count` folios consecutivos y regresa el primero
+        self._reserve = reserve
+        self.size, self.refill_at = size, refill_at
+        self._lock = threading.Lock()
+        self._refilled = threading.Condition(self._lock)
+        # Una asignación a la vez: la reserva en línea no debe duplicarse entre sesiones
+        self._take_lock = threading.Lock()
+        self._prefix, self._ranges = None, []
+        self._refilling = False
+
+    def _available(self):
+        return sum(end - start for start, end in self._ranges)
+
+    def available(self):
+        with self._lock:
+            return self._available()
+
+    def _add(self, today_prefix, count):
+        first = self._reserve(count, today_prefix)
+        with self._lock:
+            # Un bloque de un día anterior (reservado justo antes de medianoche) se descarta
+            if self._prefix is not None and today_prefix < self._prefix: return
+            if today_prefix != self._prefix: self._prefix, self._ranges = today_prefix, []
+            self._ranges.append([first, first + count])
+
+    def _refill(self, today_prefix):
+        try:
+            with metricas.span("folio.reserva_anticipada"):
+                self._add(today_prefix, self.size)
+        except Exception:
+            # Sin bloque nuevo, la siguiente asignación que no alcance reserva en línea
+            pass
+        finally:
+            with self._lock:
+                self._refilling = False
+                self._refilled.notify_all()
+
+    def prefetch(self, today_prefix):
+        """Reserva el siguiente bloque en segundo plano si quedan menos de `refill_at` folios."""
+        with self._lock:
+            if self._prefix != today_prefix: self._prefix, self._ranges = today_prefix, []
+            if self._refilling or self._available() >= self.refill_at: return
+            self._refilling = True
+        threading.Thread(target=self._refill, args=(today_prefix,), daemon=True).start()
+
+    def take(self, count, today_prefix):
+        """Asigna `count` folios del día; regresa sus números en orden (no siempre consecutivos)."""
+        with self._take_lock:
+            with self._lock:
+                if self._prefix != today_prefix: self._prefix, self._ranges = today_prefix, []
+                # Un bloque que ya se está reservando llega antes que una reserva en línea nueva
+                self._refilled.wait_for(lambda: not self._refilling or self._available() >= count, timeout=FOLIO_REFILL_WAIT_SECONDS)
+                missing = count - self._available()
+            if missing > 0:
+                with metricas.span("folio.reserva_en_linea"):
+                    self._add(today_prefix, missing + self.size)
+            numbers = []
+            with self._lock:
+                while len(numbers) < count:
+                    start, end = self._ranges[0]
+                    used = min(end - start, count - len(numbers))
+                    numbers.extend(range(start, start + used))
+                    if start + used == end: self._ranges.pop(0)
+                    else: self._ranges[0][0] = start + used
+        self.prefetch(today_prefix)
+        return numbers
+
+@st.cache_resource
+def get_folio_block(_gsheet_client, spreadsheet_id, sheet_tab_name):
+    return FolioBlock(lambda count, today_prefix: get_next_folio_number(_gsheet_client, spreadsheet_id, sheet_tab_name, count=count, today_prefix=today_prefix))
+
+# Origen de fechas de Google Sheets (número de serie 0)
+SHEETS_EPOCH = datetime(1899, 12, 30)
+
+def _to_cell_data(value):
+    # Equivalente a USER_ENTERED para los valores que escribe la app: números, fecha-hora y texto
+    if value == "" or value is None:
+        return {}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    try:
+        moment = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return {"userEnteredValue": {"stringValue": value}}
+    serial = (moment - SHEETS_EPOCH).total_seconds() / 86400
+    return {"userEnteredValue": {"numberValue": serial}, "userEnteredFormat": {"numberFormat": {"type": "DATE_TIME", "pattern": "yyyy-mm-dd hh:mm:ss"}}}
+
+def save_operations_batch(gsheet_client, spreadsheet_id, sheet_tab_name, rows, client_alias, new_usdt):
+    """Agrega las filas del lote y actualiza el saldo del cliente en un solo batchUpdate.
+
+    La petición es atómica: o se escriben las filas y el saldo, o no se escribe nada.
+    Regresa True si el saldo se incluyó en la escritura y False si no se encontró al cliente;
+    los errores de la API se propagan a quien llama.
+    """
+    spreadsheet, _ = open_spreadsheet(gsheet_client, spreadsheet_id)
+    ledger = get_worksheet(gsheet_client, spreadsheet_id, sheet_tab_name)
+    clients = get_worksheet(gsheet_client, spreadsheet_id, "Clientes")
+    requests = []
+    if rows:
+        requests.append({"appendCells": {
+            "sheetId": ledger.id,
+            "rows": [{"values": [_to_cell_data(value) for value in row]} for row in rows],
+            "fields": "userEnteredValue,userEnteredFormat.numberFormat",
+        }})
+    balance_cell = find_client_balance_cell(gsheet_client, spreadsheet_id, client_alias)
+    if balance_cell is not None:
+        row_number, usdt_col = balance_cell
+        requests.append({"updateCells": {
+            "start": {"sheetId": clients.id, "rowIndex": row_number - 1, "columnIndex": usdt_col - 1},
+            "rows": [{"values": [_to_cell_data(float(new_usdt))]}],
+            "fields": "userEnteredValue",
+        }})
+    if requests:
+        with metricas.span("sheets.batch_update"):
+            cuota_sheets.write(spreadsheet.batch_update, {"requests": requests})
+    return balance_cell is not None
+
+# --- SALDOS DERIVADOS DEL LIBRO ---
+# Etiqueta de cada tipo de operación en el libro
+OPERATION_LABELS = saldos.OPERATION_LABELS
+BALANCE_SIGNS = {OPERATION_LABELS[kind]: sign for kind, sign in saldos.SIGNS_BY_TYPE.items()}
+# Pestaña con el checkpoint: saldo de cada cliente hasta la fila "Fila Libro" del libro de operaciones
+# (cuyo folio es "Último Folio") y su saldo antes de la primera fila, para reconstruir si el libro cambia
+BALANCE_TAB_NAME = "Saldos"
+BALANCE_HEADERS = ["Alias Cliente", "Saldo USDT", "Fila Libro", "Último Folio", "Saldo Inicial"]
+# Cada cuánto el hilo del diario, sin lotes pendientes, verifica los saldos y avanza el checkpoint
+BALANCE_VERIFY_SECONDS = 300
+
+def read_ledger_after(gsheet_client, spreadsheet_id, sheet_tab_name, ledger_row, last_column="H"):
+    """Filas del libro posteriores a `ledger_row` (base 1, 1 = encabezado), sin formato: fechas como número de serie."""
+    ledger = get_worksheet(gsheet_client, spreadsheet_id, sheet_tab_name)
+    return cuota_sheets.read(ledger.get, f"A{ledger_row + 1}:{last_column}", value_render_option=gspread.utils.ValueRenderOption.unformatted)
+
+def _cents(value):
+    return int(motor_conversion.to_cents(_clean_balances([value]).iloc[0]))
+
+class BalanceBook:
+    """Saldos de clientes calculados desde el libro de operaciones, compartidos por todas las sesiones.
+
+    Saldo = checkpoint de la pestaña "Saldos" + filas del libro posteriores a él. Solo se
+    leen las filas nuevas: cada CLIENT_REFRESH_SECONDS o, al sincronizar un lote, justo
+    antes de escribir el saldo, de modo que dos cajas con el mismo cliente no se pisan.
+    Cada lectura incluye la última fila ya contada: si su folio cambió (filas borradas,
+    insertadas u ordenadas a mano), los saldos se reconstruyen desde la fila 2.
+    `verify` recalcula desde el checkpoint, señala los "Saldo USDT" de "Clientes" que no
+    cuadran (no los sobrescribe: pudieron editarse a mano) y guarda un checkpoint nuevo;
+    `apply_corrections` los corrige solo cuando alguien lo pide.
+    """
+
+    def __init__(self, gsheet_client, spreadsheet_id, sheet_tab_name):
+        self._gsheet_client, self._spreadsheet_id, self._sheet_tab_name = gsheet_client, spreadsheet_id, sheet_tab_name
+        self._lock = threading.Lock()
+        self.checkpoint, self._tail = None, None
+        self._tail_folios = set()
+        # Folios que esta caja escribió y ya suma en _tail, antes de que _catch_up los lea del libro
+        self._written_folios = set()
+        self._checked_at = 0.0
+        # Alias -> (saldo en "Clientes", saldo según el libro) de la última verificación
+        self.discrepancies = {}
+
+    def _read_ledger_after(self, ledger_row):
+        with metricas.span("sheets.saldos_libro"):
+            return read_ledger_after(self._gsheet_client, self._spreadsheet_id, self._sheet_tab_name, ledger_row, last_column="F")
 
-def update_client_balance(_gsheet_client, spreadsheet_id, client_alias, new_usdt):
+    def _write_checkpoint(self, checkpoint):
+        worksheet = get_worksheet(self._gsheet_client, self._spreadsheet_id, BALANCE_TAB_NAME)
+        opening = checkpoint.opening or {}
+        values = [BALANCE_HEADERS] + [[alias, cents / 100, checkpoint.ledger_row, checkpoint.last_folio, opening[alias] / 100 if alias in opening else ""] for alias, cents in sorted(checkpoint.balances.items())]
+        with metricas.span("sheets.saldos_checkpoint"):
+            cuota_sheets.write(worksheet.update, values, "A1", value_input_option='RAW')
+
+    def _client_balances(self):
+        client_df, _ = get_client_cache(self._gsheet_client, self._spreadsheet_id).snapshot(force=True)
+        return {alias: _cents(balance) for alias, balance in zip(client_df['Alias Cliente'], client_df['Saldo USDT']) if alias}
+
+    def _seed(self, rows):
+        # El saldo actual de "Clientes" a la altura de `rows` (el libro completo desde la fila 2)
+        balances = self._client_balances()
+        return saldos.Checkpoint(1 + len(rows), saldos.row_folio(rows[-1]) if rows else "", balances, saldos.opening_balances(balances, rows, BALANCE_SIGNS))
+
+    def _seed_checkpoint(self):
+        # Primera vez: el checkpoint es el saldo actual de "Clientes" a la altura actual del libro
+        checkpoint = self._seed(self._read_ledger_after(1))
+        balances = checkpoint.balances
+        spreadsheet, _ = open_spreadsheet(self._gsheet_client, self._spreadsheet_id)
+        try:
+            cuota_sheets.write(spreadsheet.add_worksheet, BALANCE_TAB_NAME, rows=max(1000, len(balances) + 100), cols=len(BALANCE_HEADERS))
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code == 429: raise
+            # Otra caja lo creó al mismo tiempo
+            open_spreadsheet.clear()
+            return self._load_checkpoint()
+        open_spreadsheet.clear()
+        self._write_checkpoint(checkpoint)
+        return checkpoint
+
+    def _load_checkpoint(self):
+        try:
+            worksheet = get_worksheet(self._gsheet_client, self._spreadsheet_id, BALANCE_TAB_NAME)
+        except gspread.exceptions.WorksheetNotFound:
+            return self._seed_checkpoint()
+        values = cuota_sheets.read(worksheet.get_all_values)
+        rows = [row for row in values[1:] if row and row[0]]
+        if not rows:
+            return saldos.Checkpoint(0, "", {})
+        # Una pestaña de antes de "Saldo Inicial" no tiene saldos iniciales; verify los calcula
+        opening = {row[0]: _cents(row[4]) for row in rows if len(row) > 4 and row[4] != ""} if len(values[0]) > 4 else None
+        return saldos.Checkpoint(int(rows[0][2]), rows[0][3], {row[0]: _cents(row[1]) for row in rows}, opening)
+
+    def _read_since(self, checkpoint):
+        """(checkpoint, filas posteriores a él, si se reconstruyó).
+
+        Se lee también la fila del checkpoint: si su folio ya no es `last_folio`, el libro
+        cambió antes de ella y se regresa el checkpoint de la fila 1 (saldos iniciales) con
+        todas las filas del libro. Sin saldos iniciales guardados se toman los de "Clientes".
+        """
+        if checkpoint.ledger_row < 2:
+            return checkpoint, self._read_ledger_after(checkpoint.ledger_row), False
+        rows = self._read_ledger_after(checkpoint.ledger_row - 1)
+        if rows and saldos.row_folio(rows[0]) == checkpoint.last_folio:
+            return checkpoint, rows[1:], False
+        metricas.count("saldos.reconstrucciones")
+        rows = self._read_ledger_after(1)
+        opening = checkpoint.opening if checkpoint.opening is not None else self._seed(rows).opening
+        return saldos.Checkpoint(1, "", opening, opening), rows, True
+
+    def _catch_up(self):
+        base, rows, rebuilt = self._read_since(self._tail)
+        if rebuilt:
+            self.checkpoint = self._tail = base.advance(rows, BALANCE_SIGNS)
+            self._tail_folios, self._written_folios = {saldos.row_folio(row) for row in rows}, set()
+        elif rows:
+            tail = base.advance(rows, BALANCE_SIGNS)
+            # Las filas que record_written ya sumó no se cuentan dos veces
+            counted = [row for row in rows if row and str(row[0]) in self._written_folios]
+            if counted:
+                tail.balances.subtract(saldos.ledger_deltas(counted, BALANCE_SIGNS))
+                self._written_folios.difference_update(str(row[0]) for row in counted)
+            self._tail = tail
+            self._tail_folios.update(str(row[0]) for row in rows if row)
+        self._checked_at = time.monotonic()
+
+    def _ensure(self, force):
+        if self.checkpoint is None:
+            self.checkpoint = self._tail = self._load_checkpoint()
+            self._tail_folios = set()
+            self._catch_up()
+        elif force or time.monotonic() - self._checked_at >= CLIENT_REFRESH_SECONDS:
+            self._catch_up()
+
+    def balance(self, client_alias, extra_rows=(), force=False):
+        """Saldo en USDT del cliente más el de `extra_rows` que aún no estén en el libro.
+
+        Regresa None si el cliente no está en el checkpoint (cliente nuevo hasta la
+        siguiente verificación); quien llama usa entonces el saldo de "Clientes".
+        """
+        with self._lock:
+            self._ensure(force)
+            if client_alias not in self.checkpoint.balances:
+                return None
+            rows = [row for row in extra_rows if str(row[0]) not in self._tail_folios]
+            return (self._tail.balances[client_alias] + saldos.ledger_deltas(rows, BALANCE_SIGNS).get(client_alias, 0)) / 100
+
+    def record_written(self, rows):
+        """Suma al saldo las filas que esta caja acaba de escribir en el libro, sin esperar a leerlas de vuelta."""
+        with self._lock:
+            if self._tail is None: return
+            rows = [row for row in rows if str(row[0]) not in self._tail_folios]
+            self._tail.balances.update(saldos.ledger_deltas(rows, BALANCE_SIGNS))
+            folios = {str(row[0]) for row in rows}
+            self._tail_folios.update(folios)
+            self._written_folios.update(folios)
+
+    def verify(self):
+        """Recalcula todos los saldos desde el checkpoint, avanza el checkpoint y regresa los de "Clientes" que difieren."""
+        with self._lock:
+            # Otro proceso pudo haber avanzado el checkpoint
+            checkpoint, rows, rebuilt = self._read_since(self._load_checkpoint())
+            tail_deltas = saldos.ledger_deltas(rows, BALANCE_SIGNS)
+            client_cache = get_client_cache(self._gsheet_client, self._spreadsheet_id)
+            client_df, index = client_cache.snapshot(force=True)
+            # Clientes nuevos: su saldo inicial es el de "Clientes" menos lo que ya registraron en el libro
+            for alias, balance in zip(client_df['Alias Cliente'], client_df['Saldo USDT']):
+                if alias and alias not in checkpoint.balances:
+                    checkpoint.balances[alias] = _cents(balance) - tail_deltas.get(alias, 0)
+                    if checkpoint.opening is not None: checkpoint.opening[alias] = checkpoint.balances[alias]
+            verified = checkpoint.advance(rows, BALANCE_SIGNS)
+            if verified.opening is None:
+                # Checkpoint anterior a los saldos iniciales: se calculan una vez con el libro completo
+                verified.opening = saldos.opening_balances(verified.balances, self._read_ledger_after(1)[:verified.ledger_row - 1], BALANCE_SIGNS)
+            if not rebuilt and self._tail is not None and self._tail.ledger_row == verified.ledger_row and any(self._tail.balances.get(alias, 0) != cents for alias, cents in verified.balances.items() if alias in self.checkpoint.balances):
+                metricas.count("saldos.divergencias")
+            discrepancies = {}
+            for alias, cents in verified.balances.items():
+                cell = index.cell(alias, "Saldo USDT")
+                if cell is None: continue
+                listed = _cents(client_df.at[cell[0], 'Saldo USDT'])
+                if listed != cents: discrepancies[alias] = (listed / 100, cents / 100)
+            if discrepancies: metricas.count("saldos.diferencias", len(discrepancies))
+            self._write_checkpoint(verified)
+            self.checkpoint = self._tail = verified
+            self._tail_folios, self._written_folios = set(), set()
+            self._checked_at = time.monotonic()
+            self.discrepancies = discrepancies
+            return discrepancies
+
+    def apply_corrections(self, aliases):
+        """Escribe en "Clientes" el saldo según el libro de `aliases` señalados por verify; regresa los corregidos.
+
+        Se omite un cliente cuyo saldo en "Clientes" cambió desde la verificación.
+        """
+        with self._lock:
+            client_cache = get_client_cache(self._gsheet_client, self._spreadsheet_id)
+            client_df, index = client_cache.snapshot(force=True)
+            clients = get_worksheet(self._gsheet_client, self._spreadsheet_id, "Clientes")
+            corrections, requests = {}, []
+            for alias in aliases:
+                cell = index.cell(alias, "Saldo USDT")
+                if alias not in self.discrepancies or cell is None: continue
+                listed, derived = self.discrepancies[alias]
+                if _cents(client_df.at[cell[0], 'Saldo USDT']) != _cents(listed): continue
+                corrections[alias] = derived
+                requests.append({"updateCells": {
+                    "start": {"sheetId": clients.id, "rowIndex": cell[0] - 1, "columnIndex": cell[1] - 1},
+                    "rows": [{"values": [_to_cell_data(derived)]}],
+                    "fields": "userEnteredValue",
+                }})
+            if requests:
+                spreadsheet, _ = open_spreadsheet(self._gsheet_client, self._spreadsheet_id)
+                with metricas.span("sheets.saldos_correccion"):
+                    cuota_sheets.write(spreadsheet.batch_update, {"requests": requests})
+                metricas.count("saldos.corregidos", len(corrections))
+                for alias, balance in corrections.items(): client_cache.patch_balance(alias, balance)
+            for alias in corrections: self.discrepancies.pop(alias, None)
+            return corrections
+
+@st.cache_resource
+def get_balance_book(_gsheet_client, spreadsheet_id, sheet_tab_name):
+    return BalanceBook(_gsheet_client, spreadsheet_id, sheet_tab_name)
+
+def verify_balances(gsheet_client, spreadsheet_id, sheet_tab_name):
+    # Pasada en segundo plano del hilo del diario; el resultado queda en las métricas
+    with metricas.trace("verificacion_saldos"):
+        get_balance_book(gsheet_client, spreadsheet_id, sheet_tab_name).verify()
+
+# --- ESPEJO LOCAL DEL LIBRO ---
+# Exclusivo de la app: otro proceso (p. ej. servicio_operaciones) no debe sincronizar este directorio
+LEDGER_MIRROR_DIR = "espejo_libro"
+
+@st.cache_resource
+def get_ledger_mirror():
+    return espejo_libro.LedgerMirror(LEDGER_MIRROR_DIR)
+
+# Un marcador de link más viejo que esto ya no se va a rellenar (su lote falló): la fila se copia tal cual
+PENDING_LINK_MAX_AGE = timedelta(hours=1)
+
+def _link_pending(row):
+    # Fila del libro cuyo comprobante todavía tiene el marcador de link pendiente (el espejo la copia después)
+    if len(row) <= RECEIPT_COLUMN_INDEX or not str(row[RECEIPT_COLUMN_INDEX]).startswith(PENDING_LINK_PREFIX):
+        return False
     try:
-        spreadsheet = _gsheet_client.open_by_key(spreadsheet_id)
-        worksheet = spreadsheet.worksheet("Clientes")
-        cell = worksheet.find(client_alias, in_column=2)
-        if cell is None:
-            st.warning(f"No se pudo encontrar al cliente '{client_alias}' para actualizar su saldo.")
+        # Sin formato la fecha llega como número de serie de Sheets
+        written = SHEETS_EPOCH + timedelta(days=float(row[1]))
+    except (TypeError, ValueError):
+        try:
+            written = datetime.strptime(str(row[1]), "%Y-%m-%d %H:%M:%S")
+        except ValueError:
             return False
-        headers = worksheet.row_values(1)
-        usdt_col = headers.index("Saldo USDT") + 1
-        worksheet.update_cell(cell.row, usdt_col, new_usdt)
-        return True
+    return datetime.now(MEXICO_TZ).replace(tzinfo=None) - written < PENDING_LINK_MAX_AGE
+
+def sync_ledger_mirror(gsheet_client, spreadsheet_id, sheet_tab_name, max_age_seconds=0):
+    """Copia al espejo las filas nuevas del libro si la última sincronización tiene más de `max_age_seconds`."""
+    mirror = get_ledger_mirror()
+    if mirror.synced_at is not None and time.monotonic() - mirror.synced_at < max_age_seconds:
+        return mirror
+    with metricas.span("espejo.sincronizacion"):
+        copied = mirror.sync(partial(read_ledger_after, gsheet_client, spreadsheet_id, sheet_tab_name), incomplete=_link_pending)
+    if copied: metricas.count("espejo.filas_copiadas", copied)
+    return mirror
+
+def run_idle_maintenance(gsheet_client, spreadsheet_id, sheet_tab_name):
+    # Tareas del hilo del diario sin lotes pendientes; una falla no impide la siguiente
+    for task in (verify_balances, sync_ledger_mirror):
+        try:
+            task(gsheet_client, spreadsheet_id, sheet_tab_name)
+        except Exception:
+            pass
+
+def get_client_balance(gsheet_client, spreadsheet_id, sheet_tab_name, journal, client_alias, fallback):
+    """Saldo del cliente según el libro más sus lotes aún sin sincronizar; `fallback` (saldo de "Clientes") si no se puede calcular."""
+    try:
+        balance = get_balance_book(gsheet_client, spreadsheet_id, sheet_tab_name).balance(client_alias, journal.pending_rows(client_alias))
     except Exception as e:
-        st.warning(f"Hubo un error al actualizar el saldo del cliente: {e}")
-        return False
+        st.warning(f"No se pudo calcular el saldo desde el libro de operaciones; se muestra el de la hoja Clientes: {e}")
+        return fallback
+    return fallback if balance is None else balance
+
+# --- DIARIO LOCAL Y SINCRONIZACIÓN EN SEGUNDO PLANO ---
+JOURNAL_PATH = "diario_guardado.sqlite3"
+# Intentos de subida de un comprobante antes de registrar su fila sin link
+JOURNAL_UPLOAD_ATTEMPTS = 3
+
+@st.cache_resource
+def get_save_journal():
+    # Un diario y un hilo de sincronización por proceso, compartidos por todas las sesiones
+    journal = SaveJournal(JOURNAL_PATH)
+    worker = JournalWorker(journal, idle_interval_seconds=BALANCE_VERIFY_SECONDS)
+    worker.start()
+    return journal, worker
+
+# Columna del comprobante en el libro (H) y texto que ocupa la celda mientras se crea el link
+RECEIPT_COLUMN_INDEX = 7
+PENDING_LINK_PREFIX = "⏳ link pendiente "
+
+def backfill_receipt_links(gsheet_client, spreadsheet_id, sheet_tab_name, links):
+    """Sustituye en un solo batchUpdate los marcadores de link pendiente (`links` es folio -> link, "" para vaciar)."""
+    spreadsheet, _ = open_spreadsheet(gsheet_client, spreadsheet_id)
+    ledger = get_worksheet(gsheet_client, spreadsheet_id, sheet_tab_name)
+    column = {"sheetId": ledger.id, "startColumnIndex": RECEIPT_COLUMN_INDEX, "endColumnIndex": RECEIPT_COLUMN_INDEX + 1}
+    requests = [{"findReplace": {"find": f"{PENDING_LINK_PREFIX}{folio}", "replacement": link, "matchEntireCell": True, "range": column}} for folio, link in links.items()]
+    with metricas.span("sheets.links"):
+        cuota_sheets.write(spreadsheet.batch_update, {"requests": requests})
+
+# Llamadas simultáneas por servicio dentro de un guardado (etapas de pipeline_guardado)
+SAVE_STAGE_LIMITS = {"dropbox": MAX_UPLOAD_WORKERS, "sheets": 2}
+
+def flush_journal_batch(gsheet_client, dbx_client, spreadsheet_id, sheet_tab_name, journal, batch):
+    """Sincroniza un lote del diario con Dropbox y Google Sheets.
+
+    El guardado es un grafo de etapas: cada comprobante se sube y obtiene su link en su
+    propia cadena mientras la verificación de folios y el saldo se leen en paralelo y las
+    filas se escriben sin esperar a Dropbox (con un marcador en la celda del link); los
+    links se rellenan al final en una sola escritura. Tarda lo que la cadena más lenta.
+    Se puede repetir sin duplicar: rutas y links quedan en el diario y, en un reintento,
+    se omiten los folios que ya estén en el libro de operaciones. Regresa una nota para
+    el estado del lote o lanza la excepción para reintentar.
+    """
+    with metricas.trace("sincronizacion", lote=batch["id"], cliente=batch["client_alias"], operaciones=len(batch["operations"]), intento=batch["attempts"] + 1):
+        if batch["attempts"]:
+            metricas.count("diario.reintentos")
+        operations = batch["operations"]
+        last_attempt = batch["attempts"] + 1 >= JOURNAL_UPLOAD_ATTEMPTS
+        # Comprobantes por contenido: el mismo archivo se sube una sola vez y se reutiliza su link
+        pending = [op for op in operations if op["file_name"] and not op["link"] and op["file_bytes"] is not None]
+        # Un link solo se reutiliza dentro de la misma cuenta de Dropbox
+        scope = f"{batch['account']}/" if batch.get("account") else ""
+        digests = {op["folio"]: scope + hashlib.sha256(op["file_bytes"]).hexdigest() for op in pending}
+        known = journal.find_receipts(set(digests.values()))
+        content_paths, first_folio = {}, {}
+        for op in pending:
+            first_folio.setdefault(digests[op["folio"]], op["folio"])
+            if op["path"]: content_paths.setdefault(digests[op["folio"]], op["path"])
+        by_folio = {op["folio"]: op for op in operations}
+        uploads = {digest: StoredReceipt(by_folio[folio]["file_name"], by_folio[folio]["file_bytes"]) for digest, folio in first_folio.items() if digest not in known and digest not in content_paths}
+        # Las filas no esperan a Dropbox: todo comprobante por subir o sin link lleva el marcador
+        to_link = {digest for digest in first_folio if digest not in known and (digest in content_paths or digest in uploads)}
+        rows = []
+        for op in operations:
+            row, digest = op["row"], digests.get(op["folio"])
+            row[RECEIPT_COLUMN_INDEX] = op["link"] or known.get(digest) or (f"{PENDING_LINK_PREFIX}{op['folio']}" if digest in to_link else "")
+            rows.append(row)
+
+        upload_errors, link_errors = {}, {}
+
+        def uploaded(paths, errors):
+            # Antes del último intento una subida fallida cancela el guardado para reintentarlo completo
+            if errors and not last_attempt:
+                digest, error = next(iter(errors.items()))
+                raise RuntimeError(f"No se pudo subir el comprobante del folio {first_folio[digest]}: {error}") from error
+            upload_errors.update(errors)
+            for digest, path in paths.items():
+                content_paths[digest] = path
+                for folio in digests:
+                    if digests[folio] == digest and not by_folio[folio]["path"]: journal.set_path(folio, path)
+            return paths
+
+        def upload_one(digest):
+            try:
+                path = _upload_file(dbx_client, uploads[digest], batch["client_alias"], first_folio[digest])
+            except Exception as e:
+                return uploaded({}, {digest: e})
+            return uploaded({digest: path}, {})
+
+        def upload_sessions(group):
+            # Dos o más archivos grandes se confirman juntos con finish_batch
+            paths, errors = upload_files_concurrently(dbx_client, {first_folio[digest]: uploads[digest] for digest in group}, batch["client_alias"])
+            return uploaded({digests[folio]: path for folio, path in paths.items() if path}, {digests[folio]: error for folio, error in errors.items()})
+
+        def link_one(digest, paths=None):
+            path = content_paths.get(digest) if paths is None else paths.get(digest)
+            if not path: return ""
+            try:
+                return _shared_link(dbx_client, path)
+            except Exception as e:
+                link_errors[digest] = e
+                return ""
+
+        def verify_written():
+            # Un intento anterior pudo escribir el lote aunque su respuesta se perdiera
+            return set(cuota_sheets.read(get_worksheet(gsheet_client, spreadsheet_id, sheet_tab_name).col_values, 1))
+
+        def ledger_balance():
+            # El saldo se recalcula desde el libro justo antes de escribir: otra caja pudo registrar al mismo cliente.
+            # Las filas que ya estén en el libro no se cuentan dos veces, así que no espera a la verificación
+            return get_balance_book(gsheet_client, spreadsheet_id, sheet_tab_name).balance(batch["client_alias"], rows, force=True)
+
+        def write_ledger(new_usdt, written=()):
+            pending_rows = [row for row in rows if row[0] not in written]
+            if new_usdt is None:
+                new_usdt = batch["new_usdt"]
+            elif abs(new_usdt - batch["new_usdt"]) >= 0.005:
+                metricas.count("saldos.recalculados")
+            balance_updated = save_operations_batch(gsheet_client, spreadsheet_id, sheet_tab_name, pending_rows, batch["client_alias"], new_usdt)
+            # El lote sale de pending_rows al sincronizarse: el saldo en pantalla debe incluirlo desde ya
+            get_balance_book(gsheet_client, spreadsheet_id, sheet_tab_name).record_written(pending_rows)
+            return balance_updated
+
+        sessions = {digest for digest, file_object in uploads.items() if _is_large(file_object)}
+        if len(sessions) < 2: sessions = set()
+        stages = [pipeline_guardado.Stage("saldo_desde_libro", ledger_balance, group="sheets")]
+        if batch["attempts"] > 0:
+            stages.append(pipeline_guardado.Stage("verificacion_folios", verify_written, group="sheets"))
+        stages.append(pipeline_guardado.Stage("libro_y_saldo", write_ledger, after=[stage.name for stage in stages]))
+        if sessions:
+            # upload_files_concurrently ya limita sus hilos; la etapa no ocupa lugares del grupo
+            stages.append(pipeline_guardado.Stage("subidas:sesiones", partial(upload_sessions, sessions), span="subidas"))
+        for digest in uploads.keys() - sessions:
+            stages.append(pipeline_guardado.Stage(f"subida:{digest}", partial(upload_one, digest), group="dropbox", span="subidas"))
+        for digest in to_link:
+            after = [] if digest not in uploads else ["subidas:sesiones"] if digest in sessions else [f"subida:{digest}"]
+            stages.append(pipeline_guardado.Stage(f"link:{digest}", partial(link_one, digest), after=after, group="dropbox", span="links"))
+        results = pipeline_guardado.run_stages(stages, SAVE_STAGE_LIMITS)
+        balance_updated = results["libro_y_saldo"]
+        content_links = {digest: results[f"link:{digest}"] for digest in to_link}
+
+        errors = {folio: upload_errors[digest] for folio, digest in digests.items() if digest in upload_errors}
+        reused = sum(1 for folio, digest in digests.items() if digest in known or (digest in content_paths and not (digest in uploads and folio == first_folio[digest])))
+        if reused: metricas.count("subidas.reutilizadas", reused)
+        backfill = {}
+        for digest, link in content_links.items():
+            if link: journal.remember_receipt(digest, link, by_folio[first_folio[digest]]["file_name"], first_folio[digest])
+        for folio, digest in digests.items():
+            link = known.get(digest) or content_links.get(digest, "")
+            if link: journal.set_link(folio, link)
+            # En el último intento los links que fallaron (o sin subida) se vacían; antes se dejan para el reintento
+            if digest in to_link and (link or last_attempt): backfill[folio] = link
+        if backfill:
+            backfill_receipt_links(gsheet_client, spreadsheet_id, sheet_tab_name, backfill)
+        if link_errors and not last_attempt:
+            digest, error = next(iter(link_errors.items()))
+            raise RuntimeError(f"No se pudo crear el link del folio {first_folio[digest]}: {error}") from error
+        errors.update({folio: link_errors[digest] for folio, digest in digests.items() if digest in link_errors})
+        notes = [f"sin comprobante: {', '.join(errors)}"] if errors else []
+        if errors: metricas.count("subidas.sin_comprobante", len(errors))
+        if not balance_updated:
+            notes.append(f"no se encontró al cliente '{batch['client_alias']}' para actualizar su saldo")
+        return "; ".join(notes)
+
+def flush_account_batch(health, sheets_key, gsheet_client, spreadsheet_id, sheet_tab_name, journal, batch):
+    """Sincroniza un lote con la cuenta de Dropbox con la que se guardó (ver get_dropbox_accounts)."""
+    dbx_client = get_dropbox_accounts().get(batch["account"])
+    if dbx_client is None:
+        raise RuntimeError("La cuenta de Dropbox de este lote ya no está conectada")
+    keys = {"dropbox": batch["account"], "sheets": sheets_key}
+    return flush_with_revalidation(health, keys, partial(flush_journal_batch, gsheet_client, dbx_client, spreadsheet_id, sheet_tab_name, journal), batch)
 
-def get_next_folio_number(_gsheet_client, spreadsheet_id, sheet_tab_name):
+def _sync_status_label(entry):
+    if entry["estado"] == STATUS_SYNCED:
+        return f"✅ Sincronizado ({entry['ultimo_error']})" if entry["ultimo_error"] else "✅ Sincronizado"
+    if entry["estado"] == STATUS_FAILED:
+        return f"❌ Falló tras {entry['intentos']} intento(s): {entry['ultimo_error']}"
+    if entry["intentos"]:
+        return f"⚠️ Reintentando ({entry['intentos']}): {entry['ultimo_error']}"
+    return "⏳ Pendiente"
+
+def prepare_receipt(file_object, compress=True):
+    """(nombre, bytes) de un comprobante para el diario; las imágenes se comprimen si `compress`."""
+    data = buffer_comprobantes.receipt_data(file_object)
+    if not compress:
+        return file_object.name, data
+    with metricas.span("comprobantes.compresion"):
+        file_name, compressed = comprobantes.compress_receipt(file_object.name, data)
+    metricas.count("comprobantes.bytes_originales", len(data))
+    metricas.count("comprobantes.bytes_subidos", len(compressed))
+    return file_name, compressed
+
+def register_operations(gsheet_client, spreadsheet_id, sheet_tab_name, journal, journal_worker, client_alias, new_usdt, operations, compress_receipts=True, dropbox_account=""):
+    """Asigna folios a un lote y lo confirma en el diario local; regresa las filas registradas.
+
+    Cada operación es un dict con type, usd, usdt, comision y file (comprobante opcional).
+    `dropbox_account` es la llave de la cuenta a la que se suben sus comprobantes.
+    Captura manual e importación masiva usan el mismo camino: folios del bloque ya
+    reservado del proceso (FolioBlock) y un solo lote, sin llamadas a Sheets por fila.
+    """
+    now_mexico = datetime.now(MEXICO_TZ)
+    timestamp, today_prefix = now_mexico.strftime("%Y-%m-%d %H:%M:%S"), now_mexico.strftime("%y-%m-%d")
+    with metricas.span("folio"):
+        folio_numbers = get_folio_block(gsheet_client, spreadsheet_id, sheet_tab_name).take(len(operations), today_prefix)
+    rows, receipts = [], {}
+    for op, folio_number in zip(operations, folio_numbers):
+        folio = f"{today_prefix}-{folio_number:04d}"
+        rows.append([folio, timestamp, client_alias, OPERATION_LABELS[op['type']], op['usd'], op['usdt'], op['comision'], ""])
+        if op.get('file'): receipts[folio] = prepare_receipt(op['file'], compress_receipts)
+    # El lote queda confirmado en el diario local; Dropbox y Sheets se sincronizan en segundo plano
+    with metricas.span("diario"):
+        journal.enqueue(client_alias, new_usdt, rows, receipts, account=dropbox_account)
+    journal_worker.notify()
+    patch_client_balance(gsheet_client, spreadsheet_id, client_alias, new_usdt)
+    return rows
+
+# --- FUNCIONES DE LA INTERFAZ ---
+
+def compute_calculation_rows(row_indices, comision_compra, comision_venta, mode_compra, mode_venta):
+    # Las filas pedidas en una sola pasada del motor, con los montos ya capturados en session_state
+    input_compra = [st.session_state.get(f"input_compra_{i}", 0.0) for i in row_indices]
+    input_venta = [st.session_state.get(f"input_venta_{i}", 0.0) for i in row_indices]
+    usd_compra, usdt_compra = motor_conversion.convert_batch(input_compra, mode_compra, comision_compra)
+    usd_venta, usdt_venta = motor_conversion.convert_batch(input_venta, mode_venta, comision_venta)
+    usd_compra, usdt_compra = motor_conversion.from_cents(usd_compra), motor_conversion.from_cents(usdt_compra)
+    usd_venta, usdt_venta = motor_conversion.from_cents(usd_venta), motor_conversion.from_cents(usdt_venta)
+    return [{
+        "usd_dados_compra": float(usd_compra[i]), "usdt_recibidos_compra": float(usdt_compra[i]),
+        "usd_recibidos_venta": float(usd_venta[i]), "usdt_dados_venta": float(usdt_venta[i]),
+    } for i in range(len(row_indices))]
+
+# --- COMPROBANTES DE LA SESIÓN ---
+# El archivo de cada uploader pasa al buffer de la sesión (buffer_comprobantes)
+# y el uploader se sustituye por un botón para quitarlo; Streamlit suelta su
+# copia, que de otro modo guardaría hasta el fin de la sesión, incluso la de
+# uploaders que ya no existen tras un reinicio. Al limpiar se borran las llaves
+# y los comprobantes de iteraciones anteriores.
+_UPLOADER_KEY = re.compile(r"uploader_(?:compra|venta|pago|recibo)_\d+_(\d+)")
+RECEIPT_TYPES = ["png", "jpg", "jpeg", "pdf"]
+
+def get_receipt_buffer():
+    if "receipt_buffer" not in st.session_state:
+        st.session_state.receipt_buffer = buffer_comprobantes.ReceiptBuffer()
+    return st.session_state.receipt_buffer
+
+def _release_uploaded_file(uploaded_file):
+    # API interna de Streamlit; si cambia, el archivo se queda en memoria hasta que termine la sesión
     try:
-        spreadsheet = _gsheet_client.open_by_key(spreadsheet_id)
-        worksheet = spreadsheet.worksheet(sheet_tab_name)
-        all_values = worksheet.get_all_values()
-        if len(all_values) < 2: return 1
-        last_row = all_values[-1]
-        last_folio = last_row[0]
-        parts = last_folio.split('-')
-        last_folio_date_str = f"{parts[0]}-{parts[1]}-{parts[2]}"
-        last_folio_num = int(parts[3])
-        today_date_str = datetime.now(pytz.timezone("America/Mexico_City")).strftime("%y-%m-%d")
-        if last_folio_date_str == today_date_str:
-            return last_folio_num + 1
-        else:
-            return 1
-    except (ValueError, IndexError, gspread.exceptions.WorksheetNotFound):
-        return 1
+        ctx = get_script_run_ctx()
+        ctx.uploaded_file_mgr.remove_file(ctx.session_id, uploaded_file.file_id)
     except Exception:
-        return 1
+        pass
 
-# --- FUNCIONES DE LA INTERFAZ ---
+def capture_receipt(key):
+    """on_change de un uploader: su archivo pasa al buffer de la sesión y Streamlit suelta el suyo."""
+    uploaded_file = st.session_state.get(key)
+    # Sin archivo: el que ya se capturó y se soltó (el uploader ya no se dibuja; se quita con su botón)
+    if uploaded_file is None: return
+    get_receipt_buffer().put(key, uploaded_file.name, uploaded_file.getvalue())
+    _release_uploaded_file(uploaded_file)
+
+def receipt_uploader(label, key):
+    receipt = get_receipt_buffer().get(key)
+    if receipt is None:
+        st.file_uploader(label, type=RECEIPT_TYPES, key=key, on_change=capture_receipt, args=(key,), label_visibility="collapsed")
+    else:
+        st.button(f"✕ {receipt.name}", key=f"quitar_{key}", on_click=get_receipt_buffer().discard, args=(key,), help=f"Quitar comprobante ({receipt.size / 1024:,.0f} KB)", use_container_width=True)
+
+def uploaded_receipt(key):
+    # El buffer tiene el comprobante; el valor del widget solo si no pasó por capture_receipt
+    return get_receipt_buffer().get(key) or st.session_state.get(key)
 
-def create_calculation_row(row_index, comision_compra, comision_venta, mode_compra, mode_venta):
+def purge_stale_uploaders():
+    """Borra los uploaders de iteraciones anteriores a upload_key_iter: su llave, su archivo en Streamlit y su comprobante."""
+    current = str(st.session_state.get("upload_key_iter", 0))
+    buffer = get_receipt_buffer()
+    stale = {key for key in list(st.session_state) + buffer.keys() if (match := _UPLOADER_KEY.fullmatch(str(key))) and match.group(1) != current}
+    for key in stale:
+        uploaded_file = st.session_state.get(key)
+        if uploaded_file is not None: _release_uploaded_file(uploaded_file)
+        if key in st.session_state: del st.session_state[key]
+        buffer.discard(key)
+
+def create_calculation_row(row_index, row_data, mode_compra, mode_venta):
     col_compra, _, col_venta = st.columns([1, 0.2, 1])
     
     key_iter = st.session_state.get('upload_key_iter', 0)
 
-    usd_compra_final, usdt_compra_final, input_compra = 0.0, 0.0, 0.0
-    usd_venta_final, usdt_venta_final, input_venta = 0.0, 0.0, 0.0
-
     with col_compra:
         if row_index == 0: st.subheader("Compra (Tú das USD)")
         
@@ -127,26 +1215,23 @@ def create_calculation_row(row_index, comision_compra, comision_venta, mode_comp
 
         with input_col:
             label_visibility = "visible" if row_index == 0 else "collapsed"
-            if mode_compra == "USD ➔ USDT":
+            if mode_compra == motor_conversion.MODE_USD_TO_USDT:
                 input_label = "Monto en USD que das"
-                input_compra = st.number_input(input_label, min_value=0.0, format="%.2f", step=100.0, key=f"input_compra_{row_index}", label_visibility=label_visibility)
+                st.number_input(input_label, min_value=0.0, format="%.2f", step=100.0, key=f"input_compra_{row_index}", label_visibility=label_visibility)
             else:
                 input_label = "Monto en USDT a recibir"
-                input_compra = st.number_input(input_label, min_value=0.0, format="%.2f", step=100.0, key=f"input_compra_{row_index}", label_visibility=label_visibility)
+                st.number_input(input_label, min_value=0.0, format="%.2f", step=100.0, key=f"input_compra_{row_index}", label_visibility=label_visibility)
         
-        if mode_compra == "USD ➔ USDT":
-            usd_compra_final, usdt_compra_final = input_compra, input_compra * (1 - comision_compra / 100)
-            resultado_texto = f"<p style='font-size: 28px; font-weight: bold; color: #228B22; margin: 0; padding-top: 15px;'>{usdt_compra_final:,.2f} USDT</p>"
+        if mode_compra == motor_conversion.MODE_USD_TO_USDT:
+            resultado_texto = f"<p style='font-size: 28px; font-weight: bold; color: #228B22; margin: 0; padding-top: 15px;'>{row_data['usdt_recibidos_compra']:,.2f} USDT</p>"
         else:
-            usdt_compra_final = input_compra
-            usd_compra_final = usdt_compra_final / (1 - comision_compra / 100) if comision_compra < 100 else 0
-            resultado_texto = f"<p style='font-size: 28px; font-weight: bold; color: #DC143C; margin: 0; padding-top: 15px;'>{usd_compra_final:,.2f} USD</p>"
+            resultado_texto = f"<p style='font-size: 28px; font-weight: bold; color: #DC143C; margin: 0; padding-top: 15px;'>{row_data['usd_dados_compra']:,.2f} USD</p>"
         
         with result_col:
             st.markdown(resultado_texto, unsafe_allow_html=True)
 
         with upload_col:
-            st.file_uploader("Comp.", type=["png", "jpg", "jpeg", "pdf"], key=f"uploader_compra_{row_index}_{key_iter}", label_visibility="collapsed")
+            receipt_uploader("Comp.", f"uploader_compra_{row_index}_{key_iter}")
 
     with col_venta:
         if row_index == 0: st.subheader("Venta (Tú recibes USD)")
@@ -155,31 +1240,25 @@ def create_calculation_row(row_index, comision_compra, comision_venta, mode_comp
         
         with input_col:
             label_visibility = "visible" if row_index == 0 else "collapsed"
-            if mode_venta == "USD ➔ USDT":
+            if mode_venta == motor_conversion.MODE_USD_TO_USDT:
                 input_label = "Monto en USD que recibes"
-                input_venta = st.number_input(input_label, min_value=0.0, format="%.2f", step=100.0, key=f"input_venta_{row_index}", label_visibility=label_visibility)
+                st.number_input(input_label, min_value=0.0, format="%.2f", step=100.0, key=f"input_venta_{row_index}", label_visibility=label_visibility)
             else:
                 input_label = "Monto en USDT a dar"
-                input_venta = st.number_input(input_label, min_value=0.0, format="%.2f", step=100.0, key=f"input_venta_{row_index}", label_visibility=label_visibility)
+                st.number_input(input_label, min_value=0.0, format="%.2f", step=100.0, key=f"input_venta_{row_index}", label_visibility=label_visibility)
 
-        if mode_venta == "USD ➔ USDT":
-            usd_venta_final, usdt_venta_final = input_venta, input_venta * (1 - comision_venta / 100)
-            resultado_texto = f"<p style='font-size: 28px; font-weight: bold; color: #DC143C; margin: 0; padding-top: 27px;'>{usdt_venta_final:,.2f} USDT</p>"
+        if mode_venta == motor_conversion.MODE_USD_TO_USDT:
+            resultado_texto = f"<p style='font-size: 28px; font-weight: bold; color: #DC143C; margin: 0; padding-top: 27px;'>{row_data['usdt_dados_venta']:,.2f} USDT</p>"
         else:
-            usdt_venta_final = input_venta
-            usd_venta_final = usdt_venta_final / (1 - comision_venta / 100) if comision_venta < 100 else 0
-            resultado_texto = f"<p style='font-size: 28px; font-weight: bold; color: #228B22; margin: 0; padding-top: 27px;'>{usd_venta_final:,.2f} USD</p>"
+            resultado_texto = f"<p style='font-size: 28px; font-weight: bold; color: #228B22; margin: 0; padding-top: 27px;'>{row_data['usd_recibidos_venta']:,.2f} USD</p>"
 
         with result_col:
             st.markdown(resultado_texto, unsafe_allow_html=True)
             
         with upload_col:
-            st.file_uploader("Comp.", type=["png", "jpg", "jpeg", "pdf"], key=f"uploader_venta_{row_index}_{key_iter}", label_visibility="collapsed")
+            receipt_uploader("Comp.", f"uploader_venta_{row_index}_{key_iter}")
         
-    return {
-        "usd_dados_compra": usd_compra_final, "usdt_recibidos_compra": usdt_compra_final,
-        "usd_recibidos_venta": usd_venta_final, "usdt_dados_venta": usdt_venta_final,
-    }
+    return row_data
 
 def create_ajuste_row(row_index):
     col_pago, _, col_recibo = st.columns([1, 0.2, 1])
@@ -191,7 +1270,7 @@ def create_ajuste_row(row_index):
         with input_col:
             pago_monto = st.number_input("Monto del Pago", min_value=0.0, format="%.2f", key=f"pago_monto_{row_index}", label_visibility="visible" if row_index == 0 else "collapsed")
         with upload_col:
-            st.file_uploader("Comp. Pago", type=["png", "jpg", "jpeg", "pdf"], key=f"uploader_pago_{row_index}_{key_iter}", label_visibility="collapsed")
+            receipt_uploader("Comp. Pago", f"uploader_pago_{row_index}_{key_iter}")
 
     with col_recibo:
         if row_index == 0: st.subheader("Recibos (Entradas)")
@@ -199,10 +1278,162 @@ def create_ajuste_row(row_index):
         with input_col:
             recibo_monto = st.number_input("Monto del Recibo", min_value=0.0, format="%.2f", key=f"recibo_monto_{row_index}", label_visibility="visible" if row_index == 0 else "collapsed")
         with upload_col:
-            st.file_uploader("Comp. Recibo", type=["png", "jpg", "jpeg", "pdf"], key=f"uploader_recibo_{row_index}_{key_iter}", label_visibility="collapsed")
+            receipt_uploader("Comp. Recibo", f"uploader_recibo_{row_index}_{key_iter}")
             
     return {"pago_usdt": pago_monto, "recibo_usdt": recibo_monto}
 
+# --- FILAS COMO FRAGMENTOS ---
+# Cada fila es un st.fragment: editar un monto solo vuelve a ejecutar esa fila y
+# redibuja los totales, que se calculan desde un almacén en session_state con el
+# último resultado de cada fila. Durante una ejecución completa de la página los
+# totales se dibujan una sola vez, al final.
+
+def _calc_store():
+    if 'calc_store' not in st.session_state:
+        st.session_state.calc_store = {"rows": {}, "ajustes": {}}
+    return st.session_state.calc_store
+
+def _is_fragment_rerun():
+    return not st.session_state.get('_calc_full_run', False)
+
+def render_totals(totals_slot, balance_inicial_usdt):
+    store = _calc_store()
+    all_rows_data = [store["rows"][i] for i in range(st.session_state.get('num_rows', 1)) if i in store["rows"]]
+    all_ajustes_data = [store["ajustes"][i] for i in range(st.session_state.get('num_ajustes', 1)) if i in store["ajustes"]]
+    totales = motor_conversion.closing_totals(
+        motor_conversion.to_cents([d['usdt_recibidos_compra'] for d in all_rows_data]),
+        motor_conversion.to_cents([d['usdt_dados_venta'] for d in all_rows_data]),
+        [d['pago_usdt'] for d in all_ajustes_data], [d['recibo_usdt'] for d in all_ajustes_data], balance_inicial_usdt)
+    with totals_slot.container():
+        st.subheader("Totales Consolidados 🧮")
+        col_t1, col_t2 = st.columns(2)
+        with col_t1: st.metric("TOTAL USDT RECIBIDOS (Op. + Ajustes)", f"{totales['total_usdt_recibidos']:,.2f} USDT")
+        with col_t2: st.metric("TOTAL USDT ENTREGADOS (Op. + Ajustes)", f"{totales['total_usdt_entregados']:,.2f} USDT")
+        st.subheader("Balance Final de Cierre del Cliente ⚖️")
+        cambio_neto_usdt, balance_final_usdt = totales['cambio_neto_usdt'], totales['balance_final_usdt']
+        st.metric("Nuevo Saldo USDT del Cliente", f"{balance_final_usdt:,.2f}", delta=f"{cambio_neto_usdt:,.2f} USDT")
+        if balance_final_usdt > 0.01: status_texto, status_color = "EL CLIENTE TE DEBE", "#228B22"
+        elif balance_final_usdt < -0.01: status_texto, status_color = "TÚ LE DEBES AL CLIENTE", "#DC143C"
+        else: status_texto, status_color = "SALDO CERO", "gray"
+        st.markdown(f"<h3 style='text-align: center; color: {status_color};'>{status_texto}</h3>", unsafe_allow_html=True)
+    return totales
+
+@st.fragment
+def calculation_row_fragment(row_index, comision_compra, comision_venta, mode_compra, mode_venta, totals_slot, balance_inicial_usdt):
+    store = _calc_store()
+    fragment_rerun = _is_fragment_rerun()
+    if fragment_rerun or row_index not in store["rows"]:
+        store["rows"][row_index] = compute_calculation_rows([row_index], comision_compra, comision_venta, mode_compra, mode_venta)[0]
+    create_calculation_row(row_index, store["rows"][row_index], mode_compra, mode_venta)
+    if fragment_rerun: render_totals(totals_slot, balance_inicial_usdt)
+
+@st.fragment
+def ajuste_row_fragment(row_index, totals_slot, balance_inicial_usdt):
+    _calc_store()["ajustes"][row_index] = create_ajuste_row(row_index)
+    if _is_fragment_rerun(): render_totals(totals_slot, balance_inicial_usdt)
+
+# --- IMPORTACIÓN MASIVA ---
+@st.cache_data(show_spinner=False, max_entries=8)
+def parse_import_file(data, file_name, comision_compra, comision_venta, mode_compra, mode_venta):
+    # Se recalcula solo si cambia el archivo o la configuración de la sección 1
+    raw = importacion.read_operations_file(data, file_name)
+    return importacion.build_import_batch(raw, comision_compra, comision_venta, mode_compra, mode_venta)
+
+def import_operations(import_df):
+    """Operaciones de un lote importado en el formato de register_operations (sin comprobantes)."""
+    operations = []
+    for op in import_df.itertuples(index=False):
+        if op.tipo in ("Compra", "Venta"):
+            operations.append({'type': op.tipo, 'usd': float(op.usd), 'usdt': float(op.usdt), 'comision': float(op.comision)})
+        else:
+            operations.append({'type': op.tipo, 'usd': "", 'usdt': float(op.usdt), 'comision': "N/A"})
+    return operations
+
+# Guardados que se muestran en el panel de métricas
+METRICS_PANEL_SAVES = 10
+
+def render_client_history(gsheet_client, spreadsheet_id, sheet_tab_name, client_alias):
+    # Consulta el espejo local; la hoja solo se toca para traer las filas nuevas
+    try:
+        mirror = sync_ledger_mirror(gsheet_client, spreadsheet_id, sheet_tab_name, max_age_seconds=CLIENT_REFRESH_SECONDS)
+    except Exception as e:
+        st.warning(f"No se pudo actualizar el historial desde Google Sheets; se muestra la última copia local: {e}")
+        mirror = get_ledger_mirror()
+    today = datetime.now(MEXICO_TZ).date()
+    col_fechas, col_tipos = st.columns(2)
+    date_range = col_fechas.date_input("Fechas", (today - pd.Timedelta(days=30), today), key="history_dates")
+    types = col_tipos.multiselect("Tipos", list(OPERATION_LABELS.values()), key="history_types")
+    start, end = (date_range[0], date_range[-1]) if isinstance(date_range, (list, tuple)) and date_range else (None, None)
+    started = time.perf_counter()
+    history = mirror.query(client=client_alias, start=start, end=end and end + pd.Timedelta(days=1), types=types, columns=["folio", "fecha", "tipo", "usd", "usdt", "comision", "comprobante"])
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    st.dataframe(history, hide_index=True)
+    st.caption(f"{len(history)} operación(es) · USDT neto: {(history['usdt'] * history['tipo'].map(BALANCE_SIGNS).fillna(0)).sum():,.2f} · consulta local en {elapsed_ms:.0f} ms")
+
+def render_closing_report(gsheet_client, spreadsheet_id, sheet_tab_name, pending_batches):
+    try:
+        mirror = sync_ledger_mirror(gsheet_client, spreadsheet_id, sheet_tab_name, max_age_seconds=CLIENT_REFRESH_SECONDS)
+    except Exception as e:
+        st.warning(f"No se pudo actualizar el libro desde Google Sheets; el cierre usa la última copia local: {e}")
+        mirror = get_ledger_mirror()
+    today = datetime.now(MEXICO_TZ).date()
+    closing_day = st.date_input("Día", today, key="closing_day")
+    started = time.perf_counter()
+    by_client, by_day = cierre_diario.closing_report(cierre_diario.load_days(mirror, closing_day))
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if by_day.empty:
+        st.info("No hay operaciones registradas en el libro para ese día.")
+        return
+    day_totals = by_day.iloc[0]
+    ccol1, ccol2, ccol3, ccol4 = st.columns(4)
+    ccol1.metric("USD entregados / recibidos", f"{day_totals['usd_entregados']:,.2f} / {day_totals['usd_recibidos']:,.2f}")
+    ccol2.metric("USDT recibidos / entregados", f"{day_totals['usdt_compras']:,.2f} / {day_totals['usdt_ventas']:,.2f}")
+    ccol3.metric("Comisión ganada (USDT)", f"{day_totals['comision_ganada']:,.2f}", f"{day_totals['comision_efectiva_pct']:.2f} % efectiva", delta_color="off")
+    ccol4.metric("Ajustes pagos / recibos", f"{day_totals['ajustes_pago']:,.2f} / {day_totals['ajustes_recibo']:,.2f}")
+    st.dataframe(by_client.rename(columns=cierre_diario.COLUMN_NAMES), hide_index=True, use_container_width=True)
+    dcol1, dcol2 = st.columns(2)
+    dcol1.download_button("⬇️ Descargar CSV", cierre_diario.export_report(by_client, by_day, "csv"), f"cierre_{closing_day}.csv", "text/csv")
+    dcol2.download_button("⬇️ Descargar Excel", cierre_diario.export_report(by_client, by_day, "xlsx"), f"cierre_{closing_day}.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    notes = [f"{int(day_totals['operaciones'])} operación(es) calculadas en {elapsed_ms:.0f} ms"]
+    if pending_batches: notes.append(f"{pending_batches} lote(s) aún sin sincronizar no están incluidos")
+    st.caption(" · ".join(notes))
+
+def render_balance_discrepancies(book):
+    # La verificación en segundo plano solo señala; "Clientes" se corrige cuando alguien lo confirma
+    discrepancies = dict(book.discrepancies)
+    if not discrepancies: return
+    with st.expander(f"⚠️ {len(discrepancies)} saldo(s) en Clientes no cuadran con el libro de operaciones"):
+        st.dataframe(pd.DataFrame([{"Cliente": alias, "Saldo en Clientes": listed, "Saldo según el libro": derived, "Diferencia": round(derived - listed, 2)} for alias, (listed, derived) in sorted(discrepancies.items())]), hide_index=True, use_container_width=True)
+        st.caption("Un saldo editado a mano en la hoja aparece aquí; corrige solo si el libro de operaciones es el correcto.")
+        if st.button("✍️ Corregir en Clientes con el saldo del libro", key="corregir_saldos"):
+            corrected = book.apply_corrections(list(discrepancies))
+            st.success(f"Se corrigieron {len(corrected)} saldo(s).")
+
+def render_metrics_panel():
+    st.sidebar.header("📊 Métricas de guardado")
+    usage = cuota_sheets.usage()
+    counters = metricas.totals()
+    st.sidebar.caption(
+        f"Sheets en el último minuto (este proceso usa {cuota_sheets.scheduler.share:.0%} de la cuota): {usage[cuota_sheets.READ][0]}/{usage[cuota_sheets.READ][1]} lecturas · {usage[cuota_sheets.WRITE][0]}/{usage[cuota_sheets.WRITE][1]} escrituras · "
+        f"429: {counters.get('sheets.cuota_excedida', 0)} · reintentos: {counters.get('sheets.reintentos', 0)} · esperas por cuota: {counters.get('sheets.esperas_cuota', 0)}"
+    )
+    records = metricas.read_recent(METRICS_PANEL_SAVES)
+    if not records:
+        st.sidebar.caption("Aún no hay guardados registrados.")
+        return
+    # Solo los pasos del flujo (sin punto) en la gráfica; la tabla incluye también las llamadas externas
+    labels = [f"{i}. {record['tipo']} {record['inicio'][11:]}" for i, record in enumerate(records, start=1)]
+    stages_df = pd.DataFrame([{stage: ms for stage, ms in record['etapas'].items() if '.' not in stage} for record in records], index=labels).fillna(0)
+    st.sidebar.bar_chart(stages_df)
+    detail_df = pd.DataFrame([{"Total ms": record['total_ms'], "OK": "✅" if record['ok'] else "❌", **record['etapas']} for record in records], index=labels).fillna(0)
+    st.sidebar.dataframe(detail_df)
+    original_bytes = sum(record['contadores'].get("comprobantes.bytes_originales", 0) for record in records)
+    if original_bytes:
+        uploaded_bytes = sum(record['contadores'].get("comprobantes.bytes_subidos", 0) for record in records)
+        st.sidebar.caption(f"Comprobantes: {original_bytes / 1e6:,.1f} MB ➔ {uploaded_bytes / 1e6:,.1f} MB ({1 - uploaded_bytes / original_bytes:.0%} menos por subir)")
+    if counters:
+        st.sidebar.caption(" · ".join(f"{name}: {value}" for name, value in sorted(counters.items())))
+
 def main():
     st.set_page_config(page_title="Calculadora USD/USDT", page_icon="🏦", layout="wide")
     
@@ -219,6 +1450,8 @@ def main():
         except (FileNotFoundError, KeyError):
             pass
 
+    compress_receipts = st.sidebar.checkbox("🗜️ Comprimir imágenes de comprobantes", value=True, help=f"Reduce fotos a {comprobantes.RECEIPT_MAX_DIMENSION}px y las recodifica sin EXIF antes de subirlas. Los PDF no se modifican.")
+
     st.markdown("""
     <style>
         [data-testid="stFileUploader"] section [data-testid="stFileUploaderDropzone"] {display: none;}
@@ -237,14 +1470,38 @@ def main():
 
     gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME = connect_to_google_sheets()
     
-    # Conexión usando el token determinado
+    # Conexión usando el token determinado; la validación de red solo se repite al vencer su TTL o tras un error de autenticación
+    health = get_connection_health()
+    connection_keys = {"dropbox": salud_conexiones.credential_key("dropbox", final_token), "sheets": sheets_credential_key(gsheet_client, SPREADSHEET_ID)}
     try:
         dbx_client = connect_to_dropbox(final_token)
-        # Verificación simple de conexión
-        dbx_client.users_get_current_account()
+        health.ensure(connection_keys["dropbox"], dbx_client.users_get_current_account)
     except Exception:
         st.error("❌ El token de Dropbox es inválido. Por favor revísalo en la barra lateral.")
         st.stop()
+    try:
+        health.ensure(connection_keys["sheets"], partial(check_sheets_access, gsheet_client, SPREADSHEET_ID))
+    except Exception as e:
+        st.error(f"❌ No se pudo conectar con Google Sheets: {e}")
+        st.stop()
+
+    # Cada lote guarda la llave de su cuenta de Dropbox; el hilo de sincronización solo toma
+    # lotes de cuentas conectadas y nunca sube comprobantes con el token de otra sesión
+    dropbox_accounts = get_dropbox_accounts()
+    new_account = connection_keys["dropbox"] not in dropbox_accounts
+    dropbox_accounts[connection_keys["dropbox"]] = dbx_client
+    # Los lotes de antes de que el diario recordara su cuenta solo se suben con el token del servidor
+    if not manual_token: dropbox_accounts[""] = dbx_client
+    journal, journal_worker = get_save_journal()
+    journal_worker.configure(
+        partial(flush_account_batch, health, connection_keys["sheets"], gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME, journal),
+        idle_fn=partial(run_idle_maintenance, gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME),
+        accounts=dropbox_accounts,
+    )
+    # Una cuenta que se (re)conecta puede tener lotes esperando
+    if new_account: journal_worker.notify()
+    # Los folios del primer guardado se reservan desde ahora, no al guardar
+    get_folio_block(gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME).prefetch(datetime.now(MEXICO_TZ).strftime("%y-%m-%d"))
 
     # Se inicializa un iterador de clave para el reseteo de los uploaders
     if 'upload_key_iter' not in st.session_state:
@@ -260,7 +1517,8 @@ def main():
             if f"input_venta_{i}" in st.session_state:
                 st.session_state[f"input_venta_{i}"] = 0.0
         st.session_state.num_rows = 1
-        st.session_state.upload_key_iter += 1 
+        st.session_state.upload_key_iter += 1
+        purge_stale_uploaders()
     
     def limpiar_ajustes_callback():
         for i in range(st.session_state.get('num_ajustes', 1)):
@@ -269,7 +1527,8 @@ def main():
             if f"recibo_monto_{i}" in st.session_state:
                 st.session_state[f"recibo_monto_{i}"] = 0.0
         st.session_state.num_ajustes = 1
-        st.session_state.upload_key_iter += 1 
+        st.session_state.upload_key_iter += 1
+        purge_stale_uploaders()
 
     def limpiar_todo_callback():
         limpiar_calculos_callback()
@@ -277,7 +1536,9 @@ def main():
         st.session_state.num_rows = 1
         st.session_state.num_ajustes = 1
         if "cliente_selector" in st.session_state: st.session_state.cliente_selector = "-- Seleccione un Cliente --"
-        st.session_state.upload_key_iter += 1 
+        if "cliente_busqueda" in st.session_state: st.session_state.cliente_busqueda = ""
+        st.session_state.upload_key_iter += 1
+        purge_stale_uploaders()
 
     # --- SECCIÓN 1: CONFIGURACIÓN ---
     st.header("1. Configuración de Operación")
@@ -287,21 +1548,30 @@ def main():
         client_df = get_client_data(gsheet_client, SPREADSHEET_ID)
         balance_inicial_usdt, selected_client_name = 0.0, ""
         if not client_df.empty:
-            client_list = ["-- Seleccione un Cliente --"] + client_df['Alias Cliente'].tolist()
-            selected_client_name = st.selectbox("Cliente", client_list, key="cliente_selector")
-            if selected_client_name != "-- Seleccione un Cliente --":
-                client_data = client_df[client_df['Alias Cliente'] == selected_client_name].iloc[0]
-                balance_inicial_usdt = float(client_data['Saldo USDT'])
+            client_search = get_client_index(gsheet_client, SPREADSHEET_ID).search
+            search_text = st.text_input("Buscar cliente", key="cliente_busqueda", placeholder="Alias o parte del nombre, sin importar acentos")
+            matches = client_search.search(search_text, CLIENT_SELECTOR_RESULTS)
+            # El cliente ya elegido se conserva aunque la búsqueda nueva no lo incluya
+            current = st.session_state.get("cliente_selector")
+            pinned = [current] if current and current != "-- Seleccione un Cliente --" and current not in matches else []
+            selected_client_name = st.selectbox("Cliente", ["-- Seleccione un Cliente --"] + pinned + matches, key="cliente_selector")
+            if len(client_search) > len(matches) and not search_text:
+                st.caption(f"Mostrando {len(matches)} de {len(client_search):,} clientes; escribe para buscar.")
+            client_data = find_client(gsheet_client, SPREADSHEET_ID, selected_client_name) if selected_client_name != "-- Seleccione un Cliente --" else None
+            if client_data is not None:
+                balance_inicial_usdt = get_client_balance(gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME, journal, selected_client_name, float(client_data['Saldo USDT']))
                 st.metric("Saldo Actual USDT", f"{balance_inicial_usdt:,.2f}")
                 st.caption("Positivo = cliente te debe. Negativo = tú le debes.")
     with col_compra:
         st.subheader("Config. Compra (Tú das USD)")
         comision_compra = st.number_input("Comisión de Compra (%)", value=3.50, min_value=0.0, format="%.2f", step=0.5, key="comision_compra_input")
-        mode_compra = st.radio("Modo de Cálculo", ("USD ➔ USDT", "USDT ➔ USD"), horizontal=True, key="mode_compra")
+        mode_compra = st.radio("Modo de Cálculo", (motor_conversion.MODE_USD_TO_USDT, motor_conversion.MODE_USDT_TO_USD), horizontal=True, key="mode_compra")
     with col_venta:
         st.subheader("Config. Venta (Tú recibes USD)")
         comision_venta = st.number_input("Comisión de Venta (%)", value=4.50, min_value=0.0, format="%.2f", step=0.5, key="comision_venta_input")
-        mode_venta = st.radio("Modo de Cálculo", ("USD ➔ USDT", "USDT ➔ USD"), horizontal=True, key="mode_venta")
+        mode_venta = st.radio("Modo de Cálculo", (motor_conversion.MODE_USD_TO_USDT, motor_conversion.MODE_USDT_TO_USD), horizontal=True, key="mode_venta")
+    if selected_client_name and selected_client_name != "-- Seleccione un Cliente --" and st.checkbox("📜 Ver historial del cliente", key="show_client_history"):
+        render_client_history(gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME, selected_client_name)
     st.markdown("---")
 
     # --- SECCIÓN 2: OPERACIONES ---
@@ -310,7 +1580,7 @@ def main():
     bcol1, bcol2, _ = st.columns([0.2, 0.2, 1.6], gap="small")
     with bcol1: st.button("➕ Añadir Fila", on_click=add_calculo_row)
     with bcol2: st.button("🔄 Limpiar Filas", on_click=limpiar_calculos_callback)
-    all_rows_data = [create_calculation_row(i, comision_compra, comision_venta, mode_compra, mode_venta) for i in range(st.session_state.num_rows)]
+    rows_container = st.container()
     st.markdown("---")
     
     # --- SECCIÓN 3: AJUSTES DE CAJA ---
@@ -319,29 +1589,31 @@ def main():
     acol1, acol2, _ = st.columns([0.2, 0.2, 1.6], gap="small")
     with acol1: st.button("➕ Añadir Ajuste", on_click=add_ajuste_row)
     with acol2: st.button("🔄 Limpiar Ajustes", on_click=limpiar_ajustes_callback)
-    all_ajustes_data = [create_ajuste_row(i) for i in range(st.session_state.num_ajustes)]
+    ajustes_container = st.container()
     st.markdown("---")
 
     # --- SECCIÓN 4: TOTALES Y BALANCE ---
     st.header("4. Totales y Balance Final")
-    total_usdt_recibidos_op = sum(d['usdt_recibidos_compra'] for d in all_rows_data)
-    total_usdt_entregados_op = sum(d['usdt_dados_venta'] for d in all_rows_data)
-    total_usdt_pagos_ajuste = sum(d['pago_usdt'] for d in all_ajustes_data)
-    total_usdt_recibos_ajuste = sum(d['recibo_usdt'] for d in all_ajustes_data)
-    st.subheader("Totales Consolidados 🧮")
-    col_t1, col_t2 = st.columns(2)
-    with col_t1: st.metric("TOTAL USDT RECIBIDOS (Op. + Ajustes)", f"{total_usdt_recibidos_op + total_usdt_pagos_ajuste:,.2f} USDT")
-    with col_t2: st.metric("TOTAL USDT ENTREGADOS (Op. + Ajustes)", f"{total_usdt_entregados_op + total_usdt_recibos_ajuste:,.2f} USDT")
-    st.subheader("Balance Final de Cierre del Cliente ⚖️")
-    cambio_neto_usdt = (total_usdt_recibidos_op + total_usdt_pagos_ajuste) - (total_usdt_entregados_op + total_usdt_recibos_ajuste)
-    balance_final_usdt = balance_inicial_usdt + cambio_neto_usdt
-    st.metric("Nuevo Saldo USDT del Cliente", f"{balance_final_usdt:,.2f}", delta=f"{cambio_neto_usdt:,.2f} USDT")
-    if balance_final_usdt > 0.01: status_texto, status_color = "EL CLIENTE TE DEBE", "#228B22"
-    elif balance_final_usdt < -0.01: status_texto, status_color = "TÚ LE DEBES AL CLIENTE", "#DC143C"
-    else: status_texto, status_color = "SALDO CERO", "gray"
-    st.markdown(f"<h3 style='text-align: center; color: {status_color};'>{status_texto}</h3>", unsafe_allow_html=True)
+    totals_slot = st.empty()
     st.markdown("---")
 
+    # Ejecución completa: todas las filas en una pasada del motor y los totales una sola vez al final
+    store = _calc_store()
+    store["rows"] = dict(enumerate(compute_calculation_rows(range(st.session_state.num_rows), comision_compra, comision_venta, mode_compra, mode_venta)))
+    store["ajustes"] = {}
+    st.session_state._calc_full_run = True
+    try:
+        with rows_container:
+            for i in range(st.session_state.num_rows): calculation_row_fragment(i, comision_compra, comision_venta, mode_compra, mode_venta, totals_slot, balance_inicial_usdt)
+        with ajustes_container:
+            for i in range(st.session_state.num_ajustes): ajuste_row_fragment(i, totals_slot, balance_inicial_usdt)
+    finally:
+        st.session_state._calc_full_run = False
+    all_rows_data = [store["rows"][i] for i in range(st.session_state.num_rows)]
+    all_ajustes_data = [store["ajustes"][i] for i in range(st.session_state.num_ajustes)]
+    totales = render_totals(totals_slot, balance_inicial_usdt)
+    balance_final_usdt = totales['balance_final_usdt']
+
     # --- SECCIÓN 5: REGISTRO ---
     st.header("5. Registrar Operaciones")
     col_save, col_clear_all = st.columns([3,1])
@@ -366,58 +1638,100 @@ def main():
                 if not operations_to_process:
                     st.warning("No hay operaciones o ajustes con montos mayores a cero para guardar.")
                 else:
-                    progress_bar = st.progress(0, text="Iniciando guardado...")
-                    mexico_tz = pytz.timezone("America/Mexico_City")
-                    now_mexico = datetime.now(mexico_tz)
-                    timestamp = now_mexico.strftime("%Y-%m-%d %H:%M:%S")
-                    today_prefix = now_mexico.strftime("%y-%m-%d")
-                    next_folio_num = get_next_folio_number(gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME)
-                    data_to_save_batch = []
-                    total_ops = len(operations_to_process)
-                    
-                    for i, op in enumerate(operations_to_process):
-                        current_folio = f"{today_prefix}-{next_folio_num + i:04d}"
-                        progress_text = f"Procesando operación {current_folio}..."
-                        progress_bar.progress((i + 1) / (total_ops + 2), text=progress_text)
-                        link, file_to_upload = "", None
-
-                        if op['type'] == 'Compra':
-                            file_to_upload = st.session_state.get(f"uploader_compra_{op['index']}_{current_key_iter}")
-                            row_data = all_rows_data[op['index']]
-                            if file_to_upload: link = upload_to_dropbox(dbx_client, file_to_upload, selected_client_name)
-                            data_to_save_batch.append([current_folio, timestamp, selected_client_name, "Compra (Das USD)", row_data['usd_dados_compra'], row_data['usdt_recibidos_compra'], comision_compra, link])
-                        elif op['type'] == 'Venta':
-                            file_to_upload = st.session_state.get(f"uploader_venta_{op['index']}_{current_key_iter}")
-                            row_data = all_rows_data[op['index']]
-                            if file_to_upload: link = upload_to_dropbox(dbx_client, file_to_upload, selected_client_name)
-                            data_to_save_batch.append([current_folio, timestamp, selected_client_name, "Venta (Recibes USD)", row_data['usd_recibidos_venta'], row_data['usdt_dados_venta'], comision_venta, link])
-                        elif op['type'] == 'Ajuste-Pago':
-                            file_to_upload = st.session_state.get(f"uploader_pago_{op['index']}_{current_key_iter}")
-                            row_data = all_ajustes_data[op['index']]
-                            if file_to_upload: link = upload_to_dropbox(dbx_client, file_to_upload, selected_client_name)
-                            data_to_save_batch.append([current_folio, timestamp, selected_client_name, "Ajuste: Pago Cliente", "", row_data['pago_usdt'], "N/A", link])
-                        elif op['type'] == 'Ajuste-Recibo':
-                            file_to_upload = st.session_state.get(f"uploader_recibo_{op['index']}_{current_key_iter}")
-                            row_data = all_ajustes_data[op['index']]
-                            if file_to_upload: link = upload_to_dropbox(dbx_client, file_to_upload, selected_client_name)
-                            data_to_save_batch.append([current_folio, timestamp, selected_client_name, "Ajuste: Recibo Tuyo", "", row_data['recibo_usdt'], "N/A", link])
                     try:
-                        progress_bar.progress((total_ops + 1) / (total_ops + 2), text="Guardando en Google Sheets...")
-                        sheet = gsheet_client.open_by_key(SPREADSHEET_ID).worksheet(SHEET_TAB_NAME)
-                        sheet.append_rows(data_to_save_batch, value_input_option='USER_ENTERED')
-                        progress_bar.progress(1.0, text="Actualizando saldo del cliente...")
-                        update_success = update_client_balance(gsheet_client, SPREADSHEET_ID, selected_client_name, balance_final_usdt)
-                        progress_bar.empty()
-                        if update_success:
-                            st.success(f"✅ ¡Éxito! Se guardaron las operaciones y se actualizó el saldo.")
-                        else:
-                            st.error(f"Se guardaron las operaciones, pero hubo un error al actualizar el saldo del cliente.")
+                        operations = []
+                        for op in operations_to_process:
+                            if op['type'] == 'Compra':
+                                row_data = all_rows_data[op['index']]
+                                operations.append({'type': 'Compra', 'usd': row_data['usd_dados_compra'], 'usdt': row_data['usdt_recibidos_compra'], 'comision': comision_compra, 'file': uploaded_receipt(f"uploader_compra_{op['index']}_{current_key_iter}")})
+                            elif op['type'] == 'Venta':
+                                row_data = all_rows_data[op['index']]
+                                operations.append({'type': 'Venta', 'usd': row_data['usd_recibidos_venta'], 'usdt': row_data['usdt_dados_venta'], 'comision': comision_venta, 'file': uploaded_receipt(f"uploader_venta_{op['index']}_{current_key_iter}")})
+                            elif op['type'] == 'Ajuste-Pago':
+                                operations.append({'type': 'Ajuste-Pago', 'usd': "", 'usdt': all_ajustes_data[op['index']]['pago_usdt'], 'comision': "N/A", 'file': uploaded_receipt(f"uploader_pago_{op['index']}_{current_key_iter}")})
+                            elif op['type'] == 'Ajuste-Recibo':
+                                operations.append({'type': 'Ajuste-Recibo', 'usd': "", 'usdt': all_ajustes_data[op['index']]['recibo_usdt'], 'comision': "N/A", 'file': uploaded_receipt(f"uploader_recibo_{op['index']}_{current_key_iter}")})
+                        with metricas.trace("guardado", cliente=selected_client_name, operaciones=len(operations)):
+                            saved_rows = register_operations(gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME, journal, journal_worker, selected_client_name, balance_final_usdt, operations, compress_receipts, dropbox_account=connection_keys["dropbox"])
+                        st.success(f"✅ ¡Éxito! Folios {saved_rows[0][0]} a {saved_rows[-1][0]} registrados. Se sincronizan con Google Sheets y Dropbox en segundo plano.")
                         st.balloons()
                     except Exception as e:
-                        progress_bar.empty()
+                        revalidate_on_auth_error(health, connection_keys, e)
                         st.error(f"❌ Error al guardar: {e}")
     with col_clear_all:
         st.button("🔄 Limpiar Todo", on_click=limpiar_todo_callback, use_container_width=True)
 
+    st.markdown("---")
+
+    # --- SECCIÓN 6: IMPORTACIÓN MASIVA ---
+    st.header("6. Importación Masiva")
+    st.caption("CSV o Excel con columnas **tipo** (compra, venta, pago, recibo) y **monto**; opcionales **modo** y **comision**. Sin ellas se usa la configuración de la sección 1.")
+    if 'import_key_iter' not in st.session_state: st.session_state.import_key_iter = 0
+    import_file = st.file_uploader("Archivo de operaciones", type=["csv", "xlsx"], key=f"import_file_{st.session_state.import_key_iter}")
+    if import_file is not None:
+        try:
+            import_df, import_errors = parse_import_file(import_file.getvalue(), import_file.name, comision_compra, comision_venta, mode_compra, mode_venta)
+        except Exception as e:
+            st.error(f"❌ No se pudo leer el archivo: {e}")
+        else:
+            if not import_errors.empty:
+                st.warning(f"⚠️ {len(import_errors)} fila(s) con errores no se importarán.")
+                st.dataframe(import_errors.rename(columns={"fila": "Fila", "motivo": "Motivo"}), hide_index=True, use_container_width=True)
+            if import_df.empty:
+                st.info("El archivo no contiene operaciones válidas.")
+            else:
+                st.dataframe(import_df.rename(columns={"fila": "Fila", "tipo": "Tipo", "modo": "Modo", "comision": "Comisión (%)", "monto": "Monto", "usd": "USD", "usdt": "USDT"}), hide_index=True, use_container_width=True)
+                import_totales = importacion.import_totals(import_df, balance_inicial_usdt)
+                icol1, icol2, icol3 = st.columns(3)
+                icol1.metric("Operaciones", f"{len(import_df):,}")
+                icol2.metric("Cambio Neto USDT", f"{import_totales['cambio_neto_usdt']:,.2f}")
+                icol3.metric("Saldo Final USDT", f"{import_totales['balance_final_usdt']:,.2f}")
+                if st.button("💾 Guardar Importación", type="primary"):
+                    if not selected_client_name or selected_client_name == "-- Seleccione un Cliente --":
+                        st.error("Por favor, seleccione un cliente antes de guardar.")
+                    else:
+                        try:
+                            operations = import_operations(import_df)
+                            with metricas.trace("guardado", cliente=selected_client_name, operaciones=len(operations), origen="importacion"):
+                                saved_rows = register_operations(gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME, journal, journal_worker, selected_client_name, import_totales['balance_final_usdt'], operations, dropbox_account=connection_keys["dropbox"])
+                            st.session_state.import_key_iter += 1
+                            st.success(f"✅ ¡Éxito! Folios {saved_rows[0][0]} a {saved_rows[-1][0]} importados. Se sincronizan con Google Sheets en segundo plano.")
+                        except Exception as e:
+                            revalidate_on_auth_error(health, connection_keys, e)
+                            st.error(f"❌ Error al guardar: {e}")
+
+    pending_batches = journal.pending_count()
+    # --- SECCIÓN 7: CIERRE DEL DÍA ---
+    st.markdown("---")
+    st.header("7. Cierre del Día")
+    if st.checkbox("📑 Generar reporte de cierre", key="show_closing_report"):
+        render_closing_report(gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME, pending_batches)
+
+    failed_batches = journal.failed_batches()
+    failed_title = f", {len(failed_batches)} fallido(s)" if failed_batches else ""
+    with st.expander(f"Estado de sincronización ({pending_batches} lote(s) pendiente(s){failed_title})", expanded=pending_batches > 0 or bool(failed_batches)):
+        # Un lote fallido ya no se reintenta solo ni detiene la cola: se reintenta tras corregir la causa o se cierra a mano
+        for failed in failed_batches:
+            st.error(f"❌ Lote {failed['id']} ({failed['cliente']}, folios {failed['folios']}) falló tras {failed['intentos']} intento(s): {failed['ultimo_error']}")
+            retry_col, resolve_col = st.columns(2)
+            if retry_col.button("🔁 Reintentar", key=f"reintentar_lote_{failed['id']}"):
+                journal.retry_batch(failed['id'])
+                journal_worker.notify()
+                st.rerun()
+            if resolve_col.button("✔️ Marcar como resuelto a mano", key=f"resolver_lote_{failed['id']}"):
+                journal.resolve_batch(failed['id'], f"resuelto a mano el {datetime.now(MEXICO_TZ):%Y-%m-%d %H:%M}; último error: {failed['ultimo_error']}")
+                st.rerun()
+        status_rows = journal.recent_status()
+        if not status_rows:
+            st.caption("Aún no hay folios registrados en esta instalación.")
+        else:
+            st.dataframe(pd.DataFrame([{"Folio": entry["folio"], "Cliente": entry["cliente"], "Estado": _sync_status_label(entry), "Comprobante": entry["link"]} for entry in status_rows]), hide_index=True, use_container_width=True)
+        st.button("🔄 Actualizar estado")
+
+    render_balance_discrepancies(get_balance_book(gsheet_client, SPREADSHEET_ID, SHEET_TAB_NAME))
+
+    if st.sidebar.checkbox("📊 Mostrar métricas de guardado", key="mostrar_metricas"):
+        render_metrics_panel()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
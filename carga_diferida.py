@@ -0,0 +1,33 @@
+import importlib
+
+# --- IMPORTACIONES DIFERIDAS ---
+# Los SDK de Google y Dropbox, pandas y pyarrow tardan cientos de milisegundos
+# en importarse y la primera pantalla no usa ninguno. Un módulo diferido se
+# importa la primera vez que se lee uno de sus atributos, así la página se
+# dibuja antes de pagar por lo que todavía no necesita. importlib toma el
+# candado de importación del módulo: dos hilos que lo usen a la vez obtienen
+# el mismo módulo, importado una sola vez.
+
+class _DeferredModule:
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        if self._module is None:
+            object.__setattr__(self, "_module", importlib.import_module(self._name))
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        # p. ej. el benchmark reemplaza cuota_sheets.scheduler
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return f"<módulo diferido {self._name!r}>"
+
+def lazy_module(name):
+    """Sustituto de `import name` que importa el módulo en su primer uso."""
+    return _DeferredModule(name)
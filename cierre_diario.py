@@ -0,0 +1,150 @@
+import argparse
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import espejo_libro
+import motor_conversion
+import saldos
+
+# --- CIERRE DEL DÍA ---
+# Resumen por día y cliente calculado desde el libro de operaciones (el espejo
+# local en Parquet): USD entregados y recibidos, USDT por compras y ventas,
+# ajustes y comisión ganada. Todo sale de un solo groupby en centavos enteros.
+# El día de cada operación es el prefijo aa-mm-dd de su folio.
+#
+#   python cierre_diario.py --dia 2026-10-17 --salida cierre.xlsx
+#   python cierre_diario.py --benchmark 200000
+
+COLUMN_NAMES = {
+    "dia": "Día", "cliente": "Cliente", "operaciones": "Operaciones",
+    "usd_entregados": "USD entregados (compras)", "usd_recibidos": "USD recibidos (ventas)",
+    "usdt_compras": "USDT recibidos (compras)", "usdt_ventas": "USDT entregados (ventas)",
+    "ajustes_pago": "Ajustes: pagos cliente", "ajustes_recibo": "Ajustes: recibos tuyos",
+    "comision_ganada": "Comisión ganada (USDT)", "comision_nominal_pct": "Comisión nominal (%)", "comision_efectiva_pct": "Comisión efectiva (%)",
+    "cambio_neto_usdt": "Cambio neto saldo USDT",
+}
+_AMOUNT_COLUMNS = ["usd_entregados", "usd_recibidos", "usdt_compras", "usdt_ventas", "ajustes_pago", "ajustes_recibo", "comision_ganada", "cambio_neto_usdt"]
+TOTAL_LABEL = "TOTAL"
+
+def _operation_days(ledger):
+    # Prefijo del folio (aa-mm-dd); las filas con otro folio usan su fecha.
+    # Se interpretan solo los prefijos distintos (uno por día), no uno por fila
+    prefixes = pc.utf8_slice_codeunits(pa.array(ledger["folio"].astype(str), type=pa.string()), 0, 8).to_pandas()
+    codes, uniques = pd.factorize(prefixes)
+    days = pd.Series(pd.to_datetime(pd.Series(uniques, dtype=object), format="%y-%m-%d", errors="coerce").to_numpy()[codes], index=ledger.index)
+    return days.fillna(pd.to_datetime(ledger["fecha"]).dt.normalize())
+
+def closing_report(ledger, labels=saldos.OPERATION_LABELS):
+    """Resumen de cierre de `ledger` (DataFrame con las columnas del espejo) por día y cliente.
+
+    Regresa (por_cliente, por_dia): mismas columnas, montos en unidades; `por_dia` es el
+    total de cada día. La comisión ganada es usd - usdt de compras y ventas (1 USD = 1 USDT);
+    la nominal es el promedio de la comisión capturada ponderado por USD.
+    """
+    kinds = ledger["tipo"].map({label: kind for kind, label in labels.items()}).to_numpy()
+    usd, usdt = motor_conversion.to_cents(ledger["usd"].fillna(0)), motor_conversion.to_cents(ledger["usdt"].fillna(0))
+    is_compra, is_venta = kinds == "Compra", kinds == "Venta"
+    is_exchange = is_compra | is_venta
+    frame = pd.DataFrame({
+        "dia": _operation_days(ledger).to_numpy(),
+        "cliente": ledger["cliente"].to_numpy(),
+        "operaciones": np.ones(len(ledger), dtype=np.int64),
+        "usd_entregados": np.where(is_compra, usd, 0),
+        "usd_recibidos": np.where(is_venta, usd, 0),
+        "usdt_compras": np.where(is_compra, usdt, 0),
+        "usdt_ventas": np.where(is_venta, usdt, 0),
+        "ajustes_pago": np.where(kinds == "Ajuste-Pago", usdt, 0),
+        "ajustes_recibo": np.where(kinds == "Ajuste-Recibo", usdt, 0),
+        "comision_ganada": np.where(is_exchange, usd - usdt, 0),
+        # USD x comisión (centavos x %) para el promedio ponderado
+        "_usd_x_comision": np.where(is_exchange, usd * ledger["comision"].fillna(0).to_numpy(), 0),
+    })[pd.notna(kinds)]
+    by_client = frame.groupby(["dia", "cliente"], sort=True).sum()
+    by_day = by_client.groupby(level="dia").sum()
+    by_day["cliente"] = TOTAL_LABEL
+    return _finish(by_client.reset_index()), _finish(by_day.reset_index())
+
+def _finish(totals):
+    # Centavos -> unidades y columnas derivadas, en el orden de COLUMN_NAMES
+    volume = totals["usd_entregados"] + totals["usd_recibidos"]
+    safe_volume = volume.where(volume > 0)
+    totals["comision_nominal_pct"] = (totals["_usd_x_comision"] / safe_volume).round(2).fillna(0)
+    totals["comision_efectiva_pct"] = (totals["comision_ganada"] * 100 / safe_volume).round(2).fillna(0)
+    totals["dia"] = totals["dia"].dt.date
+    # Mismo criterio que closing_totals: compras y pagos suben el saldo, ventas y recibos lo bajan
+    totals["cambio_neto_usdt"] = totals["usdt_compras"] + totals["ajustes_pago"] - totals["usdt_ventas"] - totals["ajustes_recibo"]
+    for column in _AMOUNT_COLUMNS:
+        totals[column] = motor_conversion.from_cents(totals[column])
+    return totals[list(COLUMN_NAMES)]
+
+def export_report(by_client, by_day, file_format):
+    """Bytes del reporte en "csv" (una tabla, con los totales al final de cada día) o "xlsx" (una hoja por tabla)."""
+    if file_format == "xlsx":
+        output = io.BytesIO()
+        # Requiere openpyxl, igual que la importación de XLSX
+        with pd.ExcelWriter(output, engine="openpyxl") as writer:
+            by_client.rename(columns=COLUMN_NAMES).to_excel(writer, sheet_name="Por cliente", index=False)
+            by_day.rename(columns=COLUMN_NAMES).to_excel(writer, sheet_name="Totales por día", index=False)
+        return output.getvalue()
+    combined = pd.concat([by_client, by_day]).sort_values(["dia", "cliente"], key=lambda column: column.eq(TOTAL_LABEL) if column.name == "cliente" else column, kind="stable")
+    return combined.rename(columns=COLUMN_NAMES).to_csv(index=False).encode("utf-8-sig")
+
+def load_days(mirror, first_day, last_day=None):
+    """Operaciones del espejo (LedgerMirror o MirrorReader) de `first_day` a `last_day` (incluidos)."""
+    last_day = last_day or first_day
+    ledger = mirror.query(start=first_day, end=pd.Timestamp(last_day) + pd.Timedelta(days=1))
+    # La fecha define la partición a leer; el folio, el día de cierre
+    days = _operation_days(ledger)
+    return ledger[(days >= pd.Timestamp(first_day)) & (days <= pd.Timestamp(last_day))]
+
+def _synthetic_ledger(rows, seed=0):
+    # Un año de operaciones al azar con la forma del espejo
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.uniform(0, 365, rows), unit="D")
+    labels = np.array(list(saldos.OPERATION_LABELS.values()))
+    usd = rng.uniform(10, 50_000, rows).round(2)
+    commission = rng.choice([3.0, 3.5, 4.0, 4.5], rows)
+    return pd.DataFrame({
+        "folio": dates.strftime("%y-%m-%d") + "-" + pd.Series(range(rows)).astype(str).str.zfill(4),
+        "fecha": dates, "cliente": rng.choice([f"cliente{i}" for i in range(500)], rows), "tipo": rng.choice(labels, rows),
+        "usd": usd, "usdt": (usd * (1 - commission / 100)).round(2), "comision": commission,
+    })
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reporte de cierre del día desde el espejo local del libro de operaciones.")
+    parser.add_argument("--dia", help="Día a reportar (AAAA-MM-DD); por omisión hoy")
+    parser.add_argument("--hasta", help="Último día si se reporta un rango (AAAA-MM-DD)")
+    parser.add_argument("--espejo", default="espejo_libro", help="Carpeta del espejo local que sincroniza la app (se lee sin modificarla)")
+    parser.add_argument("--salida", help="Archivo .csv o .xlsx; sin él se imprime el total de cada día")
+    parser.add_argument("--benchmark", type=int, metavar="FILAS", help="Mide el reporte sobre FILAS operaciones sintéticas de un año")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.benchmark:
+        ledger = _synthetic_ledger(args.benchmark)
+        start = time.perf_counter()
+        by_client, by_day = closing_report(ledger)
+        elapsed = time.perf_counter() - start
+        print(f"{args.benchmark:,} operaciones ({len(by_day)} días, {len(by_client):,} filas cliente-día) en {elapsed * 1000:,.1f} ms")
+        return
+    first_day = pd.Timestamp(args.dia or pd.Timestamp.now().date()).date()
+    # Solo lectura: el espejo lo sincroniza la app y un LedgerMirror aquí podría borrar partes que ella está escribiendo
+    ledger = load_days(espejo_libro.MirrorReader(args.espejo), first_day, args.hasta and pd.Timestamp(args.hasta).date())
+    by_client, by_day = closing_report(ledger)
+    if not args.salida:
+        print(by_day.rename(columns=COLUMN_NAMES).to_string(index=False))
+        return
+    file_format = "xlsx" if args.salida.lower().endswith(".xlsx") else "csv"
+    with open(args.salida, "wb") as output:
+        output.write(export_report(by_client, by_day, file_format))
+    print(f"{len(ledger)} operaciones, {len(by_client)} filas cliente-día -> {args.salida}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import io
+import os
+
+import carga_diferida
+
+# Pillow se importa al comprimir el primer comprobante, no al leer las constantes
+Image = carga_diferida.lazy_module("PIL.Image")
+ImageOps = carga_diferida.lazy_module("PIL.ImageOps")
+
+# --- PREPROCESAMIENTO DE COMPROBANTES ---
+# Las fotos de recibos tomadas con el teléfono pesan varios MB y dominan el
+# tiempo de subida. Antes de guardarlas se reducen a una dimensión máxima y se
+# recodifican como JPEG progresivo (o WebP) sin metadatos EXIF. Si la versión
+# recodificada no sirve, el original se sube igual pero sin metadatos (el EXIF
+# de una foto trae la ubicación GPS). Los PDF y los archivos que no son imagen
+# se dejan intactos.
+
+RECEIPT_MAX_DIMENSION = 2000
+RECEIPT_QUALITY = 80
+# "JPEG" o "WEBP"
+RECEIPT_FORMAT = "JPEG"
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+_FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+_EXIF_ORIENTATION = 0x0112
+# Segmentos JPEG con metadatos: APP1 (EXIF, XMP) y APP13 (IPTC); el perfil ICC (APP2) se conserva
+_JPEG_METADATA_MARKERS = (0xE1, 0xED)
+# Opciones al volver a guardar sin metadatos un original que no es JPEG
+_RESAVE_OPTIONS = {"PNG": {"optimize": True}, "WEBP": {"quality": 95}, "TIFF": {"compression": "tiff_deflate"}}
+
+def _flatten(image):
+    # JPEG no admite transparencia: se compone sobre fondo blanco
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image if image.mode in ("RGB", "L") else image.convert("RGB")
+
+def _strip_jpeg_metadata(data, orientation=None):
+    # Quita los segmentos de metadatos sin recodificar; la orientación queda en un EXIF mínimo. None si no es un JPEG legible
+    data = bytes(data)
+    if data[:2] != b"\xff\xd8":
+        return None
+    kept, position = [data[:2]], 2
+    if orientation and orientation != 1:
+        exif = Image.Exif()
+        exif[_EXIF_ORIENTATION] = orientation
+        exif = exif.tobytes()
+        kept.append(b"\xff\xe1" + (len(exif) + 2).to_bytes(2, "big") + exif)
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Bytes de relleno antes del marcador
+            position += 1
+            continue
+        if marker == 0xDA:
+            # Desde el inicio del escaneo ya solo vienen los datos de la imagen
+            kept.append(data[position:])
+            return b"".join(kept)
+        end = position + 2 + int.from_bytes(data[position + 2:position + 4], "big")
+        if marker not in _JPEG_METADATA_MARKERS: kept.append(data[position:end])
+        position = end
+    return None
+
+def strip_metadata(file_name, data):
+    """Bytes de la imagen sin metadatos (EXIF con GPS, XMP, IPTC); el JPEG no se recodifica.
+
+    Si no se puede leer como imagen se regresa `data` sin cambios.
+    """
+    if os.path.splitext(file_name)[1].lower() not in IMAGE_EXTENSIONS:
+        return data
+    orientation = None
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            orientation = original.getexif().get(_EXIF_ORIENTATION)
+            if original.format != "JPEG":
+                # Los pixeles se giran según el EXIF y se guardan en el mismo formato, solo con perfil de color y transparencia
+                image = ImageOps.exif_transpose(original).copy()
+                image.info = {key: original.info[key] for key in ("icc_profile", "transparency") if key in original.info}
+                output = io.BytesIO()
+                image.save(output, original.format, **_RESAVE_OPTIONS.get(original.format, {}))
+                return output.getvalue()
+    except Exception:
+        # Pillow no lee el archivo: a un JPEG todavía se le pueden quitar los segmentos de metadatos
+        pass
+    stripped = _strip_jpeg_metadata(data, orientation)
+    return data if stripped is None else stripped
+
+def compress_receipt(file_name, data, max_dimension=RECEIPT_MAX_DIMENSION, quality=RECEIPT_QUALITY, image_format=RECEIPT_FORMAT):
+    """Regresa (nombre, bytes) del comprobante listo para subir.
+
+    Si el archivo no es una imagen legible, o la versión comprimida no es más
+    pequeña, se regresa el original sin metadatos (ver strip_metadata).
+    """
+    stem, extension = os.path.splitext(file_name)
+    if extension.lower() not in IMAGE_EXTENSIONS:
+        return file_name, data
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            # La orientación de la cámara se aplica a los pixeles antes de descartar el EXIF
+            image = _flatten(ImageOps.exif_transpose(original))
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            output = io.BytesIO()
+            if image_format == "WEBP":
+                image.save(output, "WEBP", quality=quality, method=4)
+            else:
+                image.save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+    except Exception:
+        return file_name, strip_metadata(file_name, data)
+    if output.tell() >= len(data):
+        return file_name, strip_metadata(file_name, data)
+    return f"{stem}{_FORMAT_EXTENSIONS.get(image_format, '.jpg')}", output.getvalue()
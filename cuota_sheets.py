@@ -0,0 +1,162 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import gspread
+import requests
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+import metricas
+
+# --- ACCESO A GOOGLE SHEETS CON CUOTA ---
+# Todas las llamadas a la API de Sheets pasan por aquí. Se lleva la cuenta de
+# peticiones por minuto contra la cuota conocida (60 lecturas y 60 escrituras
+# por minuto por usuario) y se espera antes de excederla; un 429 de todos modos
+# (otras cajas comparten la cuota) se reintenta con espera exponencial y
+# jitter. Las lecturas idénticas simultáneas se combinan en una sola petición.
+# Esperas, 429 y reintentos quedan en las métricas del guardado.
+#
+# La cuenta se lleva por proceso, pero la cuota es de la cuenta de servicio: si
+# otro proceso usa las mismas credenciales (p. ej. servicio_operaciones junto a
+# la app) cada uno debe limitarse a una fracción de la cuota y entre todos no
+# pasar de 1. La fracción de un proceso se toma de CUOTA_SHEETS_FRACCION (o de
+# set_share). Por omisión la app usa 3/4 y el servicio 1/4; si la app corre
+# sola puede usar la cuota completa:
+#
+#   CUOTA_SHEETS_FRACCION=1 streamlit run calculadora_cambio_USD.py
+#   python servicio_operaciones.py --cuota-sheets 0.25 servir
+
+READ_QUOTA_PER_MINUTE = 60
+WRITE_QUOTA_PER_MINUTE = 60
+QUOTA_WINDOW_SECONDS = 60
+# Fracción de la cuota de la app si no se indica otra en el entorno; el resto es del servicio
+DEFAULT_QUOTA_SHARE = 0.75
+MAX_ATTEMPTS = 6
+MAX_BACKOFF_SECONDS = 32
+
+READ, WRITE = "lectura", "escritura"
+# Una escritura solo se repite si Sheets la rechazó sin aplicarla (cuota); un 5xx pudo haberla aplicado
+_RETRYABLE_STATUS = {READ: {429, 500, 502, 503, 504}, WRITE: {429}}
+
+def _status(exc):
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) if isinstance(exc, gspread.exceptions.APIError) else None
+
+def _share_of(quota, share):
+    # Al menos una petición por ventana; una cuota infinita (benchmarks) sigue siéndolo
+    return quota if math.isinf(quota) else max(1, int(quota * share))
+
+def _call_key(fn, args, kwargs):
+    # Misma función sobre el mismo objeto (hoja) con los mismos argumentos
+    return (id(getattr(fn, "__self__", fn)), getattr(fn, "__name__", repr(fn)), repr(args), repr(sorted(kwargs.items())))
+
+class SheetsScheduler:
+    """Limita, reintenta y combina llamadas a la API de Sheets; seguro entre hilos.
+
+    `share` es la fracción de `read_quota` y `write_quota` que puede usar este proceso.
+    """
+
+    def __init__(self, read_quota=READ_QUOTA_PER_MINUTE, write_quota=WRITE_QUOTA_PER_MINUTE, window_seconds=QUOTA_WINDOW_SECONDS, share=1.0):
+        self.full_quotas = {READ: read_quota, WRITE: write_quota}
+        self.window_seconds = window_seconds
+        self.set_share(share)
+        self._sent = {READ: deque(), WRITE: deque()}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def set_share(self, share):
+        if not 0 < share <= 1:
+            raise ValueError(f"La fracción de la cuota de Sheets debe estar entre 0 y 1: {share}")
+        self.share = share
+        self.quotas = {kind: _share_of(quota, share) for kind, quota in self.full_quotas.items()}
+
+    def _acquire(self, kind):
+        # Ventana deslizante: si ya se hicieron `quota` peticiones en el último minuto se espera a que salga la más antigua
+        while True:
+            with self._lock:
+                sent, now = self._sent[kind], time.monotonic()
+                while sent and now - sent[0] >= self.window_seconds:
+                    sent.popleft()
+                if len(sent) < self.quotas[kind]:
+                    sent.append(now)
+                    return
+                delay = self.window_seconds - (now - sent[0])
+            metricas.count("sheets.esperas_cuota")
+            with metricas.span("sheets.espera_cuota"):
+                time.sleep(delay)
+
+    def _is_retryable(self, kind, exc):
+        status = _status(exc)
+        if status == 429:
+            metricas.count("sheets.cuota_excedida")
+        if kind == READ and isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        return status in _RETRYABLE_STATUS[kind]
+
+    def call(self, kind, fn, *args, **kwargs):
+        """Ejecuta `fn(*args, **kwargs)` respetando la cuota de `kind`; si se agotan los reintentos propaga el error."""
+        retrying = Retrying(
+            retry=retry_if_exception(lambda exc: self._is_retryable(kind, exc)),
+            wait=wait_random_exponential(multiplier=0.5, max=MAX_BACKOFF_SECONDS),
+            stop=stop_after_attempt(MAX_ATTEMPTS),
+            before_sleep=lambda state: metricas.count("sheets.reintentos"),
+            reraise=True,
+        )
+        for attempt in retrying:
+            with attempt:
+                self._acquire(kind)
+                return fn(*args, **kwargs)
+
+    def read(self, fn, *args, **kwargs):
+        # Si la misma lectura ya está en curso (otra sesión u otro hilo), se espera su resultado
+        key = _call_key(fn, args, kwargs)
+        with self._lock:
+            pending = self._inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._inflight[key] = Future()
+        if not owner:
+            metricas.count("sheets.lecturas_combinadas")
+            return pending.result()
+        try:
+            result = self.call(READ, fn, *args, **kwargs)
+            pending.set_result(result)
+            return result
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def write(self, fn, *args, **kwargs):
+        return self.call(WRITE, fn, *args, **kwargs)
+
+    def usage(self):
+        """Peticiones hechas en la ventana actual por tipo: dict tipo -> (usadas, cuota)."""
+        with self._lock:
+            now = time.monotonic()
+            return {kind: (sum(1 for sent_at in sent if now - sent_at < self.window_seconds), self.quotas[kind]) for kind, sent in self._sent.items()}
+
+def configured_share():
+    """Fracción de la cuota de la app según CUOTA_SHEETS_FRACCION (o DEFAULT_QUOTA_SHARE)."""
+    return float(os.environ.get("CUOTA_SHEETS_FRACCION", DEFAULT_QUOTA_SHARE))
+
+# Un planificador por proceso: la cuota es de la cuenta de servicio, no de la sesión
+scheduler = SheetsScheduler(share=configured_share())
+
+def set_share(share):
+    """Fracción de la cuota de la cuenta de servicio que usa este proceso (0 a 1)."""
+    scheduler.set_share(share)
+
+def read(fn, *args, **kwargs):
+    return scheduler.read(fn, *args, **kwargs)
+
+def write(fn, *args, **kwargs):
+    return scheduler.write(fn, *args, **kwargs)
+
+def usage():
+    return scheduler.usage()
@@ -0,0 +1,318 @@
+import io
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# --- DIARIO LOCAL DE GUARDADOS ---
+# Cada guardado se confirma primero en SQLite y un hilo en segundo plano lo
+# sincroniza después con Google Sheets y Dropbox. El diario no depende de
+# Streamlit: la función que sincroniza un lote la provee la aplicación.
+
+STATUS_PENDING = "pendiente"
+STATUS_SYNCED = "sincronizado"
+# Agotó sus intentos o falló sin remedio: no bloquea la cola y espera a que alguien lo resuelva
+STATUS_FAILED = "fallido"
+# Intentos de un lote antes de marcarlo como fallido
+MAX_SYNC_ATTEMPTS = 10
+
+logger = logging.getLogger("diario_guardado")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lotes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    creado TEXT NOT NULL,
+    cliente TEXT NOT NULL,
+    saldo_final REAL NOT NULL,
+    estado TEXT NOT NULL,
+    intentos INTEGER NOT NULL DEFAULT 0,
+    ultimo_error TEXT NOT NULL DEFAULT '',
+    cuenta TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS operaciones (
+    folio TEXT PRIMARY KEY,
+    lote_id INTEGER NOT NULL REFERENCES lotes(id),
+    posicion INTEGER NOT NULL,
+    fila TEXT NOT NULL,
+    link TEXT NOT NULL DEFAULT '',
+    ruta TEXT NOT NULL DEFAULT '',
+    archivo_nombre TEXT NOT NULL DEFAULT '',
+    archivo_bytes BLOB
+);
+CREATE INDEX IF NOT EXISTS idx_lotes_estado ON lotes(estado, id);
+CREATE TABLE IF NOT EXISTS comprobantes (
+    sha256 TEXT PRIMARY KEY,
+    link TEXT NOT NULL,
+    archivo_nombre TEXT NOT NULL,
+    folio TEXT NOT NULL,
+    creado TEXT NOT NULL
+);
+"""
+
+class PermanentSyncError(Exception):
+    """Falla que no se corrige reintentando: el lote pasa directo a fallido."""
+
+class StoredReceipt(io.BytesIO):
+    """Comprobante leído del diario con la misma interfaz que un UploadedFile (name, getvalue)."""
+
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+class SaveJournal:
+    """Diario de lotes por guardar, persistido en un archivo SQLite en modo WAL."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            # Diarios creados antes de que los links se generaran en una etapa aparte
+            if "ruta" not in {column["name"] for column in conn.execute("PRAGMA table_info(operaciones)")}:
+                conn.execute("ALTER TABLE operaciones ADD COLUMN ruta TEXT NOT NULL DEFAULT ''")
+            # Diarios creados antes de que cada lote recordara la cuenta de Dropbox de quien lo guardó
+            if "cuenta" not in {column["name"] for column in conn.execute("PRAGMA table_info(lotes)")}:
+                conn.execute("ALTER TABLE lotes ADD COLUMN cuenta TEXT NOT NULL DEFAULT ''")
+
+    @contextmanager
+    def _connect(self):
+        # Una conexión por operación (el diario se usa desde varios hilos); confirma al salir sin error
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, client_alias, new_usdt, rows, receipts, account=""):
+        """Confirma un lote; `rows` son las filas del libro (folio primero) y `receipts` un dict folio -> (nombre, bytes).
+
+        `account` identifica la cuenta de Dropbox a la que van sus comprobantes (una llave, no el token).
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO lotes (creado, cliente, saldo_final, estado, cuenta) VALUES (?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec="seconds"), client_alias, float(new_usdt), STATUS_PENDING, account),
+            )
+            batch_id = cursor.lastrowid
+            for position, row in enumerate(rows):
+                file_name, file_bytes = receipts.get(row[0], ("", None))
+                conn.execute(
+                    "INSERT INTO operaciones (folio, lote_id, posicion, fila, archivo_nombre, archivo_bytes) VALUES (?, ?, ?, ?, ?, ?)",
+                    (row[0], batch_id, position, json.dumps(row), file_name, file_bytes),
+                )
+        return batch_id
+
+    def next_pending(self, accounts=None):
+        """Siguiente lote por sincronizar, o None.
+
+        Los lotes se sincronizan en orden. Con `accounts` solo se consideran los de esas
+        cuentas de Dropbox, sin adelantar a un lote pendiente anterior del mismo cliente.
+        """
+        with self._connect() as conn:
+            if accounts is None:
+                batch = conn.execute("SELECT * FROM lotes WHERE estado = ? ORDER BY id LIMIT 1", (STATUS_PENDING,)).fetchone()
+            else:
+                accounts = list(accounts)
+                batch = conn.execute(
+                    f"SELECT * FROM lotes l WHERE estado = ? AND cuenta IN ({', '.join('?' * len(accounts))}) "
+                    "AND NOT EXISTS (SELECT 1 FROM lotes p WHERE p.estado = ? AND p.cliente = l.cliente AND p.id < l.id) ORDER BY id LIMIT 1",
+                    (STATUS_PENDING, *accounts, STATUS_PENDING),
+                ).fetchone()
+            if batch is None:
+                return None
+            operations = conn.execute("SELECT * FROM operaciones WHERE lote_id = ? ORDER BY posicion", (batch["id"],)).fetchall()
+        return {
+            "id": batch["id"], "client_alias": batch["cliente"], "new_usdt": batch["saldo_final"], "attempts": batch["intentos"], "account": batch["cuenta"],
+            "operations": [{
+                "folio": op["folio"], "row": json.loads(op["fila"]), "link": op["link"], "path": op["ruta"],
+                "file_name": op["archivo_nombre"], "file_bytes": op["archivo_bytes"],
+            } for op in operations],
+        }
+
+    def set_link(self, folio, link):
+        with self._connect() as conn:
+            conn.execute("UPDATE operaciones SET link = ? WHERE folio = ?", (link, folio))
+
+    def set_path(self, folio, path):
+        # Ruta en Dropbox de un comprobante ya subido, aunque aún no tenga link
+        with self._connect() as conn:
+            conn.execute("UPDATE operaciones SET ruta = ? WHERE folio = ?", (path, folio))
+
+    def mark_synced(self, batch_id, note=""):
+        # Los bytes de los comprobantes ya no se necesitan una vez sincronizado el lote
+        with self._connect() as conn:
+            conn.execute("UPDATE lotes SET estado = ?, ultimo_error = ? WHERE id = ?", (STATUS_SYNCED, note, batch_id))
+            conn.execute("UPDATE operaciones SET archivo_bytes = NULL WHERE lote_id = ?", (batch_id,))
+
+    def mark_failed(self, batch_id, error, final=False):
+        # `final`: el lote deja de reintentarse y queda como fallido hasta que alguien lo resuelva
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE lotes SET intentos = intentos + 1, ultimo_error = ?, estado = CASE WHEN ? THEN ? ELSE estado END WHERE id = ?",
+                (str(error), final, STATUS_FAILED, batch_id),
+            )
+
+    def failed_batches(self):
+        # Lotes fallidos con sus folios, del más antiguo al más reciente
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT l.id, l.creado, l.cliente, l.intentos, l.ultimo_error, group_concat(o.folio, ', ') AS folios FROM lotes l "
+                "JOIN operaciones o ON o.lote_id = l.id WHERE l.estado = ? GROUP BY l.id ORDER BY l.id",
+                (STATUS_FAILED,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def retry_batch(self, batch_id):
+        """Regresa un lote fallido a la cola con sus intentos en cero (p. ej. tras corregir la causa)."""
+        with self._connect() as conn:
+            conn.execute("UPDATE lotes SET estado = ?, intentos = 0 WHERE id = ? AND estado = ?", (STATUS_PENDING, batch_id, STATUS_FAILED))
+
+    def resolve_batch(self, batch_id, note):
+        """Cierra a mano un lote fallido (p. ej. sus filas se capturaron directo en la hoja)."""
+        with self._connect() as conn:
+            if conn.execute("UPDATE lotes SET estado = ?, ultimo_error = ? WHERE id = ? AND estado = ?", (STATUS_SYNCED, note, batch_id, STATUS_FAILED)).rowcount:
+                conn.execute("UPDATE operaciones SET archivo_bytes = NULL WHERE lote_id = ?", (batch_id,))
+
+    def find_receipts(self, digests):
+        """Links ya subidos para los hashes SHA-256 dados: dict hash -> link."""
+        digests = list(digests)
+        if not digests:
+            return {}
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT sha256, link FROM comprobantes WHERE sha256 IN ({', '.join('?' * len(digests))})", digests).fetchall()
+        return {row["sha256"]: row["link"] for row in rows}
+
+    def remember_receipt(self, digest, link, file_name, folio):
+        # El primer link de un contenido se conserva: es al que apuntan las filas anteriores
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO comprobantes (sha256, link, archivo_nombre, folio, creado) VALUES (?, ?, ?, ?, ?)",
+                (digest, link, file_name, folio, datetime.now().isoformat(timespec="seconds")),
+            )
+
+    def pending_rows(self, client_alias):
+        # Filas del libro de los lotes del cliente que aún no se sincronizan
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT o.fila FROM operaciones o JOIN lotes l ON l.id = o.lote_id WHERE l.estado = ? AND l.cliente = ? ORDER BY l.id, o.posicion",
+                (STATUS_PENDING, client_alias),
+            ).fetchall()
+        return [json.loads(row["fila"]) for row in rows]
+
+    def pending_count(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM lotes WHERE estado = ?", (STATUS_PENDING,)).fetchone()[0]
+
+    def folio_status(self, folios):
+        # Estado de su lote y link de cada folio dado, en el mismo orden; los folios desconocidos se omiten
+        folios = list(folios)
+        if not folios:
+            return []
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT o.folio, l.cliente, l.estado, l.intentos, l.ultimo_error, o.link FROM operaciones o "
+                f"JOIN lotes l ON l.id = o.lote_id WHERE o.folio IN ({', '.join('?' * len(folios))})",
+                folios,
+            ).fetchall()
+        by_folio = {row["folio"]: dict(row) for row in rows}
+        return [by_folio[folio] for folio in folios if folio in by_folio]
+
+    def recent_status(self, limit=20):
+        # Últimos folios registrados con el estado de su lote, del más reciente al más antiguo
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT o.folio, l.cliente, l.estado, l.intentos, l.ultimo_error, o.link FROM operaciones o "
+                "JOIN lotes l ON l.id = o.lote_id ORDER BY l.id DESC, o.posicion DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+class JournalWorker:
+    """Hilo que vacía el diario llamando `flush_fn(lote)` para cada lote pendiente.
+
+    `flush_fn` regresa una nota opcional (se guarda con el lote) o lanza una
+    excepción; en ese caso el lote se reintenta con espera exponencial y los
+    lotes posteriores esperan su turno. Tras `max_attempts` intentos, o ante un
+    PermanentSyncError, el lote queda como fallido y la cola sigue. Sin lotes
+    pendientes, `idle_fn` (si se configuró) se ejecuta a lo más cada
+    `idle_interval_seconds`. Un error del propio diario (p. ej. SQLite bloqueado) se
+    registra y se reintenta con espera; si aun así el hilo muere, `configure` lo
+    vuelve a arrancar.
+    """
+
+    def __init__(self, journal, idle_seconds=5, max_backoff_seconds=300, idle_interval_seconds=300, max_attempts=MAX_SYNC_ATTEMPTS):
+        self.journal = journal
+        self._thread, self._start_lock = None, threading.Lock()
+        self.idle_seconds, self.max_backoff_seconds = idle_seconds, max_backoff_seconds
+        self.idle_interval_seconds, self.max_attempts = idle_interval_seconds, max_attempts
+        self._flush_fn, self._idle_fn, self._accounts = None, None, None
+        self._idle_ran_at = time.monotonic()
+        self._wake = threading.Event()
+
+    def configure(self, flush_fn, idle_fn=None, accounts=None):
+        # `accounts`: colección viva de cuentas de Dropbox disponibles; solo se sincronizan sus lotes.
+        # Solo la primera configuración despierta al hilo para no romper la espera entre reintentos
+        first_time = self._flush_fn is None
+        self._flush_fn, self._idle_fn, self._accounts = flush_fn, idle_fn, accounts
+        if first_time: self._wake.set()
+        # El worker vive en una caché de Streamlit: un hilo muerto se reemplaza aquí, en el siguiente rerun
+        if self._thread is not None and not self._thread.is_alive():
+            logger.error("El hilo de sincronización del diario se detuvo; se vuelve a arrancar")
+            self.start()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name="journal-worker", daemon=True)
+                self._thread.start()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run_idle(self):
+        if self._idle_fn is None or time.monotonic() - self._idle_ran_at < self.idle_interval_seconds:
+            return
+        self._idle_ran_at = time.monotonic()
+        try:
+            self._idle_fn()
+        except Exception:
+            # La tarea registra sus propias fallas; el hilo sigue atendiendo el diario
+            pass
+
+    def notify(self):
+        self._wake.set()
+
+    def run(self):
+        journal_errors = 0
+        while True:
+            try:
+                self._step()
+                journal_errors = 0
+            except Exception:
+                # Falla del diario, no del lote: el lote sigue pendiente y se vuelve a intentar
+                # (sincronizar un lote dos veces no duplica filas)
+                logger.exception("Error del diario de guardados en el hilo de sincronización")
+                self._wake.wait(min(2 ** journal_errors, self.max_backoff_seconds))
+                journal_errors += 1
+
+    def _step(self):
+        self._wake.clear()
+        accounts = None if self._accounts is None else list(self._accounts)
+        batch = self.journal.next_pending(accounts) if self._flush_fn else None
+        if batch is None:
+            self._run_idle()
+            self._wake.wait(self.idle_seconds)
+            return
+        try:
+            note = self._flush_fn(batch)
+        except Exception as e:
+            final = isinstance(e, PermanentSyncError) or batch["attempts"] + 1 >= self.max_attempts
+            self.journal.mark_failed(batch["id"], e, final=final)
+            if not final: self._wake.wait(min(2 ** batch["attempts"], self.max_backoff_seconds))
+            return
+        self.journal.mark_synced(batch["id"], note or "")
@@ -0,0 +1,258 @@
+import json
+import os
+import re
+import threading
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+# --- ESPEJO LOCAL DEL LIBRO DE OPERACIONES ---
+# Copia columnar del libro en Parquet, particionada por mes (mes=AAAA-MM), para
+# consultar historial sin descargar la hoja completa. Cada sincronización solo
+# pide las filas posteriores a la última copiada y las agrega como un archivo
+# nuevo; las consultas leen los archivos con memory-map. La lectura de la hoja
+# la provee la aplicación.
+
+LEDGER_COLUMNS = ["folio", "fecha", "cliente", "tipo", "usd", "usdt", "comision", "comprobante"]
+SCHEMA = pa.schema([
+    ("folio", pa.string()), ("fecha", pa.timestamp("s")), ("cliente", pa.string()), ("tipo", pa.string()),
+    ("usd", pa.float64()), ("usdt", pa.float64()), ("comision", pa.float64()), ("comprobante", pa.string()),
+    # Número de fila en la hoja (base 1, el encabezado es la fila 1)
+    ("fila", pa.int64()),
+])
+PARTITIONING = ds.partitioning(pa.schema([("mes", pa.string())]), flavor="hive")
+# Con más archivos que esto en un mes, se combinan en uno solo
+MAX_PARTS_PER_MONTH = 24
+
+# Los nombres con "_" no los toma pyarrow como parte del dataset
+_STATE_FILE = "_estado.json"
+_PART_NAME = re.compile(r"parte-(\d+)-(\d+)\.parquet$")
+
+def _folio(row):
+    return str(row[0]).strip() if row else ""
+
+def _read_state(directory):
+    try:
+        with open(os.path.join(directory, _STATE_FILE), encoding="utf-8") as state_file:
+            state = json.load(state_file)
+        return state["fila_libro"], state["ultimo_folio"]
+    except (OSError, ValueError, KeyError):
+        # Sin estado el espejo empieza de cero: se copia el libro desde la fila 2
+        return 1, ""
+
+def _list_parts(directory):
+    # (mes, primera fila, última fila, ruta) de cada archivo del espejo
+    parts = []
+    for month in os.listdir(directory):
+        month_dir = os.path.join(directory, month)
+        if not month.startswith("mes=") or not os.path.isdir(month_dir): continue
+        for name in os.listdir(month_dir):
+            match = _PART_NAME.match(name)
+            if match: parts.append((month[4:], int(match.group(1)), int(match.group(2)), os.path.join(month_dir, name)))
+    return parts
+
+def _uncommitted(parts, ledger_row):
+    # Rutas posteriores al estado (sincronización en curso o interrumpida) o ya incluidas en una combinación
+    return {path for month, first, last, path in parts
+            if last > ledger_row or any(other_path != path and other_month == month and other_first <= first and last <= other_last
+                                        for other_month, other_first, other_last, other_path in parts)}
+
+def _condition(client=None, start=None, end=None, types=None):
+    condition = ds.field("fila") > 0
+    if client is not None:
+        condition &= ds.field("cliente") == str(client)
+    if start is not None:
+        start = pd.Timestamp(start)
+        # La partición por mes permite saltarse los archivos fuera del rango
+        condition &= (ds.field("mes") >= start.strftime("%Y-%m")) & (ds.field("fecha") >= pa.scalar(start.to_pydatetime(), pa.timestamp("s")))
+    if end is not None:
+        end = pd.Timestamp(end)
+        condition &= (ds.field("mes") <= end.strftime("%Y-%m")) & (ds.field("fecha") < pa.scalar(end.to_pydatetime(), pa.timestamp("s")))
+    if types:
+        condition &= ds.field("tipo").isin(list(types))
+    return condition
+
+def _to_frame(table, selected):
+    frame = table.sort_by("fila").to_pandas()
+    return frame[selected].reset_index(drop=True)
+
+def _numbers(values):
+    return pd.to_numeric(pd.Series(values, dtype=object).astype(str).str.replace(r"[$,]", "", regex=True), errors="coerce")
+
+def _dates(values):
+    # Leídas sin formato, las fechas llegan como número de serie de Sheets; las escritas como texto se interpretan
+    values = pd.Series(values, dtype=object)
+    serials = pd.to_numeric(values, errors="coerce")
+    dates = pd.to_datetime(serials, unit="D", origin="1899-12-30")
+    text = serials.isna() & values.astype(str).str.strip().ne("")
+    if text.any():
+        dates[text] = pd.to_datetime(values[text].astype(str), errors="coerce")
+    return dates.dt.round("s")
+
+def rows_to_table(rows, first_row):
+    """Tabla Arrow de filas del libro (listas como las regresa Sheets); `first_row` es la fila de la primera."""
+    rows = [(list(row) + [""] * len(LEDGER_COLUMNS))[:len(LEDGER_COLUMNS)] for row in rows]
+    frame = pd.DataFrame(rows, columns=LEDGER_COLUMNS, dtype=object)
+    frame["fila"] = range(first_row, first_row + len(frame))
+    # Filas vacías o sin folio (p. ej. borradas a mano) no se copian
+    frame = frame[frame["folio"].astype(str).str.strip().ne("")]
+    for column in ("folio", "cliente", "tipo", "comprobante"):
+        frame[column] = frame[column].astype(str)
+    for column in ("usd", "usdt", "comision"):
+        frame[column] = _numbers(frame[column]).to_numpy()
+    frame["fecha"] = _dates(frame["fecha"]).to_numpy()
+    return pa.Table.from_pandas(frame, schema=SCHEMA, preserve_index=False)
+
+class LedgerMirror:
+    """Espejo en Parquet del libro en `directory`; seguro entre hilos de un mismo proceso.
+
+    Un solo proceso debe sincronizar un mismo directorio: el estado (_estado.json) se lee
+    al crearse el espejo y dos procesos copiarían las mismas filas dos veces.
+    """
+
+    def __init__(self, directory, max_parts_per_month=MAX_PARTS_PER_MONTH):
+        self.directory, self.max_parts_per_month = directory, max_parts_per_month
+        self._filesystem = fs.LocalFileSystem(use_mmap=True)
+        # _lock ordena las sincronizaciones (incluida la lectura de la hoja); _files_lock protege
+        # los archivos: una consulta no lee mientras se agregan, combinan o borran partes
+        self._lock, self._files_lock = threading.Lock(), threading.Lock()
+        self._dataset = None
+        # time.monotonic() de la última sincronización en este proceso
+        self.synced_at = None
+        os.makedirs(directory, exist_ok=True)
+        self.ledger_row, self.last_folio = _read_state(directory)
+        self._discard_uncommitted()
+
+    # --- Estado en disco ---
+    def _save_state(self):
+        path = os.path.join(self.directory, _STATE_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as state_file:
+            json.dump({"fila_libro": self.ledger_row, "ultimo_folio": self.last_folio}, state_file)
+        os.replace(path + ".tmp", path)
+
+    def _parts(self):
+        return _list_parts(self.directory)
+
+    def _discard_uncommitted(self):
+        # Una sincronización o combinación interrumpida deja archivos posteriores al estado o ya incluidos en otro
+        for path in _uncommitted(self._parts(), self.ledger_row):
+            os.remove(path)
+
+    def _reset(self):
+        for _, _, _, path in self._parts():
+            os.remove(path)
+        self.ledger_row, self.last_folio = 1, ""
+        self._save_state()
+
+    # --- Sincronización ---
+    def sync(self, read_rows_after, incomplete=None):
+        """Copia las filas nuevas del libro; `read_rows_after(fila)` regresa las filas posteriores a `fila` (base 1).
+
+        Se pide también la última fila copiada: si su folio ya no coincide (el libro se
+        reordenó o se borraron filas) el espejo se reconstruye completo. Los archivos no
+        se reescriben: con `incomplete(fila)` la copia se detiene antes de la primera fila
+        que todavía va a cambiar (p. ej. sin su link) y sigue desde ella la próxima vez.
+        Regresa el número de filas copiadas.
+        """
+        with self._lock:
+            if self.ledger_row > 1:
+                rows = read_rows_after(self.ledger_row - 1)
+                if rows and _folio(rows[0]) == self.last_folio:
+                    rows = rows[1:]
+                else:
+                    with self._files_lock:
+                        self._reset()
+                        self._dataset = None
+                    rows = read_rows_after(self.ledger_row)
+            else:
+                rows = read_rows_after(self.ledger_row)
+            self.synced_at = time.monotonic()
+            if incomplete is not None:
+                rows = rows[:next((position for position, row in enumerate(rows) if incomplete(row)), len(rows))]
+            if not rows:
+                return 0
+            first_row = self.ledger_row + 1
+            table = rows_to_table(rows, first_row)
+            last_row = first_row + len(rows) - 1
+            with self._files_lock:
+                if table.num_rows:
+                    months = pc.strftime(table["fecha"], format="%Y-%m").fill_null("sin-fecha")
+                    for month in pc.unique(months).to_pylist():
+                        month_dir = os.path.join(self.directory, f"mes={month}")
+                        os.makedirs(month_dir, exist_ok=True)
+                        pq.write_table(table.filter(pc.equal(months, month)), os.path.join(month_dir, f"parte-{first_row:09d}-{last_row:09d}.parquet"))
+                self.ledger_row = last_row
+                self.last_folio = _folio(rows[-1])
+                self._save_state()
+                self._compact()
+                self._dataset = None
+            return len(rows)
+
+    def _compact(self):
+        by_month = {}
+        for month, first, last, path in self._parts():
+            by_month.setdefault(month, []).append((first, last, path))
+        for parts in by_month.values():
+            if len(parts) <= self.max_parts_per_month: continue
+            parts.sort()
+            month_dir = os.path.dirname(parts[0][2])
+            merged = os.path.join(month_dir, f"parte-{parts[0][0]:09d}-{parts[-1][1]:09d}.parquet")
+            table = pa.concat_tables([pq.read_table(path, memory_map=True) for _, _, path in parts])
+            temporary = os.path.join(month_dir, "_" + os.path.basename(merged))
+            pq.write_table(table, temporary)
+            os.replace(temporary, merged)
+            # Si el proceso se interrumpe aquí, _discard_uncommitted elimina los archivos ya incluidos
+            for _, _, path in parts:
+                if path != merged: os.remove(path)
+
+    # --- Consultas ---
+    def _get_dataset(self):
+        if self._dataset is None:
+            self._dataset = ds.dataset(self.directory, format="parquet", partitioning=PARTITIONING, filesystem=self._filesystem, schema=SCHEMA.append(pa.field("mes", pa.string())))
+        return self._dataset
+
+    def query(self, client=None, start=None, end=None, types=None, columns=None):
+        """Operaciones del espejo como DataFrame, en orden del libro.
+
+        `client` alias exacto; `start` (incluida) y `end` (excluida) fechas o fecha-hora;
+        `types` etiquetas del libro ("Compra (Das USD)", ...); `columns` subconjunto de columnas.
+        """
+        condition = _condition(client, start, end, types)
+        selected = list(columns or SCHEMA.names)
+        # El escaneo completo va bajo el candado: una combinación concurrente borraría partes a medio leer
+        with self._files_lock:
+            table = self._get_dataset().to_table(columns=sorted(set(selected) | {"fila"}), filter=condition)
+        return _to_frame(table, selected)
+
+class MirrorReader:
+    """Lectura del espejo desde otro proceso (p. ej. el reporte de cierre): nunca escribe ni borra archivos.
+
+    Cada consulta toma solo las partes confirmadas en _estado.json y no incluidas en una
+    combinación; si la app borra una parte a media lectura, la consulta se repite.
+    """
+
+    def __init__(self, directory, attempts=3):
+        self.directory, self.attempts = directory, attempts
+        self._filesystem = fs.LocalFileSystem(use_mmap=True)
+
+    def query(self, client=None, start=None, end=None, types=None, columns=None):
+        """Mismos filtros y resultado que LedgerMirror.query."""
+        selected = list(columns or SCHEMA.names)
+        for attempt in range(self.attempts):
+            ledger_row, _ = _read_state(self.directory)
+            parts = _list_parts(self.directory) if os.path.isdir(self.directory) else []
+            paths = sorted(path for path in {part[3] for part in parts} - _uncommitted(parts, ledger_row))
+            if not paths:
+                return pd.DataFrame({name: pd.Series(dtype=SCHEMA.field(name).type.to_pandas_dtype()) for name in selected})
+            try:
+                dataset = ds.dataset(paths, format="parquet", partitioning=PARTITIONING, partition_base_dir=self.directory, filesystem=self._filesystem, schema=SCHEMA.append(pa.field("mes", pa.string())))
+                table = dataset.to_table(columns=sorted(set(selected) | {"fila"}), filter=_condition(client, start, end, types))
+            except FileNotFoundError:
+                if attempt + 1 == self.attempts: raise
+                continue
+            return _to_frame(table, selected)
@@ -0,0 +1,112 @@
+import io
+import unicodedata
+import numpy as np
+import pandas as pd
+
+import motor_conversion
+
+# --- IMPORTACIÓN MASIVA DE OPERACIONES ---
+# Lee un CSV/XLSX con una operación por fila, lo valida y calcula todas las
+# conversiones en una sola pasada del motor. Columnas:
+#   tipo      compra | venta | pago | recibo                     (obligatoria)
+#   monto     monto capturado: USD o USDT según el modo          (obligatoria)
+#   modo      "USD ➔ USDT" / "USDT ➔ USD" (o "usd" / "usdt")     (opcional, compra/venta)
+#   comision  porcentaje                                          (opcional, compra/venta)
+# Sin modo o comisión se usa la configuración de la sección 1 de la app.
+
+REQUIRED_COLUMNS = ("tipo", "monto")
+# Filas por bloque al leer un CSV
+CSV_CHUNK_ROWS = 5000
+
+OPERATION_TYPES = {
+    "compra": "Compra", "venta": "Venta",
+    "pago": "Ajuste-Pago", "ajuste pago": "Ajuste-Pago", "ajuste-pago": "Ajuste-Pago",
+    "recibo": "Ajuste-Recibo", "ajuste recibo": "Ajuste-Recibo", "ajuste-recibo": "Ajuste-Recibo",
+}
+
+def _normalize(text):
+    # "  Comisión " -> "comision"
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii")
+    return text.strip().lower()
+
+def read_operations_file(data, file_name):
+    """Lee los bytes de un CSV o XLSX y regresa un DataFrame de texto con columnas normalizadas y la fila de origen."""
+    if file_name.lower().endswith((".xlsx", ".xlsm")):
+        # Requiere openpyxl; pandas lanza ImportError con instrucciones si falta
+        raw = pd.read_excel(io.BytesIO(data), dtype=str)
+    else:
+        chunks = pd.read_csv(io.BytesIO(data), dtype=str, sep=None, engine="python", chunksize=CSV_CHUNK_ROWS, encoding="utf-8-sig")
+        raw = pd.concat(list(chunks), ignore_index=True)
+    raw.columns = [_normalize(column) for column in raw.columns]
+    missing = [column for column in REQUIRED_COLUMNS if column not in raw.columns]
+    if missing:
+        raise ValueError(f"Faltan columnas obligatorias: {', '.join(missing)}")
+    # Fila 1 = encabezados, igual que en la hoja de cálculo de origen
+    raw.insert(0, "fila", np.arange(2, len(raw) + 2))
+    return raw.fillna("")
+
+def _parse_modes(values, default_mode):
+    normalized = values.map(_normalize)
+    modes = np.full(len(values), default_mode, dtype=object)
+    modes[normalized.str.startswith("usdt").to_numpy()] = motor_conversion.MODE_USDT_TO_USD
+    modes[(normalized.str.startswith("usd") & ~normalized.str.startswith("usdt")).to_numpy()] = motor_conversion.MODE_USD_TO_USDT
+    invalid = (normalized != "") & ~normalized.str.startswith("usd")
+    return modes, invalid.to_numpy()
+
+def build_import_batch(raw, comision_compra, comision_venta, mode_compra, mode_venta):
+    """Valida y calcula un lote importado.
+
+    Regresa (operaciones, errores). `operaciones` tiene una fila por operación válida con
+    las columnas fila, tipo, modo, comision, monto, usd y usdt (usd vacío en ajustes);
+    `errores` lista fila y motivo de cada fila rechazada.
+    """
+    types = raw["tipo"].map(lambda value: OPERATION_TYPES.get(_normalize(value), ""))
+    amounts = pd.to_numeric(raw["monto"].str.replace(r"[$,\s]", "", regex=True), errors="coerce")
+    is_compra, is_venta = (types == "Compra").to_numpy(), (types == "Venta").to_numpy()
+    is_trade = is_compra | is_venta
+
+    default_modes = np.where(is_compra, mode_compra, mode_venta)
+    modes = default_modes.astype(object)
+    invalid_mode = np.zeros(len(raw), dtype=bool)
+    if "modo" in raw.columns:
+        for default_mode, mask in ((mode_compra, is_compra), (mode_venta, ~is_compra)):
+            parsed, invalid = _parse_modes(raw["modo"], default_mode)
+            modes[mask] = parsed[mask]
+            invalid_mode |= invalid & mask & is_trade
+
+    commissions = np.where(is_compra, comision_compra, comision_venta).astype(np.float64)
+    invalid_commission = np.zeros(len(raw), dtype=bool)
+    if "comision" in raw.columns:
+        given = raw["comision"].str.replace(r"[%\s]", "", regex=True)
+        parsed = pd.to_numeric(given, errors="coerce").to_numpy()
+        provided = (given != "").to_numpy()
+        invalid_commission = provided & is_trade & (np.isnan(parsed) | (parsed < 0))
+        commissions = np.where(provided & ~np.isnan(parsed), parsed, commissions)
+
+    reasons = pd.Series("", index=raw.index)
+    reasons[(types == "").to_numpy()] = "tipo no reconocido (use compra, venta, pago o recibo)"
+    reasons[(reasons == "") & ~(amounts > 0)] = "monto inválido o no mayor a cero"
+    reasons[(reasons == "") & invalid_mode] = "modo inválido (use USD ➔ USDT o USDT ➔ USD)"
+    reasons[(reasons == "") & invalid_commission] = "comisión inválida"
+    valid = (reasons == "").to_numpy()
+
+    usd_cents, usdt_cents = motor_conversion.convert_batch(amounts.fillna(0).to_numpy(), modes, commissions)
+    adjustment_cents = motor_conversion.to_cents(amounts.fillna(0).to_numpy())
+    operations = pd.DataFrame({
+        "fila": raw["fila"].to_numpy(),
+        "tipo": types.to_numpy(),
+        "modo": np.where(is_trade, modes, ""),
+        "comision": np.where(is_trade, commissions, np.nan),
+        "monto": amounts.to_numpy(),
+        "usd": np.where(is_trade, motor_conversion.from_cents(usd_cents), np.nan),
+        "usdt": motor_conversion.from_cents(np.where(is_trade, usdt_cents, adjustment_cents)),
+    })[valid].reset_index(drop=True)
+    errors = pd.DataFrame({"fila": raw["fila"].to_numpy(), "motivo": reasons.to_numpy()})[~valid].reset_index(drop=True)
+    return operations, errors
+
+def import_totals(operations, balance_inicial):
+    """Totales de la sección 4 para un lote importado (mismas reglas que la captura manual)."""
+    by_type = {kind: motor_conversion.to_cents(operations.loc[operations["tipo"] == kind, "usdt"].to_numpy()) for kind in ("Compra", "Venta")}
+    pagos = operations.loc[operations["tipo"] == "Ajuste-Pago", "usdt"].to_numpy()
+    recibos = operations.loc[operations["tipo"] == "Ajuste-Recibo", "usdt"].to_numpy()
+    return motor_conversion.closing_totals(by_type["Compra"], by_type["Venta"], pagos, recibos, balance_inicial)
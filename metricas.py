@@ -0,0 +1,123 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+# --- MÉTRICAS DEL GUARDADO ---
+# Tiempos por etapa de cada guardado (y de cada sincronización en segundo
+# plano) escritos como JSON-lines en un archivo local que rota por tamaño.
+# Las etapas sin punto son pasos del flujo ("folio", "subidas"); las que llevan
+# punto son llamadas externas ("dropbox.files_upload", "sheets.batch_update").
+
+METRICS_PATH = "metricas_guardado.jsonl"
+METRICS_MAX_BYTES = 5 * 1024 * 1024
+METRICS_BACKUP_COUNT = 3
+
+_current = contextvars.ContextVar("metricas_trace", default=None)
+_totals = Counter()
+_totals_lock = threading.Lock()
+_logger = None
+_logger_lock = threading.Lock()
+
+def _metrics_logger():
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            logger = logging.getLogger("metricas_guardado")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            handler = RotatingFileHandler(METRICS_PATH, maxBytes=METRICS_MAX_BYTES, backupCount=METRICS_BACKUP_COUNT, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            _logger = logger
+    return _logger
+
+class Trace:
+    """Acumula milisegundos por etapa y contadores de un guardado; seguro entre hilos."""
+
+    def __init__(self, kind, **labels):
+        self.kind, self.labels = kind, labels
+        self.started = datetime.now()
+        self._t0 = time.perf_counter()
+        self.stages, self.counters = Counter(), Counter()
+        self.ok = True
+        self._lock = threading.Lock()
+
+    def add(self, stage, elapsed_ms):
+        with self._lock:
+            self.stages[stage] += elapsed_ms
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def record(self):
+        return {
+            "tipo": self.kind, "inicio": self.started.isoformat(timespec="seconds"), "ok": self.ok,
+            "total_ms": round((time.perf_counter() - self._t0) * 1000, 1), "etiquetas": self.labels,
+            "etapas": {stage: round(ms, 1) for stage, ms in self.stages.items()}, "contadores": dict(self.counters),
+        }
+
+@contextmanager
+def trace(kind, **labels):
+    """Registra un guardado completo; las llamadas a `span` y `count` dentro de él se le asignan."""
+    active = Trace(kind, **labels)
+    token = _current.set(active)
+    try:
+        yield active
+    except BaseException:
+        active.ok = False
+        raise
+    finally:
+        _current.reset(token)
+        _metrics_logger().info(json.dumps(active.record(), ensure_ascii=False))
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count(f"{stage}.fallas")
+        raise
+    finally:
+        active = _current.get()
+        if active is not None:
+            active.add(stage, (time.perf_counter() - start) * 1000)
+
+def count(name, amount=1):
+    # Además del guardado activo, se acumula en los totales del proceso
+    with _totals_lock:
+        _totals[name] += amount
+    active = _current.get()
+    if active is not None:
+        active.count(name, amount)
+
+def totals():
+    with _totals_lock:
+        return dict(_totals)
+
+def submit(executor, fn, *args):
+    # Los hilos de un executor no heredan el contexto: cada tarea corre en su propia copia
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def read_recent(limit=20, tail_bytes=256 * 1024):
+    """Últimos `limit` registros del archivo de métricas, del más antiguo al más reciente."""
+    if not os.path.exists(METRICS_PATH):
+        return []
+    with open(METRICS_PATH, "rb") as metrics_file:
+        metrics_file.seek(max(0, os.path.getsize(METRICS_PATH) - tail_bytes))
+        lines = metrics_file.read().decode("utf-8", errors="ignore").splitlines()
+    records = []
+    for line in lines[-limit:]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
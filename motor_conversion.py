@@ -0,0 +1,82 @@
+import sys
+import time
+import numpy as np
+
+# --- MOTOR DE CONVERSIÓN USD/USDT ---
+# Cálculo sin interfaz, compartido por la app de Streamlit, las importaciones
+# masivas y cualquier proceso sin UI. Todo se calcula en centavos enteros
+# (int64) para que redondeos y totales sean exactos; las comisiones se manejan
+# en centésimas de punto porcentual (3.50 % -> 350).
+
+MODE_USD_TO_USDT = "USD ➔ USDT"
+MODE_USDT_TO_USD = "USDT ➔ USD"
+
+# 100 % expresado en centésimas de punto porcentual
+FULL_COMMISSION = 10000
+
+def to_cents(amounts):
+    return np.rint(np.asarray(amounts, dtype=np.float64) * 100).astype(np.int64)
+
+def from_cents(cents):
+    return np.asarray(cents, dtype=np.int64) / 100
+
+def _round_div(numerator, denominator):
+    # División entera redondeando la mitad hacia arriba (montos no negativos)
+    return (2 * numerator + denominator) // (2 * denominator)
+
+def convert_batch(amounts, modes, commissions):
+    """Convierte un lote de montos capturados y regresa (usd_centavos, usdt_centavos).
+
+    `amounts` son los montos tal como se capturan: USD en modo "USD ➔ USDT" y USDT
+    en modo "USDT ➔ USD". `modes` y `commissions` (en %) pueden ser un valor para
+    todo el lote o un arreglo por fila.
+
+    - USD ➔ USDT: usdt = usd * (1 - comisión)
+    - USDT ➔ USD: usd = usdt / (1 - comisión); 0 si la comisión es de 100 % o más
+    """
+    captured = to_cents(amounts)
+    modes = np.broadcast_to(np.asarray(modes), captured.shape)
+    commission_bp = np.broadcast_to(np.rint(np.asarray(commissions, dtype=np.float64) * 100).astype(np.int64), captured.shape)
+    net_factor = FULL_COMMISSION - commission_bp
+    usd_to_usdt = modes == MODE_USD_TO_USDT
+
+    converted_usdt = _round_div(captured * np.maximum(net_factor, 0), FULL_COMMISSION)
+    safe_factor = np.where(net_factor > 0, net_factor, 1)
+    converted_usd = np.where(net_factor > 0, _round_div(captured * FULL_COMMISSION, safe_factor), 0)
+
+    usd_cents = np.where(usd_to_usdt, captured, converted_usd)
+    usdt_cents = np.where(usd_to_usdt, converted_usdt, captured)
+    return usd_cents, usdt_cents
+
+def closing_totals(usdt_recibidos_compra, usdt_dados_venta, pagos, recibos, balance_inicial):
+    """Totales de la sección 4 a partir de centavos de operaciones y montos de ajustes.
+
+    Regresa un dict en unidades (float) con los totales consolidados, el cambio neto y
+    el saldo final del cliente (positivo = el cliente te debe).
+    """
+    recibidos = int(np.sum(usdt_recibidos_compra)) + int(np.sum(to_cents(pagos)))
+    entregados = int(np.sum(usdt_dados_venta)) + int(np.sum(to_cents(recibos)))
+    cambio_neto = recibidos - entregados
+    balance_final = int(to_cents(balance_inicial)) + cambio_neto
+    return {
+        "total_usdt_recibidos": recibidos / 100,
+        "total_usdt_entregados": entregados / 100,
+        "cambio_neto_usdt": cambio_neto / 100,
+        "balance_final_usdt": balance_final / 100,
+    }
+
+def benchmark(rows=1_000_000, seed=0):
+    # Mide convert_batch + closing_totals con montos, modos y comisiones aleatorios
+    rng = np.random.default_rng(seed)
+    amounts = rng.uniform(0, 50_000, rows).round(2)
+    modes = np.where(rng.random(rows) < 0.5, MODE_USD_TO_USDT, MODE_USDT_TO_USD)
+    commissions = rng.choice([3.0, 3.5, 4.0, 4.5], rows)
+    start = time.perf_counter()
+    usd, usdt = convert_batch(amounts, modes, commissions)
+    closing_totals(usdt, usdt, [], [], 0.0)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    elapsed = benchmark(rows)
+    print(f"{rows:,} filas en {elapsed * 1000:,.1f} ms ({rows / elapsed:,.0f} filas/s)")
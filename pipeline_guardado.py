@@ -0,0 +1,84 @@
+import asyncio
+
+import metricas
+
+# --- GRAFO DE ETAPAS DEL GUARDADO ---
+# Un guardado se describe como etapas con dependencias explícitas. Cada etapa
+# es una función bloqueante (los SDK de Sheets y Dropbox no son asíncronos)
+# que corre en un hilo en cuanto terminan las etapas de las que depende, de
+# modo que las llamadas independientes se traslapan y el guardado tarda lo que
+# la cadena más lenta, no la suma de todas. La concurrencia se limita por grupo
+# (p. ej. llamadas a Dropbox) y la primera falla cancela lo que no ha empezado.
+
+class Stage:
+    """Etapa `name`: `fn(*resultados de after)` corre en un hilo; `group` limita cuántas del mismo grupo corren a la vez."""
+
+    def __init__(self, name, fn, after=(), group=None, span=None):
+        self.name, self.fn, self.after, self.group = name, fn, tuple(after), group
+        # Nombre en las métricas; varias etapas pueden sumar al mismo ("subidas")
+        self.span = span or name
+
+def _check_graph(stages):
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError(f"Etapa repetida: {stage.name}")
+        by_name[stage.name] = stage
+    visiting, done = set(), set()
+
+    def visit(name, path):
+        if name in done: return
+        if name not in by_name:
+            raise ValueError(f"La etapa {path[-1]} depende de {name}, que no existe")
+        if name in visiting:
+            raise ValueError(f"Dependencia circular: {' -> '.join(path + [name])}")
+        visiting.add(name)
+        for dependency in by_name[name].after:
+            visit(dependency, path + [name])
+        visiting.discard(name)
+        done.add(name)
+
+    for name in by_name:
+        visit(name, [])
+
+async def _run_graph(stages, limits):
+    semaphores = {group: asyncio.Semaphore(limit) for group, limit in limits.items()}
+    tasks = {}
+
+    async def run(stage):
+        args = [await tasks[dependency] for dependency in stage.after]
+        semaphore = semaphores.get(stage.group)
+        if semaphore is None:
+            return await asyncio.to_thread(_timed, stage, args)
+        async with semaphore:
+            return await asyncio.to_thread(_timed, stage, args)
+
+    # Todas las tareas existen antes de que la primera espere a sus dependencias
+    for stage in stages:
+        tasks[stage.name] = asyncio.ensure_future(run(stage))
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except BaseException:
+        # Las etapas pendientes se cancelan; las que ya corren en un hilo terminan y su resultado se descarta
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+    return dict(zip(tasks, results))
+
+def _timed(stage, args):
+    # asyncio.to_thread copia el contexto: el span queda en la traza activa del guardado
+    with metricas.span(stage.span):
+        return stage.fn(*args)
+
+def run_stages(stages, limits=None):
+    """Ejecuta las etapas respetando sus dependencias; regresa dict nombre -> resultado.
+
+    `limits` es grupo -> máximo de etapas simultáneas de ese grupo. Si una etapa
+    falla, las que no han empezado se cancelan y se propaga su excepción.
+    """
+    stages = list(stages)
+    _check_graph(stages)
+    if not stages:
+        return {}
+    return asyncio.run(_run_graph(stages, limits or {}))
@@ -0,0 +1,68 @@
+from collections import Counter
+
+import carga_diferida
+
+# Solo ledger_deltas los usa; las constantes se leen al arrancar la app
+pd = carga_diferida.lazy_module("pandas")
+motor_conversion = carga_diferida.lazy_module("motor_conversion")
+
+# --- SALDOS DERIVADOS DEL LIBRO ---
+# El saldo de un cliente es un checkpoint (saldo hasta cierta fila del libro de
+# operaciones) más el efecto de las filas posteriores. Aquí solo está el
+# cálculo, en centavos enteros; dónde se guardan checkpoint y libro lo decide
+# la aplicación.
+
+# Etiqueta de cada tipo de operación en la columna "Tipo" del libro
+OPERATION_LABELS = {"Compra": "Compra (Das USD)", "Venta": "Venta (Recibes USD)", "Ajuste-Pago": "Ajuste: Pago Cliente", "Ajuste-Recibo": "Ajuste: Recibo Tuyo"}
+
+# Efecto de cada tipo de operación en el saldo (positivo = el cliente te debe), igual que closing_totals
+SIGNS_BY_TYPE = {"Compra": 1, "Ajuste-Pago": 1, "Venta": -1, "Ajuste-Recibo": -1}
+
+# Posición de las columnas en una fila del libro: [folio, fecha, cliente, tipo, usd, usdt, comisión, comprobante]
+FOLIO, CLIENT, TYPE, USDT = 0, 2, 3, 5
+
+def ledger_deltas(rows, signs_by_label):
+    """Cambio de saldo por cliente (centavos) de un conjunto de filas del libro; filas de otro tipo se ignoran."""
+    rows = [row for row in rows if len(row) > USDT and row[TYPE] in signs_by_label]
+    if not rows:
+        return Counter()
+    frame = pd.DataFrame({"cliente": [row[CLIENT] for row in rows], "tipo": [row[TYPE] for row in rows], "usdt": [row[USDT] for row in rows]})
+    usdt = pd.to_numeric(frame["usdt"].astype(str).str.replace(r"[$,]", "", regex=True), errors="coerce").fillna(0)
+    frame["centavos"] = motor_conversion.to_cents(usdt.to_numpy()) * frame["tipo"].map(signs_by_label).to_numpy()
+    return Counter({client: int(cents) for client, cents in frame.groupby("cliente")["centavos"].sum().items()})
+
+def row_folio(row):
+    # Folio de una fila del libro; "" para una fila vacía
+    return str(row[FOLIO]).strip() if row else ""
+
+class Checkpoint:
+    """Saldos en centavos de todos los clientes hasta la fila `ledger_row` del libro (incluida).
+
+    `last_folio` es el folio de esa fila: si ya no está ahí, el libro cambió (filas borradas,
+    insertadas u ordenadas) y el checkpoint no sirve. `opening` son los saldos antes de la
+    fila 2 (None si no se conocen), para reconstruir desde el libro completo.
+    """
+
+    def __init__(self, ledger_row, last_folio, balances, opening=None):
+        self.ledger_row, self.last_folio = ledger_row, last_folio
+        self.balances = Counter(balances)
+        self.opening = None if opening is None else Counter(opening)
+
+    def advance(self, rows, signs_by_label):
+        # Nuevo checkpoint con las filas que siguen a este; el original no cambia
+        # Counter.update suma y conserva saldos cero o negativos (el operador + los descartaría)
+        if not rows:
+            return Checkpoint(self.ledger_row, self.last_folio, self.balances, self.opening)
+        balances = Counter(self.balances)
+        balances.update(ledger_deltas(rows, signs_by_label))
+        return Checkpoint(self.ledger_row + len(rows), row_folio(rows[-1]), balances, self.opening)
+
+def rebuild(opening, rows, signs_by_label):
+    """Checkpoint desde la fila 2 con los saldos iniciales `opening` y todas las filas del libro `rows`."""
+    return Checkpoint(1, "", opening, opening).advance(rows, signs_by_label)
+
+def opening_balances(balances, rows, signs_by_label):
+    """Saldos antes de la fila 2 dados los saldos `balances` después de las filas `rows` (desde la fila 2)."""
+    opening = Counter(balances)
+    opening.subtract(ledger_deltas(rows, signs_by_label))
+    return opening
@@ -0,0 +1,41 @@
+import hashlib
+import threading
+import time
+
+# --- SALUD DE LAS CONEXIONES ---
+# Validar un token con una llamada de red en cada rerun de Streamlit agrega una
+# ida y vuelta por tecla. La validación exitosa de cada credencial se recuerda
+# durante un TTL y se descarta en cuanto una llamada real falla por
+# autenticación, de modo que la siguiente interacción la vuelve a comprobar.
+
+VALIDATION_TTL_SECONDS = 15 * 60
+
+def credential_key(service, credential):
+    # El token no se guarda en claro como llave
+    return f"{service}:{hashlib.sha256(str(credential).encode('utf-8')).hexdigest()[:16]}"
+
+class ConnectionHealth:
+    """Validaciones recientes por credencial; segura entre hilos (la usa también el hilo del diario)."""
+
+    def __init__(self, ttl_seconds=VALIDATION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._validated = {}
+        self._lock = threading.Lock()
+
+    def ensure(self, key, validate):
+        """Llama `validate()` solo si `key` no tiene una validación vigente; su excepción se propaga.
+
+        Regresa True si hubo que validar (llamada de red) y False si se usó la validación guardada.
+        """
+        with self._lock:
+            validated_at = self._validated.get(key)
+        if validated_at is not None and time.monotonic() - validated_at < self.ttl_seconds:
+            return False
+        validate()
+        with self._lock:
+            self._validated[key] = time.monotonic()
+        return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._validated.pop(key, None)
@@ -0,0 +1,349 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import requests
+
+import calculadora_cambio_USD as app
+import importacion
+import metricas
+import motor_conversion
+from diario_guardado import SaveJournal, JournalWorker, StoredReceipt, STATUS_SYNCED, STATUS_FAILED
+
+# --- API SIN INTERFAZ ---
+# Cotización y registro de lotes de operaciones para integraciones (bot,
+# scripts) con las mismas funciones que la app: motor de conversión, reserva
+# de folios, diario local y sincronización en segundo plano con Dropbox y
+# Sheets. Se usa como módulo (OperationsService), como servicio HTTP local o
+# desde la línea de comandos:
+#
+#   python servicio_operaciones.py cotizar lote.json
+#   python servicio_operaciones.py registrar lote.json --esperar
+#   python servicio_operaciones.py servir --puerto 8765
+#   python servicio_operaciones.py benchmark --lotes 200 --concurrencia 16
+#
+# Un lote es un objeto JSON (o una lista de ellos):
+#   {"cliente": "Ana", "comision_compra": 3.5, "comision_venta": 4.5,
+#    "modo_compra": "usd", "modo_venta": "usd",
+#    "operaciones": [{"tipo": "compra", "monto": 1000, "modo": "usdt", "comision": 3.5,
+#                     "comprobante": {"nombre": "recibo.jpg", "base64": "..."}}]}
+# Solo "operaciones" (y "cliente" para registrar) es obligatorio; tipo, monto, modo y
+# comisión se validan igual que en la importación masiva.
+
+DEFAULT_HOST, DEFAULT_PORT = "127.0.0.1", 8765
+# Fracción de la cuota de Sheets de la cuenta de servicio para este proceso; el resto queda para la app (ver cuota_sheets)
+SERVICE_QUOTA_SHARE = 0.25
+# Diario propio del servicio: dos procesos no deben vaciar el mismo diario
+SERVICE_JOURNAL_PATH = "diario_servicio.sqlite3"
+# Mismos valores por omisión que la sección 1 de la app
+DEFAULT_COMISION_COMPRA, DEFAULT_COMISION_VENTA = 3.50, 4.50
+SYNC_WAIT_SECONDS = 60
+SYNC_POLL_SECONDS = 0.2
+
+class ClientNotFound(LookupError):
+    pass
+
+def _mode(value):
+    # "usdt", "USDT ➔ USD" -> modo USDT; cualquier otro valor o sin valor -> USD
+    return motor_conversion.MODE_USDT_TO_USD if str(value or "").strip().lower().startswith("usdt") else motor_conversion.MODE_USD_TO_USDT
+
+def _json_safe(frame):
+    # NaN no es JSON válido
+    return frame.astype(object).where(frame.notna(), None).to_dict(orient="records")
+
+def parse_batch(payload):
+    """(raw, configuración) de un lote JSON; raw tiene el formato de importacion.read_operations_file."""
+    operations = payload.get("operaciones")
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("El lote debe incluir una lista 'operaciones' con al menos una operación.")
+    raw = pd.DataFrame([{column: "" if op.get(column) is None else str(op.get(column)) for column in ("tipo", "monto", "modo", "comision")} for op in operations])
+    # "fila" es la posición de la operación en el lote, base 1
+    raw.insert(0, "fila", np.arange(1, len(raw) + 1))
+    settings = {
+        "comision_compra": float(payload.get("comision_compra", DEFAULT_COMISION_COMPRA)),
+        "comision_venta": float(payload.get("comision_venta", DEFAULT_COMISION_VENTA)),
+        "mode_compra": _mode(payload.get("modo_compra")), "mode_venta": _mode(payload.get("modo_venta")),
+    }
+    return raw, settings
+
+def _receipts(payload):
+    # Posición (base 1) -> StoredReceipt de los comprobantes en base64
+    receipts = {}
+    for position, op in enumerate(payload["operaciones"], start=1):
+        receipt = op.get("comprobante")
+        if not receipt: continue
+        try:
+            receipts[position] = StoredReceipt(str(receipt["nombre"]), base64.b64decode(receipt["base64"], validate=True))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Operación {position}: el comprobante debe tener 'nombre' y 'base64' válidos.") from e
+    return receipts
+
+class OperationsService:
+    """Cotiza y registra lotes sin Streamlit; seguro entre hilos (un servidor HTTP atiende peticiones en paralelo).
+
+    Los lotes registrados quedan en un diario SQLite propio y un JournalWorker los
+    sincroniza, igual que en la app; `register(..., wait=True)` espera a que su lote
+    se sincronice para regresar los links de los comprobantes.
+    """
+
+    def __init__(self, gsheet_client, dbx_client, spreadsheet_id, sheet_tab_name, journal_path=SERVICE_JOURNAL_PATH):
+        self.gsheet_client, self.dbx_client = gsheet_client, dbx_client
+        self.spreadsheet_id, self.sheet_tab_name = spreadsheet_id, sheet_tab_name
+        self.journal = SaveJournal(journal_path)
+        self.worker = JournalWorker(self.journal, idle_interval_seconds=app.BALANCE_VERIFY_SECONDS)
+        # Un solo token de Dropbox para todo el servicio; flush_with_revalidation marca como fallidos los lotes que Sheets rechaza
+        self.worker.configure(
+            partial(app.flush_with_revalidation, None, {}, partial(app.flush_journal_batch, gsheet_client, dbx_client, spreadsheet_id, sheet_tab_name, self.journal)),
+            # Sin el espejo del libro: su directorio es de la app (LedgerMirror solo coordina hilos de un proceso) y el servicio no lo consulta
+            idle_fn=partial(app.verify_balances, gsheet_client, spreadsheet_id, sheet_tab_name),
+        )
+        self.worker.start()
+
+    def client_balance(self, client_alias):
+        client_row = app.find_client(self.gsheet_client, self.spreadsheet_id, client_alias)
+        if client_row is None:
+            raise ClientNotFound(f"No existe el cliente '{client_alias}' en la hoja Clientes.")
+        return app.get_client_balance(self.gsheet_client, self.spreadsheet_id, self.sheet_tab_name, self.journal, client_alias, float(client_row['Saldo USDT']))
+
+    def quote(self, payload):
+        """Conversión de cada operación y, si el lote trae cliente, su saldo final; no escribe nada."""
+        raw, settings = parse_batch(payload)
+        operations, errors = importacion.build_import_batch(raw, **settings)
+        result = {"operaciones": _json_safe(operations), "errores": _json_safe(errors)}
+        if payload.get("cliente"):
+            balance = self.client_balance(payload["cliente"])
+            result.update({"saldo_inicial_usdt": balance, **importacion.import_totals(operations, balance)})
+        return result
+
+    def register(self, payload, wait=False, timeout=SYNC_WAIT_SECONDS):
+        """Reserva folios y confirma el lote en el diario; regresa folios, saldo final y, si `wait`, el estado y los links.
+
+        Un lote con cualquier operación inválida se rechaza completo (ValueError).
+        """
+        client_alias = payload.get("cliente")
+        if not client_alias:
+            raise ValueError("El lote debe indicar 'cliente'.")
+        raw, settings = parse_batch(payload)
+        operations, errors = importacion.build_import_batch(raw, **settings)
+        if not errors.empty:
+            raise ValueError("; ".join(f"operación {row.fila}: {row.motivo}" for row in errors.itertuples()))
+        receipts = _receipts(payload)
+        totals = importacion.import_totals(operations, self.client_balance(client_alias))
+        batch = app.import_operations(operations)
+        for position, op in zip(operations["fila"], batch):
+            op['file'] = receipts.get(position)
+        with metricas.trace("guardado", cliente=client_alias, operaciones=len(batch), origen="api"):
+            rows = app.register_operations(self.gsheet_client, self.spreadsheet_id, self.sheet_tab_name, self.journal, self.worker,
+                                           client_alias, totals['balance_final_usdt'], batch, payload.get("comprimir_comprobantes", True))
+        folios = [row[0] for row in rows]
+        result = {"folios": folios, "saldo_final_usdt": totals['balance_final_usdt']}
+        if wait:
+            result["estado"] = self.wait_synced(folios, timeout)
+        return result
+
+    def status(self, folios):
+        return self.journal.folio_status(folios)
+
+    def wait_synced(self, folios, timeout=SYNC_WAIT_SECONDS):
+        # El hilo del diario sincroniza en orden; se consulta el diario hasta que el lote quede sincronizado o fallido
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.status(folios)
+            if all(entry["estado"] in (STATUS_SYNCED, STATUS_FAILED) for entry in status) or time.monotonic() >= deadline:
+                return status
+            time.sleep(SYNC_POLL_SECONDS)
+
+# --- SERVICIO HTTP ---
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        # POST /cotizar, POST /operaciones[?esperar=1], GET /operaciones?folios=a,b
+
+        def _send(self, status, body):
+            data = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self, action):
+            try:
+                self._send(200, action())
+            except ClientNotFound as e:
+                self._send(404, {"error": str(e)})
+            except ValueError as e:
+                self._send(400, {"error": str(e)})
+            except Exception as e:
+                self._send(500, {"error": str(e)})
+
+        def _payload(self):
+            try:
+                return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except json.JSONDecodeError as e:
+                raise ValueError(f"JSON inválido: {e}") from e
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/cotizar":
+                self._handle(lambda: service.quote(self._payload()))
+            elif url.path == "/operaciones":
+                self._handle(lambda: service.register(self._payload(), wait=query.get("esperar", ["0"])[0] in ("1", "true", "si")))
+            else:
+                self._send(404, {"error": f"Ruta desconocida: {url.path}"})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/operaciones":
+                folios = [folio for value in parse_qs(url.query).get("folios", []) for folio in value.split(",") if folio]
+                self._handle(lambda: service.status(folios))
+            else:
+                self._send(404, {"error": f"Ruta desconocida: {url.path}"})
+
+        def log_message(self, format, *args):
+            logging.getLogger("servicio_operaciones").info(format, *args)
+
+    return Handler
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    # Un hilo por petición: las reservas de folio y las lecturas de Sheets de varios lotes se traslapan
+    return ThreadingHTTPServer((host, port), make_handler(service))
+
+# --- LÍNEA DE COMANDOS ---
+def connect(dropbox_token=None, journal_path=SERVICE_JOURNAL_PATH):
+    """Servicio con las credenciales de la app (st.secrets o config.py) y el token de Dropbox dado o de DROPBOX_ACCESS_TOKEN."""
+    settings = app.load_sheets_settings()
+    if settings is None:
+        raise SystemExit("No se encontraron credenciales de Google Sheets (.streamlit/secrets.toml o config.py).")
+    creds_dict, spreadsheet_id, sheet_tab_name = settings
+    dropbox_token = dropbox_token or os.environ.get("DROPBOX_ACCESS_TOKEN")
+    if not dropbox_token:
+        raise SystemExit("Falta el token de Dropbox (--token-dropbox o DROPBOX_ACCESS_TOKEN).")
+    return OperationsService(app.authorize_google_sheets(creds_dict), app.connect_to_dropbox(dropbox_token), spreadsheet_id, sheet_tab_name, journal_path)
+
+def run_batches(action, payloads, concurrency):
+    """Aplica `action` a cada lote en paralelo; los errores se regresan por lote en vez de detener el resto."""
+    def run(payload):
+        try:
+            return action(payload)
+        except Exception as e:
+            return {"error": str(e)}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(run, payloads))
+
+def benchmark(args):
+    # Mismas simulaciones de Sheets y Dropbox que benchmark_guardado (se importa solo aquí)
+    import benchmark_guardado as simulated
+    app.cuota_sheets.scheduler = app.cuota_sheets.SheetsScheduler(read_quota=float("inf"), write_quota=float("inf"))
+    spreadsheet = simulated.FakeSpreadsheet(simulated.Latency(args.sheets_latency), simulated.build_ledger(args.ledger), simulated.build_clients(args.clients))
+    dbx_client = simulated.FakeDropbox(simulated.Latency(args.dropbox_latency))
+    journal_path = os.path.join(tempfile.mkdtemp(prefix="servicio_benchmark_"), "diario.sqlite3")
+    service = OperationsService(simulated.FakeGspreadClient(spreadsheet), dbx_client, f"servicio-benchmark-{time.time_ns()}", simulated.LEDGER_TAB, journal_path)
+    receipt = {"nombre": "recibo.jpg", "base64": base64.b64encode(b"\0" * args.receipt_kb * 1024).decode("ascii")} if args.receipt_kb else None
+    payloads = [{"cliente": simulated.CLIENT_ALIAS, "operaciones": [
+        {"tipo": ("compra", "venta")[i % 2], "monto": 100 + batch, **({"comprobante": receipt} if receipt else {})} for i in range(args.operaciones)
+    ]} for batch in range(args.lotes)]
+    server = None
+    if args.http:
+        server = make_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        session = requests.Session()
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrencia))
+        url = f"http://{DEFAULT_HOST}:{server.server_address[1]}/operaciones"
+        action = lambda payload: session.post(url, json=payload).json()
+    else:
+        action = service.register
+    start = time.perf_counter()
+    results = run_batches(action, payloads, args.concurrencia)
+    registered = time.perf_counter() - start
+    failures = [result for result in results if "error" in result]
+    service.wait_synced([folio for result in results for folio in result.get("folios", [])], timeout=args.timeout)
+    synced = time.perf_counter() - start
+    if server: server.shutdown()
+    total = args.lotes * args.operaciones
+    print(f"{args.lotes} lotes x {args.operaciones} operaciones, concurrencia {args.concurrencia}{' (HTTP)' if args.http else ''}")
+    print(f"registradas: {total / registered:,.1f} ops/s ({registered:,.2f} s); sincronizadas: {total / synced:,.1f} ops/s ({synced:,.2f} s); lotes con error: {len(failures)}")
+
+def _read_payloads(path):
+    if path == "-":
+        payloads = json.load(sys.stdin)
+    else:
+        with open(path, encoding="utf-8") as source:
+            payloads = json.load(source)
+    return payloads if isinstance(payloads, list) else [payloads]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Cotiza y registra lotes de operaciones sin la interfaz de Streamlit.")
+    parser.add_argument("--token-dropbox", help="Token de Dropbox; por omisión DROPBOX_ACCESS_TOKEN")
+    parser.add_argument("--diario", default=SERVICE_JOURNAL_PATH, help="Archivo SQLite del diario del servicio")
+    parser.add_argument("--cuota-sheets", type=float, default=SERVICE_QUOTA_SHARE, help="Fracción (0 a 1) de la cuota de Sheets de la cuenta de servicio para este proceso")
+    commands = parser.add_subparsers(dest="comando", required=True)
+    quote = commands.add_parser("cotizar", help="Calcula uno o varios lotes sin registrarlos")
+    quote.add_argument("archivo", help="JSON con un lote o una lista de lotes; - para stdin")
+    register = commands.add_parser("registrar", help="Registra uno o varios lotes")
+    register.add_argument("archivo", help="JSON con un lote o una lista de lotes; - para stdin")
+    register.add_argument("--esperar", action="store_true", help="Espera a que cada lote se sincronice y muestra sus links")
+    for command in (quote, register):
+        command.add_argument("--concurrencia", type=int, default=8, help="Lotes procesados en paralelo")
+    failed = commands.add_parser("fallidos", help="Lista los lotes que agotaron sus intentos; con --reintentar o --resolver los atiende")
+    failed.add_argument("--reintentar", type=int, metavar="LOTE", help="Regresa el lote a la cola con sus intentos en cero")
+    failed.add_argument("--resolver", type=int, metavar="LOTE", help="Cierra el lote como sincronizado (p. ej. capturado a mano en la hoja)")
+    failed.add_argument("--nota", default="resuelto a mano", help="Nota que queda con el lote resuelto")
+    serve = commands.add_parser("servir", help="Servicio HTTP local")
+    serve.add_argument("--host", default=DEFAULT_HOST)
+    serve.add_argument("--puerto", type=int, default=DEFAULT_PORT)
+    bench = commands.add_parser("benchmark", help="Operaciones por segundo contra Sheets y Dropbox simulados")
+    bench.add_argument("--lotes", type=int, default=100)
+    bench.add_argument("--operaciones", type=int, default=3, help="Operaciones por lote")
+    bench.add_argument("--concurrencia", type=int, default=16, help="Lotes enviados en paralelo")
+    bench.add_argument("--http", action="store_true", help="Enviar los lotes por HTTP en vez de llamar a la API directamente")
+    bench.add_argument("--ledger", type=int, default=1000, help="Filas en el libro simulado")
+    bench.add_argument("--clients", type=int, default=1000, help="Filas en la hoja de clientes simulada")
+    bench.add_argument("--receipt-kb", type=int, default=0, help="Comprobante por operación; 0 = sin comprobantes")
+    bench.add_argument("--sheets-latency", type=float, default=0.05, help="Segundos por llamada a Sheets")
+    bench.add_argument("--dropbox-latency", type=float, default=0.1, help="Segundos por llamada a Dropbox")
+    bench.add_argument("--timeout", type=float, default=600, help="Segundos máximos de espera a la sincronización")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Fuera de `streamlit run` las cachés de Streamlit avisan en cada llamada
+    logging.disable(logging.WARNING)
+    if args.comando == "benchmark":
+        return benchmark(args)
+    if args.comando == "fallidos":
+        # Solo toca el diario: no hace falta conectarse; un servicio en marcha toma el lote reintentado en su siguiente vuelta
+        journal = SaveJournal(args.diario)
+        if args.reintentar is not None: journal.retry_batch(args.reintentar)
+        if args.resolver is not None: journal.resolve_batch(args.resolver, args.nota)
+        print(json.dumps(journal.failed_batches(), ensure_ascii=False, indent=2, default=str))
+        return
+    # La cuota se cuenta por proceso: la app usa el resto con CUOTA_SHEETS_FRACCION
+    app_share = app.cuota_sheets.configured_share()
+    if app_share + args.cuota_sheets > 1:
+        print(f"AVISO: la app ({app_share:.0%}, CUOTA_SHEETS_FRACCION) y este servicio ({args.cuota_sheets:.0%}) suman más que la cuota de Sheets de la cuenta de servicio; habrá errores 429.", file=sys.stderr)
+    app.cuota_sheets.set_share(args.cuota_sheets)
+    service = connect(args.token_dropbox, args.diario)
+    if args.comando == "servir":
+        print(f"Escuchando en http://{args.host}:{args.puerto}", file=sys.stderr)
+        make_server(service, args.host, args.puerto).serve_forever()
+        return
+    payloads = _read_payloads(args.archivo)
+    action = service.quote if args.comando == "cotizar" else partial(service.register, wait=args.esperar)
+    results = run_batches(action, payloads, args.concurrencia)
+    print(json.dumps(results if len(results) > 1 else results[0], ensure_ascii=False, indent=2, default=str))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import logging
+import os
+import sys
+import uuid
+
+import pytest
+
+# Los módulos de la app viven en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Streamlit avisa en cada caché que no hay runtime; en las pruebas no importa
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+import benchmark_guardado  # noqa: E402
+import cuota_sheets  # noqa: E402
+
+@pytest.fixture(autouse=True)
+def unlimited_sheets_quota(monkeypatch):
+    # Las hojas falsas no tienen cuota; la real haría esperar a las pruebas un minuto
+    monkeypatch.setattr(cuota_sheets, "scheduler", cuota_sheets.SheetsScheduler(read_quota=float("inf"), write_quota=float("inf")))
+
+@pytest.fixture
+def spreadsheet_id():
+    # Las cachés de la app son por id de hoja: cada prueba usa la suya
+    return f"prueba-{uuid.uuid4().hex}"
+
+@pytest.fixture
+def fake_sheets():
+    """Hoja falsa con 3 compras de días anteriores de CLIENT_ALIAS y 5 clientes."""
+    spreadsheet = benchmark_guardado.FakeSpreadsheet(benchmark_guardado.Latency(), benchmark_guardado.build_ledger(3), benchmark_guardado.build_clients(5))
+    return spreadsheet, benchmark_guardado.FakeGspreadClient(spreadsheet)
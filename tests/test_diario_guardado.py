@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+from diario_guardado import STATUS_FAILED, STATUS_PENDING, STATUS_SYNCED, JournalWorker, PermanentSyncError, SaveJournal
+
+@pytest.fixture
+def journal(tmp_path):
+    return SaveJournal(str(tmp_path / "diario.sqlite3"))
+
+def _enqueue(journal, client, folios, account=""):
+    rows = [[folio, "2026-10-18 10:00:00", client, "Compra (Das USD)", 100, 96.5, 3.5, ""] for folio in folios]
+    return journal.enqueue(client, 0, rows, {folios[0]: ("recibo.pdf", b"%PDF")}, account=account)
+
+def _worker(journal, flush_fn, **kwargs):
+    # Sin esperas entre reintentos: cada _step es un intento
+    worker = JournalWorker(journal, idle_seconds=0, max_backoff_seconds=0, **kwargs)
+    worker.configure(flush_fn)
+    return worker
+
+def _status(journal, folio):
+    return journal.folio_status([folio])[0]
+
+def test_batches_come_out_in_order_with_their_rows(journal):
+    first = _enqueue(journal, "Ana", ["F1", "F2"])
+    second = _enqueue(journal, "Beto", ["F3"])
+    batch = journal.next_pending()
+    assert batch["id"] == first
+    assert [op["folio"] for op in batch["operations"]] == ["F1", "F2"]
+    assert batch["operations"][0]["file_bytes"] == b"%PDF" and batch["operations"][1]["file_bytes"] is None
+    journal.mark_synced(first)
+    assert journal.next_pending()["id"] == second
+    journal.mark_synced(second)
+    assert journal.next_pending() is None
+
+def test_account_filter_never_overtakes_the_same_client(journal):
+    _enqueue(journal, "Ana", ["F1"], account="a")
+    _enqueue(journal, "Ana", ["F2"], account="b")
+    other = _enqueue(journal, "Beto", ["F3"], account="b")
+    # F2 espera a F1 (otra cuenta) para no escribir el saldo de Ana fuera de orden
+    assert journal.next_pending(["b"])["id"] == other
+    assert journal.next_pending(["c"]) is None
+
+def test_pending_rows_by_client(journal):
+    _enqueue(journal, "Ana", ["F1", "F2"])
+    batch = _enqueue(journal, "Beto", ["F3"])
+    _enqueue(journal, "Ana", ["F4"])
+    assert [row[0] for row in journal.pending_rows("Ana")] == ["F1", "F2", "F4"]
+    journal.mark_synced(batch)
+    assert journal.pending_rows("Beto") == []
+    assert journal.pending_count() == 2
+
+def test_failed_flush_is_retried_before_later_batches(journal):
+    _enqueue(journal, "Ana", ["F1"])
+    _enqueue(journal, "Beto", ["F2"])
+    flushed, failures = [], [RuntimeError("503"), RuntimeError("timeout")]
+
+    def flush(batch):
+        if failures: raise failures.pop(0)
+        flushed.append(batch["operations"][0]["folio"])
+        return "ok"
+
+    worker = _worker(journal, flush)
+    worker._step()
+    worker._step()
+    assert flushed == []
+    status = _status(journal, "F1")
+    assert (status["estado"], status["intentos"], status["ultimo_error"]) == (STATUS_PENDING, 2, "timeout")
+    worker._step()
+    worker._step()
+    assert flushed == ["F1", "F2"]
+    assert _status(journal, "F1")["estado"] == STATUS_SYNCED
+    assert journal.next_pending() is None
+
+def test_batch_fails_after_max_attempts_and_queue_moves_on(journal):
+    failing = _enqueue(journal, "Ana", ["F1"])
+    _enqueue(journal, "Beto", ["F2"])
+    flushed = []
+
+    def flush(batch):
+        if batch["id"] == failing: raise RuntimeError("503")
+        flushed.append(batch["id"])
+
+    worker = _worker(journal, flush, max_attempts=2)
+    for _ in range(3): worker._step()
+    assert _status(journal, "F1")["estado"] == STATUS_FAILED
+    assert len(flushed) == 1
+    assert [batch["folios"] for batch in journal.failed_batches()] == ["F1"]
+    journal.retry_batch(failing)
+    batch = journal.next_pending()
+    assert (batch["id"], batch["attempts"]) == (failing, 0)
+
+def test_permanent_error_fails_without_retrying(journal):
+    _enqueue(journal, "Ana", ["F1"])
+    calls = []
+
+    def flush(batch):
+        calls.append(batch["id"])
+        raise PermanentSyncError("Dropbox rechazó el token")
+
+    worker = _worker(journal, flush)
+    worker._step()
+    worker._step()
+    assert len(calls) == 1
+    assert _status(journal, "F1")["estado"] == STATUS_FAILED
+    journal.resolve_batch(journal.failed_batches()[0]["id"], "capturado a mano")
+    assert _status(journal, "F1")["estado"] == STATUS_SYNCED
+
+def test_worker_thread_survives_journal_errors(journal):
+    _enqueue(journal, "Ana", ["F1"])
+    synced = threading.Event()
+    next_pending, errors = journal.next_pending, [RuntimeError("database is locked")]
+
+    def flaky_next_pending(accounts=None):
+        if errors: raise errors.pop()
+        return next_pending(accounts)
+
+    journal.next_pending = flaky_next_pending
+    worker = _worker(journal, lambda batch: synced.set())
+    worker.start()
+    assert synced.wait(5)
+    assert worker.is_alive()
@@ -0,0 +1,107 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import calculadora_cambio_USD as app
+from benchmark_guardado import CLIENT_ALIAS, LEDGER_TAB, Latency
+
+TODAY = "26-10-18"
+
+def test_first_reservation_is_seeded_from_the_ledger(fake_sheets, spreadsheet_id):
+    spreadsheet, client = fake_sheets
+    spreadsheet.sheets[LEDGER_TAB].values.append([f"{TODAY}-0007", "", CLIENT_ALIAS, "Compra (Das USD)", "1", "1", "0", ""])
+    assert app.get_next_folio_number(client, spreadsheet_id, LEDGER_TAB, count=2, today_prefix=TODAY) == 8
+    assert app.get_next_folio_number(client, spreadsheet_id, LEDGER_TAB, count=1, today_prefix=TODAY) == 10
+
+def test_folios_restart_each_day(fake_sheets, spreadsheet_id):
+    _, client = fake_sheets
+    assert app.get_next_folio_number(client, spreadsheet_id, LEDGER_TAB, count=3, today_prefix="26-10-17") == 1
+    assert app.get_next_folio_number(client, spreadsheet_id, LEDGER_TAB, count=1, today_prefix=TODAY) == 1
+    assert app.get_next_folio_number(client, spreadsheet_id, LEDGER_TAB, count=1, today_prefix=TODAY) == 2
+
+def test_concurrent_reservations_do_not_overlap(fake_sheets, spreadsheet_id, monkeypatch):
+    spreadsheet, client = fake_sheets
+    # Latencia para que las reservas se intercalen; pocas filas por lectura para recorrer varias páginas
+    spreadsheet.latency = Latency(per_call=0.002)
+    monkeypatch.setattr(app, "FOLIO_LOOKBACK_ROWS", 3)
+    counts = [1 + i % 4 for i in range(40)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        firsts = list(executor.map(lambda count: app.get_next_folio_number(client, spreadsheet_id, LEDGER_TAB, count=count, today_prefix=TODAY), counts))
+    assigned = sorted(number for first, count in zip(firsts, counts) for number in range(first, first + count))
+    assert assigned == list(range(1, sum(counts) + 1))
+
+def _counter(fail=None):
+    # Reserva falsa: folios consecutivos desde 1; `fail` (un Event) hace fallar las reservas mientras esté puesto
+    state = {"next": 1, "calls": 0}
+    lock = threading.Lock()
+
+    def reserve(count, today_prefix):
+        with lock:
+            state["calls"] += 1
+            if fail is not None and fail.is_set():
+                raise RuntimeError("503 Service Unavailable")
+            first = state["next"]
+            state["next"] += count
+            return first
+    return reserve, state
+
+def _wait_refill(block):
+    with block._lock:
+        assert block._refilled.wait_for(lambda: not block._refilling, timeout=5)
+
+def test_folio_block_assigns_locally_and_refills_ahead():
+    reserve, state = _counter()
+    block = app.FolioBlock(reserve, size=10, refill_at=3)
+    block.prefetch(TODAY)
+    _wait_refill(block)
+    assert block.take(2, TODAY) == [1, 2]
+    assert block.take(5, TODAY) == [3, 4, 5, 6, 7]
+    # Quedan 3: todavía no se reserva otro bloque
+    assert state["calls"] == 1
+    assert block.take(1, TODAY) == [8]
+    _wait_refill(block)
+    assert state["calls"] == 2
+    # El bloque siguiente continúa donde terminó el anterior
+    assert block.take(4, TODAY) == [9, 10, 11, 12]
+
+def test_folio_block_reserves_inline_when_empty():
+    reserve, state = _counter()
+    block = app.FolioBlock(reserve, size=10, refill_at=3)
+    # Sin bloque: se reservan en línea los folios del lote más un bloque completo
+    assert block.take(2, TODAY) == [1, 2]
+    assert state["calls"] == 1
+    assert block.available() == 10
+
+def test_folio_block_survives_a_failed_refill():
+    fail = threading.Event()
+    reserve, _ = _counter(fail)
+    block = app.FolioBlock(reserve, size=10, refill_at=3)
+    block.prefetch(TODAY)
+    _wait_refill(block)
+    block.take(1, TODAY)
+    fail.set()
+    assert block.take(7, TODAY) == [2, 3, 4, 5, 6, 7, 8]
+    _wait_refill(block)
+    # El bloque nuevo no llegó, pero los folios restantes se siguen asignando
+    assert block.take(2, TODAY) == [9, 10]
+    with pytest.raises(RuntimeError):
+        block.take(1, TODAY)
+    fail.clear()
+    assert block.take(1, TODAY) == [11]
+
+def test_folio_block_starts_over_each_day():
+    reserve, _ = _counter()
+    block = app.FolioBlock(reserve, size=10, refill_at=3)
+    block.take(1, "26-10-17")
+    # Lo que quedó del día anterior no se asigna con el prefijo nuevo
+    assert block.take(1, TODAY) == [12]
+    assert block.available() == 10
+
+def test_folio_block_concurrent_takes_are_unique():
+    reserve, _ = _counter()
+    block = app.FolioBlock(reserve, size=7, refill_at=3)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        taken = list(executor.map(lambda count: block.take(count, TODAY), [1 + i % 3 for i in range(60)]))
+    numbers = [number for batch in taken for number in batch]
+    assert len(numbers) == len(set(numbers)) == 120
@@ -0,0 +1,69 @@
+import math
+
+import pandas as pd
+import pytest
+
+import importacion
+from motor_conversion import MODE_USD_TO_USDT, MODE_USDT_TO_USD
+
+def _raw(rows, columns=("tipo", "monto", "modo", "comision")):
+    raw = pd.DataFrame(rows, columns=list(columns))
+    raw.insert(0, "fila", range(2, len(raw) + 2))
+    return raw
+
+def _build(raw):
+    return importacion.build_import_batch(raw, comision_compra=3.5, comision_venta=4.5, mode_compra=MODE_USD_TO_USDT, mode_venta=MODE_USD_TO_USDT)
+
+def test_read_csv_normalizes_headers_and_numbers_rows():
+    raw = importacion.read_operations_file(" Tipo ;Monto;Comisión\ncompra;100;\nventa;50;2\n".encode("utf-8"), "lote.csv")
+    assert list(raw.columns) == ["fila", "tipo", "monto", "comision"]
+    assert raw["fila"].tolist() == [2, 3]
+    assert raw["comision"].tolist() == ["", "2"]
+
+def test_read_rejects_missing_columns():
+    with pytest.raises(ValueError, match="monto"):
+        importacion.read_operations_file(b"tipo,importe\ncompra,100\n", "lote.csv")
+
+def test_invalid_rows_are_reported_with_their_reason():
+    operations, errors = _build(_raw([
+        ["compra", "100", "", ""],
+        ["cambio", "100", "", ""],
+        ["venta", "0", "", ""],
+        ["venta", "abc", "", ""],
+        ["compra", "100", "euros", ""],
+        ["venta", "100", "", "-1"],
+        ["pago", "25", "euros", "-1"],
+    ]))
+    assert operations["fila"].tolist() == [2, 8]
+    assert dict(zip(errors["fila"], errors["motivo"])) == {
+        3: "tipo no reconocido (use compra, venta, pago o recibo)",
+        4: "monto inválido o no mayor a cero",
+        5: "monto inválido o no mayor a cero",
+        6: "modo inválido (use USD ➔ USDT o USDT ➔ USD)",
+        7: "comisión inválida",
+    }
+
+def test_defaults_and_overrides():
+    operations, errors = _build(_raw([
+        ["Compra", "$1,000", "", ""],
+        ["venta", "96.5", "usdt", "3.5 %"],
+        ["recibo", "10", "", ""],
+    ]))
+    assert errors.empty
+    compra, venta, recibo = operations.to_dict("records")
+    assert (compra["tipo"], compra["modo"], compra["comision"], compra["usd"], compra["usdt"]) == ("Compra", MODE_USD_TO_USDT, 3.5, 1000.0, 965.0)
+    assert (venta["tipo"], venta["modo"], venta["comision"], venta["usd"], venta["usdt"]) == ("Venta", MODE_USDT_TO_USD, 3.5, 100.0, 96.5)
+    # Los ajustes no llevan modo, comisión ni USD
+    assert recibo["tipo"] == "Ajuste-Recibo" and recibo["modo"] == "" and math.isnan(recibo["usd"]) and recibo["usdt"] == 10.0
+
+def test_import_totals():
+    operations, _ = _build(_raw([
+        ["compra", "100", "", ""],
+        ["venta", "50", "", ""],
+        ["pago", "20", "", ""],
+        ["recibo", "5", "", ""],
+    ]))
+    totals = importacion.import_totals(operations, 10.0)
+    assert totals["total_usdt_recibidos"] == 116.5
+    assert totals["total_usdt_entregados"] == 52.75
+    assert totals["balance_final_usdt"] == 73.75
@@ -0,0 +1,43 @@
+import numpy as np
+
+import motor_conversion
+from motor_conversion import MODE_USD_TO_USDT, MODE_USDT_TO_USD
+
+def test_usd_to_usdt_discounts_commission():
+    usd, usdt = motor_conversion.convert_batch([100.0], MODE_USD_TO_USDT, 3.5)
+    assert usd.tolist() == [10000]
+    assert usdt.tolist() == [9650]
+
+def test_usdt_to_usd_grosses_up_commission():
+    usd, usdt = motor_conversion.convert_batch([96.5], MODE_USDT_TO_USD, 3.5)
+    assert usd.tolist() == [10000]
+    assert usdt.tolist() == [9650]
+
+def test_half_cent_rounds_up():
+    # 0.01 USD al 50 % = 0.005 USDT
+    _, usdt = motor_conversion.convert_batch([0.01], MODE_USD_TO_USDT, 50)
+    assert usdt.tolist() == [1]
+
+def test_full_commission_converts_to_zero():
+    usd, usdt = motor_conversion.convert_batch([10.0, 10.0], [MODE_USD_TO_USDT, MODE_USDT_TO_USD], [100, 120])
+    assert usdt[0] == 0
+    assert usd[1] == 0
+
+def test_modes_and_commissions_per_row():
+    usd, usdt = motor_conversion.convert_batch([100.0, 50.0, 200.0], [MODE_USD_TO_USDT, MODE_USDT_TO_USD, MODE_USD_TO_USDT], [3.5, 0, 1.25])
+    assert usd.tolist() == [10000, 5000, 20000]
+    assert usdt.tolist() == [9650, 5000, 19750]
+
+def test_cents_round_trip():
+    cents = motor_conversion.to_cents([0.1, 0.2, 1234.56])
+    assert cents.dtype == np.int64
+    assert motor_conversion.from_cents(cents).tolist() == [0.1, 0.2, 1234.56]
+
+def test_closing_totals():
+    totals = motor_conversion.closing_totals(np.array([9650, 4825]), np.array([1000]), [20.0], [5.5], 10.0)
+    assert totals == {
+        "total_usdt_recibidos": 164.75,
+        "total_usdt_entregados": 15.5,
+        "cambio_neto_usdt": 149.25,
+        "balance_final_usdt": 159.25,
+    }
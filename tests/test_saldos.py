@@ -0,0 +1,97 @@
+import pytest
+
+import calculadora_cambio_USD as app
+from benchmark_guardado import CLIENT_ALIAS, LEDGER_TAB
+
+@pytest.fixture
+def sheets(fake_sheets):
+    # "Clientes" ya incluye las 3 compras de 96.5 del libro
+    spreadsheet, client = fake_sheets
+    spreadsheet.sheets["Clientes"].values[-1][2] = "100"
+    return spreadsheet, client
+
+@pytest.fixture
+def book(sheets, spreadsheet_id):
+    book = app.BalanceBook(sheets[1], spreadsheet_id, LEDGER_TAB)
+    reads = []
+    read_ledger_after = book._read_ledger_after
+    book._read_ledger_after = lambda ledger_row: reads.append(ledger_row) or read_ledger_after(ledger_row)
+    book.reads = reads
+    return book
+
+def _ledger(sheets):
+    return sheets[0].sheets[LEDGER_TAB].values
+
+def _row(folio, kind, usdt):
+    return [folio, "2026-10-18 10:00:00", CLIENT_ALIAS, kind, "", str(usdt), "", ""]
+
+def test_first_load_takes_balances_from_clientes(sheets, book):
+    assert book.balance(CLIENT_ALIAS) == 100
+    assert book.balance("Cliente 1") == 0
+    assert book.balance("Cliente nuevo") is None
+    # La pestaña de checkpoints queda creada con la altura del libro y los saldos iniciales
+    saved = {row[0]: row for row in sheets[0].sheets[app.BALANCE_TAB_NAME].values[1:]}
+    assert saved[CLIENT_ALIAS][1:4] == ["100.0", "4", "24-01-01-0003"]
+    assert float(saved[CLIENT_ALIAS][4]) == pytest.approx(100 - 3 * 96.5)
+
+def test_catch_up_reads_only_rows_after_the_checkpoint(sheets, book):
+    book.balance(CLIENT_ALIAS)
+    _ledger(sheets).append(_row("26-10-18-0001", "Venta (Recibes USD)", 47.75))
+    _ledger(sheets).append(_row("26-10-18-0002", "Ajuste: Pago Cliente", 10))
+    book.reads.clear()
+    assert book.balance(CLIENT_ALIAS, force=True) == pytest.approx(62.25)
+    # Se relee la última fila contada (fila 4) para confirmar que el libro no cambió
+    assert book.reads == [3]
+    _ledger(sheets).append(_row("26-10-18-0003", "Compra (Das USD)", 5))
+    book.reads.clear()
+    assert book.balance(CLIENT_ALIAS, force=True) == pytest.approx(67.25)
+    assert book.reads == [5]
+
+def test_rows_written_here_are_not_counted_twice(sheets, book):
+    book.balance(CLIENT_ALIAS)
+    row = _row("26-10-18-0001", "Compra (Das USD)", 20)
+    book.record_written([row])
+    assert book.balance(CLIENT_ALIAS) == 120
+    _ledger(sheets).append(row)
+    assert book.balance(CLIENT_ALIAS, force=True) == 120
+    # Las filas del diario que ya están en el libro tampoco se suman
+    assert book.balance(CLIENT_ALIAS, extra_rows=[row]) == 120
+
+def test_changed_ledger_rebuilds_from_row_two(sheets, book):
+    book.balance(CLIENT_ALIAS)
+    # Se borra a mano una compra ya contada y se agrega otra
+    del _ledger(sheets)[2]
+    _ledger(sheets).append(_row("26-10-18-0001", "Compra (Das USD)", 10))
+    book.reads.clear()
+    assert book.balance(CLIENT_ALIAS, force=True) == pytest.approx(13.5)
+    assert book.reads == [3, 1]
+    # Después de reconstruir se sigue leyendo solo lo nuevo
+    _ledger(sheets).append(_row("26-10-18-0002", "Compra (Das USD)", 5))
+    book.reads.clear()
+    assert book.balance(CLIENT_ALIAS, force=True) == pytest.approx(18.5)
+    assert book.reads == [3]
+
+def test_rebuild_after_restart_uses_saved_opening_balances(sheets, book, spreadsheet_id):
+    book.balance(CLIENT_ALIAS)
+    _ledger(sheets).insert(1, _row("24-01-01-0000", "Venta (Recibes USD)", 1))
+    restarted = app.BalanceBook(sheets[1], spreadsheet_id, LEDGER_TAB)
+    assert restarted.balance(CLIENT_ALIAS) == 99
+
+def test_verify_flags_differences_without_overwriting(sheets, book):
+    book.balance(CLIENT_ALIAS)
+    clients = sheets[0].sheets["Clientes"].values
+    clients[-1][2] = "999"
+    assert book.verify() == {CLIENT_ALIAS: (999.0, 100.0)}
+    assert clients[-1][2] == "999"
+    assert book.apply_corrections([CLIENT_ALIAS]) == {CLIENT_ALIAS: 100.0}
+    assert float(clients[-1][2]) == 100
+    assert book.discrepancies == {}
+
+def test_corrections_skip_balances_edited_after_verify(sheets, book):
+    book.balance(CLIENT_ALIAS)
+    clients = sheets[0].sheets["Clientes"].values
+    clients[-1][2] = "999"
+    book.verify()
+    clients[-1][2] = "500"
+    assert book.apply_corrections([CLIENT_ALIAS]) == {}
+    assert clients[-1][2] == "500"